@@ -3,4 +3,4 @@ from dc09_spt.comm import TransPath
 from dc09_spt.param import param
 import logging
 logging.getLogger(__name__).addHandler(logging.NullHandler())
-__all__ = ["dc09_spt",  "TransPath",  "param"]
+__all__ = ["dc09_spt",  "dc09_spt_async",  "dc09_hub",  "dc09_receiver",  "metrics",  "msgqueue",  "trace",  "TransPath",  "param"]
@@ -0,0 +1,147 @@
+# ----------------------------
+# Health and circuit breaker of a transmission path
+# (c 2018 van Ovost Automatisering b.v.
+# Author : Jacq. van Ovost
+# ----------------------------
+import time
+import threading
+import logging
+from collections import deque
+
+
+class path_health:
+    """
+    Health of one transmission path
+
+    Keeps the outcome of the last transfers, a smoothed round trip time (as in RFC 6298)
+    and a circuit breaker with the states
+        closed
+            the path is used
+        open
+            the path failed -threshold- times in a row and is skipped for a backoff time,
+            the backoff doubles with every failed trial up to -max_backoff-
+        half-open
+            the backoff is over, one trial transfer may use the path,
+            an answer closes the breaker, a failure opens it again
+
+    A transfer counts as success when the receiver answered (ACK, NAK or DUH),
+    the path works even when the message is not accepted
+    """
+    def __init__(self, threshold=3, backoff=1.0, max_backoff=30.0, window=20):
+        """
+        parameters
+            threshold
+                number of failures in a row that open the breaker
+            backoff
+                seconds the breaker stays open the first time
+            max_backoff
+                maximum seconds the breaker stays open
+            window
+                number of recent transfers the success rate is calculated over
+        """
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.outcomes = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened = 0
+        self.open_until = 0
+        self.probing = False
+        self.srtt = None
+        self.rttvar = None
+
+    def available(self):
+        """
+        Returns true when the path may be used for a message
+        """
+        self.lock.acquire()
+        if self.state == 'closed':
+            ret = True
+        elif self.state == 'open':
+            ret = time.monotonic() >= self.open_until
+        else:
+            ret = not self.probing
+        self.lock.release()
+        return ret
+
+    def begin(self):
+        """
+        Called when a transfer starts, an expired open breaker becomes half-open
+        """
+        self.lock.acquire()
+        if self.state == 'open' and time.monotonic() >= self.open_until:
+            self.state = 'half-open'
+        if self.state == 'half-open':
+            self.probing = True
+        self.lock.release()
+
+    def success(self, rtt=None):
+        """
+        Register an answered transfer
+
+        parameters
+            rtt
+                optional seconds from sending the block until the answer
+        """
+        self.lock.acquire()
+        self.outcomes.append(1)
+        self.failures = 0
+        self.probing = False
+        if self.state != 'closed':
+            logging.info('Path breaker closed')
+            self.state = 'closed'
+            self.opened = 0
+        if rtt is not None:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.lock.release()
+
+    def failure(self):
+        """
+        Register a transfer without connection or answer
+        """
+        self.lock.acquire()
+        self.outcomes.append(0)
+        self.failures += 1
+        self.probing = False
+        if self.state == 'half-open' or (self.state == 'closed' and self.failures >= self.threshold):
+            backoff = min(self.backoff * 2 ** self.opened, self.max_backoff)
+            self.opened += 1
+            self.state = 'open'
+            self.open_until = time.monotonic() + backoff
+            logging.warning('Path breaker open for %s seconds after %s failures', backoff, self.failures)
+        self.lock.release()
+
+    def success_rate(self):
+        """
+        Returns the part of the recent transfers that succeeded, 1.0 when nothing is known yet
+        """
+        outcomes = list(self.outcomes)
+        if len(outcomes) == 0:
+            return 1.0
+        return sum(outcomes) / len(outcomes)
+
+    def rank(self):
+        """
+        Returns a sort key, lower is healthier
+        the closed paths come first, then the paths that succeed at least half of the time,
+        then the paths with the shortest smoothed round trip time (unmeasured paths last)
+        """
+        srtt = self.srtt
+        return (self.state != 'closed', self.success_rate() < 0.5, srtt if srtt is not None else float('inf'))
+
+    def snapshot(self):
+        """
+        Returns the state as a dictionary with state, success rate, srtt and failures
+        """
+        self.lock.acquire()
+        ret = {'state': self.state, 'srtt': self.srtt, 'failures': self.failures}
+        self.lock.release()
+        ret['success rate'] = self.success_rate()
+        return ret
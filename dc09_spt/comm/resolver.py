@@ -0,0 +1,227 @@
+# ----------------------------
+# Name resolution cache and dual stack connect
+# (c 2018 van Ovost Automatisering b.v.
+# Author : Jacq. van Ovost
+# ----------------------------
+import time
+import errno
+import socket
+import selectors
+import threading
+import logging
+from dc09_spt import trace
+
+
+class resolver:
+    """
+    Cache of the addresses of one receiver
+
+    The addresses are looked up with getaddrinfo and kept for -ttl- seconds.
+    When they are expired the old addresses are still used while a background thread
+    looks them up again, so a slow name server does not delay a transfer.
+    A failed lookup without old addresses is remembered for -negative_ttl- seconds.
+    """
+    def __init__(self, host, port, type='tcp', *, ttl=300.0, negative_ttl=30.0):
+        """
+        parameters
+            host
+                IP address (v4 or v6) or DNS name of the receiver
+            port
+                port number of the receiver
+            type
+                'tcp' or 'udp'
+            ttl
+                seconds the addresses are used before they are looked up again
+            negative_ttl
+                seconds a failed lookup is remembered
+        """
+        self.host = host
+        self.port = port
+        self.socktype = socket.SOCK_DGRAM if type == 'udp' else socket.SOCK_STREAM
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.path = None
+        self.addrs = []
+        self.expires = 0
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def addresses(self):
+        """
+        Returns a list of (family, sockaddr) tuples, empty when the name can not be resolved
+        the addresses are ordered for a dual stack connect, see interleave
+        """
+        self.lock.acquire()
+        now = time.monotonic()
+        addrs = self.addrs
+        if now < self.expires:
+            self.lock.release()
+            return addrs
+        if len(addrs):
+            # serve the expired addresses and refresh in the background
+            if not self.refreshing:
+                self.refreshing = True
+                threading.Thread(target=self.refresh, name='dc09 resolver', daemon=True).start()
+            self.lock.release()
+            return addrs
+        self.lock.release()
+        return self.refresh()
+
+    def refresh(self):
+        """
+        Look up the addresses now, returns the new (or on failure the old) addresses
+        """
+        hook = trace.hook
+        if hook is not None:
+            start = time.monotonic()
+        try:
+            infos = socket.getaddrinfo(self.host, self.port, socket.AF_UNSPEC, self.socktype)
+            addrs = self.interleave([(info[0], info[4]) for info in infos])
+            error = None
+        except OSError as e:
+            addrs = []
+            error = e
+        if hook is not None:
+            trace.call(hook, 'resolve', self.path, start, time.monotonic())
+        self.lock.acquire()
+        if len(addrs):
+            self.addrs = addrs
+            self.expires = time.monotonic() + self.ttl
+        elif len(self.addrs):
+            logging.warning('Resolve of %s failed (%s), using the previous addresses', self.host, error)
+            self.expires = time.monotonic() + self.negative_ttl
+        else:
+            logging.error('Resolve of %s failed: %s', self.host, error)
+            self.expires = time.monotonic() + self.negative_ttl
+        self.refreshing = False
+        addrs = self.addrs
+        self.lock.release()
+        return addrs
+
+    def invalidate(self):
+        """
+        Forget the addresses, the next call of addresses looks them up again
+        """
+        self.lock.acquire()
+        self.addrs = []
+        self.expires = 0
+        self.lock.release()
+
+    @staticmethod
+    def interleave(addrs):
+        """
+        Order the addresses alternating between the address families,
+        starting with the family of the first address (the preference of the system)
+        """
+        ret = []
+        seen = set()
+        families = []
+        per_family = {}
+        for family, sockaddr in addrs:
+            if sockaddr in seen:
+                continue
+            seen.add(sockaddr)
+            if family not in per_family:
+                families.append(family)
+                per_family[family] = []
+            per_family[family].append((family, sockaddr))
+        while len(ret) < len(seen):
+            for family in families:
+                if len(per_family[family]):
+                    ret.append(per_family[family].pop(0))
+        return ret
+
+
+def happy_connect(addrs, timeout, delay=0.25):
+    """
+    Connect a TCP socket to the first address that answers (Happy Eyeballs, RFC 8305)
+
+    The addresses are tried in order, the next attempt starts when the previous one failed
+    or did not succeed within -delay- seconds, the attempts that are still running continue.
+    The first established connection is returned, the other attempts are closed.
+
+    parameters
+        addrs
+            list of (family, sockaddr) tuples, e.g. from resolver.addresses
+        timeout
+            maximum time in seconds for all attempts together
+        delay
+            seconds before the next address is tried in parallel
+    return value
+        the connected socket in blocking mode
+    exceptions
+        OSError when no address could be connected
+    """
+    if len(addrs) == 0:
+        raise OSError(errno.EHOSTUNREACH, 'No address to connect to')
+    if len(addrs) == 1:
+        family, sockaddr = addrs[0]
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(sockaddr)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+    end = time.monotonic() + timeout
+    sel = selectors.DefaultSelector()
+    pending = list(addrs)
+    running = 0
+    error = None
+    winner = None
+    next_start = 0
+    try:
+        while winner is None:
+            now = time.monotonic()
+            if now >= end:
+                break
+            if len(pending) and (now >= next_start or running == 0):
+                family, sockaddr = pending.pop(0)
+                try:
+                    sock = socket.socket(family, socket.SOCK_STREAM)
+                except OSError as e:
+                    error = e
+                    continue
+                sock.setblocking(False)
+                err = sock.connect_ex(sockaddr)
+                if err == 0:
+                    winner = sock
+                    break
+                if err not in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                    sock.close()
+                    error = OSError(err, 'Connect to {} failed'.format(sockaddr))
+                    continue
+                sel.register(sock, selectors.EVENT_WRITE)
+                running += 1
+                next_start = now + delay
+            if running == 0:
+                if len(pending) == 0:
+                    break
+                continue
+            wait = end - now
+            if len(pending):
+                wait = min(wait, max(0, next_start - now))
+            for key, events in sel.select(wait):
+                sock = key.fileobj
+                sel.unregister(sock)
+                running -= 1
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0 and winner is None:
+                    winner = sock
+                else:
+                    sock.close()
+                    if err != 0:
+                        error = OSError(err, 'Connect failed')
+                    # start the next attempt at once
+                    next_start = 0
+    finally:
+        for key in list(sel.get_map().values()):
+            key.fileobj.close()
+        sel.close()
+    if winner is None:
+        if error is None:
+            error = socket.timeout('Connect timed out')
+        raise error
+    winner.setblocking(True)
+    return winner
@@ -3,19 +3,60 @@
 # (c 2018 van Ovost Automatisering b.v.
 # Author : Jacq. van Ovost
 # ----------------------------
+import time
 import logging
+import threading
 from dc09_spt.comm.transpathtcp import TransPathTCP
 from dc09_spt.comm.transpathudp import TransPathUDP
+from dc09_spt.comm.resolver import resolver
+from dc09_spt.comm.health import path_health
+from dc09_spt.msg.dc09_msg import dc09_encoder
+from dc09_spt.msg import dc09_time
+from dc09_spt.metrics import path_metrics
+from dc09_spt import trace
 
 
 class TransPath:
     """
     Handle the basic tasks for establishing and maintaining a transmit path
     """
-    def __init__(self,  host,  port,  account, *, key=None,  receiver=None,  line=None,  timeout=5.0,  type=None):
+    def __init__(self,  host,  port,  account, *, key=None,  receiver=None,  line=None,  timeout=5.0,  type=None,
+                 keepalive=False, window=1, dns_ttl=300.0):
+        """
+        Define a transmission path
+
+        parameters
+            host
+                IP address (v4 or v6) or DNS name of receiver
+            port
+                Port number to be used at this receiver
+            account
+                account number to be used on this path
+            key
+                optional encryption key of 16 or 32 bytes
+            receiver
+                an optional integer to be used as receiver number in the block header
+            line
+                an optional integer to be used as line number in the block header
+            timeout
+                socket timeout in seconds
+            type
+                'tcp' (default) or 'udp'
+            keepalive
+                when true a TCP connection is kept open after a transfer and reused for the next one.
+                only use this when the receiver allows persistent connections.
+                the UDP socket of a path is always kept
+            window
+                number of messages that may be sent over one TCP connection before the answers are read.
+                1 (the default) means stop-and-wait, only use more when the receiver supports it.
+            dns_ttl
+                seconds the resolved addresses of host are cached, expired addresses are used
+                while they are looked up again in the background
+        """
         self.host = host
         self.port = port
         self.offset = 0
+        self.clock = None
         self.timeout = timeout
         self.receiver = receiver
         if type is not None:
@@ -25,12 +66,35 @@ class TransPath:
         self.account = account
         self.key = key
         self.line = line
+        self.keepalive = keepalive
+        self.window = window
+        self.conn = None
+        self.conn_lock = threading.Lock()
+        self.encoder = None
+        self.metrics = path_metrics()
+        self.resolver = resolver(host, port, self.type, ttl=dns_ttl)
+        self.resolver.path = self
+        self.health = path_health()
 
     def set_offset(self, offset):
+        """
+        Set the time offset of the receiver as measured from an answer
+
+        The clock of the receiver is kept as an offset to the monotonic clock (see msg.dc09_time.clock),
+        it is only changed when the new measurement differs a second or more,
+        the timestamps have a resolution of one second
+        """
         self.offset = offset
+        self.metrics.set_offset(offset)
+        clock = dc09_time.clock(offset)
+        if clock is None or self.clock is None or abs(clock - self.clock) >= 1:
+            self.clock = clock
 
     def get_offset(self):
         return self.offset
+
+    def get_clock(self):
+        return self.clock
     
     def get_key(self):
         return self.key
@@ -44,18 +108,114 @@ class TransPath:
     def get_account(self):
         return self.account
 
+    def get_encoder(self):
+        """
+        Return the block encoder of this path
+
+        The encoder is kept between transfers and only built again
+        when the account, key, receiver or line is changed
+        """
+        encoder = self.encoder
+        if encoder is None or encoder.key != self.key \
+                or encoder.account != self.account or encoder.receiver != self.receiver or encoder.line != self.line:
+            encoder = dc09_encoder(self.account, self.key, self.receiver, self.line)
+            encoder.path = self
+            self.encoder = encoder
+        if encoder.clock != self.clock:
+            encoder.set_clock(self.offset, self.clock)
+        return encoder
+
+    def get_window(self):
+        if self.type != 'tcp':
+            return 1
+        return self.window
+
     def connect(self):
+        """
+        Return a connection to the receiver
+
+        In keep-alive mode and for UDP the pooled connection is returned if there is one.
+        The connection is reserved for the caller until it is handed back with release,
+        call release in a finally clause
+        """
+        hook = trace.hook
+        if hook is not None:
+            start = time.monotonic()
+        if self.pooled():
+            self.conn_lock.acquire()
+            try:
+                if self.conn is None or self.conn.s is None:
+                    self.conn = self.new_conn()
+            except Exception:
+                self.conn_lock.release()
+                raise
+            conn = self.conn
+            if conn is None:
+                self.conn_lock.release()
+        else:
+            conn = self.new_conn()
+        if hook is not None:
+            trace.call(hook, 'connect', self, start, time.monotonic())
+        return conn
+
+    def new_conn(self):
         if self.type == 'tcp':
-            conn = TransPathTCP(self.host, self.port)
+            conn = TransPathTCP(self.host, self.port, self.timeout, keepalive=self.keepalive, resolver=self.resolver)
         elif self.type == 'udp':
-            conn = TransPathUDP(self.host, self.port)
+            conn = TransPathUDP(self.host, self.port, self.timeout, resolver=self.resolver)
         else:
             conn = None
             logging.error('Undefined connection type : %s',  self.type)
         if conn is not None:
-            conn.connect()
+            conn.metrics = self.metrics
+            conn.path = self
+            start = time.monotonic()
+            if conn.connect() is None:
+                conn = None
+                self.metrics.count('connect errors')
+            else:
+                self.metrics.observe_connect(time.monotonic() - start)
         return conn
-        
+
+    def release(self, conn):
+        """
+        Hand back a connection obtained with connect
+
+        In keep-alive mode a healthy connection stays open for the next transfer,
+        otherwise the connection is closed
+        """
+        if conn is None:
+            return
+        if self.pooled():
+            if conn.s is None:
+                self.conn = None
+            self.conn_lock.release()
+        else:
+            conn.disconnect()
+
+    def pooled(self):
+        """
+        Returns true when the connection is kept between transfers
+        """
+        return self.type == 'udp' or (self.keepalive and self.type == 'tcp')
+
+    def preconnect(self):
+        """
+        Open the pooled connection in advance (keep-alive mode only)
+        """
+        if self.keepalive and self.type == 'tcp':
+            self.release(self.connect())
+
+    def close(self):
+        """
+        Close the pooled connection if any
+        """
+        self.conn_lock.acquire()
+        if self.conn is not None:
+            self.conn.disconnect()
+            self.conn = None
+        self.conn_lock.release()
+
     @staticmethod
     def disconnect(conn):
         if conn is not None:
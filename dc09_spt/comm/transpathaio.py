@@ -0,0 +1,260 @@
+# ----------------------------
+# Transmit class for asyncio
+# (c 2018 van Ovost Automatisering b.v.
+# Author : Jacq. van Ovost
+# ----------------------------
+import time
+import errno
+import asyncio
+import logging
+from dc09_spt import trace
+from dc09_spt.comm.transpathudp import rto_estimator, answers
+
+# python 3.6 has no get_running_loop, there get_event_loop returns the running loop
+_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+class _UDPAnswer(asyncio.DatagramProtocol):
+    """
+    Datagram protocol handing the received answers to a queue
+    """
+    def __init__(self):
+        self.answers = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.answers.put_nowait(data)
+
+    def error_received(self, exc):
+        logging.error('UDP receive exception %s',  exc)
+
+
+async def happy_open(addrs, delay=0.25):
+    """
+    Open a TCP stream to the first address that answers (Happy Eyeballs, RFC 8305)
+
+    The asyncio version of comm.resolver.happy_connect, the attempts run in the event loop.
+    asyncio.open_connection only races the addresses it looked up itself (happy_eyeballs_delay),
+    so the cached addresses are raced here.
+
+    parameters
+        addrs
+            list of (family, sockaddr) tuples, e.g. from resolver.addresses
+        delay
+            seconds before the next address is tried in parallel
+    return value
+        (reader, writer) of the first established connection
+    exceptions
+        OSError when no address could be connected
+    note
+        the caller limits the total time, the attempts still running are cancelled
+    """
+    if len(addrs) == 0:
+        raise OSError(errno.EHOSTUNREACH, 'No address to connect to')
+    pending = list(addrs)
+    running = set()
+    error = None
+    winner = None
+    try:
+        while winner is None:
+            if len(pending):
+                family, sockaddr = pending.pop(0)
+                running.add(asyncio.ensure_future(asyncio.open_connection(sockaddr[0], sockaddr[1], family=family)))
+            if len(running) == 0:
+                break
+            done, running = await asyncio.wait(running, timeout=delay if len(pending) else None,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                elif winner is None:
+                    winner = task.result()
+                else:
+                    task.result()[1].close()
+    finally:
+        for task in running:
+            task.cancel()
+    if winner is None:
+        raise error
+    return winner
+
+
+class TransPathAIO:
+    """
+    asyncio connection for a TransPath
+
+    Uses asyncio streams for TCP and a datagram endpoint for UDP,
+    the datagram endpoint is kept and retransmits with an adaptive timeout, see comm.transpathudp.rto_estimator.
+    The host, port, type, timeout and keepalive settings are taken from the TransPath.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.reader = None
+        self.writer = None
+        self.transport = None
+        self.protocol = None
+        self.reused = False
+        self.rtt = rto_estimator(path.timeout)
+        # created in the event loop that uses it, see get_lock
+        self.lock = None
+
+    def get_lock(self):
+        """
+        Returns the lock reserving the connection for one transfer (call in the event loop)
+        """
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        return self.lock
+
+    async def connect(self):
+        if self.path.type == 'tcp':
+            if self.writer is not None:
+                return True
+            start = time.monotonic()
+            try:
+                self.reader, self.writer = await asyncio.wait_for(self.open_tcp(), self.path.timeout)
+            except Exception as e:
+                self.reader = self.writer = None
+                self.path.metrics.count('connect errors')
+                logging.error('TCP Connect to host %s port %s exception %s',  self.path.host,  self.path.port,  e)
+                return False
+            self.path.metrics.observe_connect(time.monotonic() - start)
+            self.reused = False
+        elif self.path.type == 'udp':
+            if self.transport is not None:
+                return True
+            try:
+                addrs = await self.addresses()
+                if len(addrs) == 0:
+                    raise OSError('No address for {}'.format(self.path.host))
+                family, sockaddr = addrs[0]
+                loop = _running_loop()
+                self.transport, self.protocol = await loop.create_datagram_endpoint(
+                    _UDPAnswer, remote_addr=sockaddr, family=family)
+            except Exception as e:
+                self.transport = self.protocol = None
+                logging.error('UDP Socket creation exception %s',  e)
+                return False
+        else:
+            logging.error('Undefined connection type : %s',  self.path.type)
+            return False
+        return True
+
+    async def addresses(self):
+        """
+        Returns the cached addresses of the path, see comm.resolver
+        """
+        resolver = self.path.resolver
+        if len(resolver.addrs):
+            # cached (or refreshed in the background), does not block
+            return resolver.addresses()
+        # getaddrinfo blocks, look up outside the event loop
+        return await _running_loop().run_in_executor(None, resolver.addresses)
+
+    async def open_tcp(self):
+        return await happy_open(await self.addresses())
+
+    async def sendAndReceive(self, msg, max_answ=1024):
+        """
+        Send a message and wait for the answer, returns None on failure
+
+        A kept alive connection that turns out to be closed by the receiver
+        is reopened once and the message is sent again
+        """
+        hook = trace.hook
+        if hook is None:
+            return await self.exchange(msg, max_answ)
+        start = time.monotonic()
+        antw = await self.exchange(msg, max_answ)
+        trace.call(hook, 'exchange', self.path, start, time.monotonic())
+        return antw
+
+    async def exchange(self, msg, max_answ):
+        if self.path.type == 'udp':
+            return await self._udp_exchange(msg, max_answ)
+        antw = None
+        if self.writer is not None:
+            reused = self.reused
+            self.reused = True
+            try:
+                self.writer.write(msg)
+                await self.writer.drain()
+                antw = await asyncio.wait_for(self.reader.read(max_answ), self.path.timeout)
+                if not antw:
+                    antw = None
+                    self.disconnect()
+                    if reused and await self.connect():
+                        self.path.metrics.count('retransmits')
+                        return await self.exchange(msg, max_answ)
+                    logging.error('TCP connection closed by host %s port %s',  self.path.host, self.path.port)
+            except ConnectionError as e:
+                self.disconnect()
+                if reused and await self.connect():
+                    self.path.metrics.count('retransmits')
+                    return await self.exchange(msg, max_answ)
+                logging.error('TCP message exchange to host %s port %s exception %s',  self.path.host,
+                              self.path.port,  e)
+            except Exception as e:
+                self.disconnect()
+                logging.error('TCP message exchange to host %s port %s exception %s',  self.path.host,
+                              self.path.port,  e)
+        return antw
+
+    async def _udp_exchange(self, msg, max_answ):
+        antw = None
+        if self.transport is not None:
+            while not self.protocol.answers.empty():
+                self.protocol.answers.get_nowait()
+            rto = self.rtt.rto
+            first = time.monotonic()
+            deadline = first + self.path.timeout
+            sends = 0
+            while antw is None:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                if sends > 0:
+                    self.path.metrics.count('retransmits')
+                self.transport.sendto(msg)
+                sends += 1
+                timer = min(now + rto, deadline)
+                while antw is None:
+                    wait = timer - time.monotonic()
+                    if wait <= 0:
+                        rto = self.rtt.backoff(rto)
+                        break
+                    try:
+                        antw = await asyncio.wait_for(self.protocol.answers.get(), wait)
+                    except asyncio.TimeoutError:
+                        rto = self.rtt.backoff(rto)
+                        break
+                    if not answers(msg, antw):
+                        antw = None
+            if antw is None:
+                logging.error('UDP message exchange to host %s port %s timeout',  self.path.host,  self.path.port)
+                # start again with a new endpoint (and source port)
+                self.disconnect()
+            else:
+                antw = antw[:max_answ]
+                if sends > 1:
+                    # the answer can belong to any transmission
+                    self.rtt.keep(rto)
+                else:
+                    self.rtt.sample(time.monotonic() - first)
+        return antw
+
+    def release(self):
+        """
+        Close the connection unless the path keeps it, see TransPath.pooled
+        """
+        if not self.path.pooled():
+            self.disconnect()
+
+    def disconnect(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.reader = None
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+            self.protocol = None
@@ -3,23 +3,39 @@
 # (c 2018 van Ovost Automatisering b.v.
 # Author : Jacq. van Ovost
 # ----------------------------
+import time
 import socket
 import logging
+from dc09_spt import trace
+import dc09_spt.comm.resolver as dns
 
 
 class TransPathTCP:
-    def __init__(self, host, port,  timeout=5):
+    def __init__(self, host, port,  timeout=5, *, keepalive=False, resolver=None):
         self.host = host
         self.port = port
+        if resolver is None:
+            resolver = dns.resolver(host, port, 'tcp')
+        self.resolver = resolver
         self.timeout = timeout
+        self.keepalive = keepalive
+        self.reused = False
         self.s = None
+        self.metrics = None
+        self.path = None
 
     def connect(self):
         try:
-            self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.s = None
+            self.s = dns.happy_connect(self.resolver.addresses(), self.timeout)
             self.s.settimeout(self.timeout)
-            self.s.connect((self.host, self.port))
+            if self.keepalive:
+                self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            self.reused = False
         except Exception as e:
+            if self.s is not None:
+                self.s.close()
             self.s = None
             logging.error('TCP Connect to host %s port %s exception %s',  self.host,  self.port,  e)
         return self.s
@@ -27,9 +43,9 @@ class TransPathTCP:
     def send(self, msg):
         if self.s is not None:
             try:
-                self.s.send(msg)
+                self.s.sendall(msg)
             except Exception as e:
-                self.s = None
+                self.disconnect()
                 logging.error('TCP send message to host %s port %s exception %s',  self.host, self.port, e)
     
     def receive(self, length=1024):
@@ -37,23 +53,57 @@ class TransPathTCP:
         if self.s is not None:
             try:
                 antw = self.s.recv(length)
+                if not antw:
+                    antw = None
+                    self.disconnect()
+                    logging.error('TCP connection closed by host %s port %s',  self.host, self.port)
             except Exception as e:
-                self.s = None
+                self.disconnect()
                 logging.error('TCP receive message from host %s port %s exception %s',  self.host, self.port, e)
         return antw
 
     def sendAndReceive(self, msg, max_answ=1024):
+        """
+        Send a message and wait for the answer
+
+        A kept alive connection that turns out to be closed by the receiver
+        is reopened once and the message is sent again
+        """
+        hook = trace.hook
+        if hook is None:
+            return self.exchange(msg, max_answ)
+        start = time.monotonic()
+        antw = self.exchange(msg, max_answ)
+        trace.call(hook, 'exchange', self.path, start, time.monotonic())
+        return antw
+
+    def exchange(self, msg, max_answ):
         antw = None
         if self.s is not None:
+            reused = self.reused
+            self.reused = True
             try:
-                self.s.send(msg)
+                self.s.sendall(msg)
             except Exception as e:
-                self.s = None
+                self.disconnect()
+                if reused and self.connect() is not None:
+                    if self.metrics is not None:
+                        self.metrics.count('retransmits')
+                    return self.exchange(msg, max_answ)
                 logging.error('TCP send message to host %s port %s exception %s',  self.host, self.port, e)
+                return None
             try:
                 antw = self.s.recv(max_answ)
+                if not antw:
+                    antw = None
+                    self.disconnect()
+                    if reused and self.connect() is not None:
+                        if self.metrics is not None:
+                            self.metrics.count('retransmits')
+                        return self.exchange(msg, max_answ)
+                    logging.error('TCP connection closed by host %s port %s',  self.host, self.port)
             except Exception as e:
-                self.s = None
+                self.disconnect()
                 logging.error('TCP receive message from host %s port %s exception %s',  self.host, self.port, e)
         return antw
 
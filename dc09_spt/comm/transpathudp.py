@@ -3,39 +3,144 @@
 # (c 2018 van Ovost Automatisering b.v.
 # Author : Jacq. van Ovost
 # ----------------------------
+import time
 import socket
 import logging
+from dc09_spt import trace
+import dc09_spt.comm.resolver as dns
+
+
+def _seq(data):
+    """
+    Returns the sequence number after the id token of a block or answer, or None
+    """
+    try:
+        start = data.index(b'"', data.index(b'"') + 1) + 1
+    except ValueError:
+        return None
+    return data[start:start + 4]
+
+
+def answers(block, antw):
+    """
+    Returns false when antw is the late answer to an earlier block,
+    NAK answers carry sequence number 0000 and are always accepted
+    """
+    seq = _seq(antw)
+    return seq is None or seq == b'0000' or seq == _seq(block)
+
+
+class rto_estimator:
+    """
+    Retransmission timeout of a UDP path
+
+    The rto follows a smoothed round trip time and its variance (as in RFC 6298),
+    it starts at timeout / 5 and doubles with every retransmission up to timeout / 2.
+    Only exchanges without retransmission are measured (Karn),
+    after a retransmission the backed off rto is kept until the next measurement
+    """
+    min_rto = 0.05
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.srtt = None
+        self.rttvar = None
+        self.rto = timeout / 5
+
+    def max_rto(self):
+        return self.timeout / 2
+
+    def backoff(self, rto):
+        """
+        Returns the rto for the next retransmission
+        """
+        return min(rto * 2, self.max_rto())
+
+    def sample(self, rtt):
+        """
+        Update the estimate with the time of an exchange without retransmission
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto), self.max_rto())
+
+    def keep(self, rto):
+        """
+        Keep the backed off rto after an exchange with retransmissions
+        """
+        self.rto = rto
 
 
 class TransPathUDP:
-    def __init__(self, host, port,  timeout=5):
+    """
+    UDP connection to a receiver
+
+    The socket is connected to the receiver so the kernel only passes its datagrams,
+    it is kept by TransPath and used for all transfers of the path.
+    A block is sent again when no answer arrived within the retransmission timeout,
+    see rto_estimator, until timeout seconds have passed
+    """
+    def __init__(self, host, port,  timeout=5, *, resolver=None):
         self.host = host
         self.port = port
+        if resolver is None:
+            resolver = dns.resolver(host, port, 'udp')
+        self.resolver = resolver
+        self.addr = None
         self.timeout = timeout
         self.s = None
+        self.metrics = None
+        self.path = None
+        self.rtt = rto_estimator(timeout)
 
     def connect(self):
         try:
-            self.s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.s = None
+            addrs = self.resolver.addresses()
+            if len(addrs) == 0:
+                raise OSError('No address for {}'.format(self.host))
+            family, self.addr = addrs[0]
+            self.s = socket.socket(family, socket.SOCK_DGRAM)
+            self.s.connect(self.addr)
             self.s.settimeout(self.timeout)
         except Exception as e:
+            if self.s is not None:
+                self.s.close()
             self.s = None
             logging.error('UDP Socket creation exception %s',  e)
         return self.s
-        
+
+    def drain(self):
+        """
+        Discard late answers to earlier blocks
+        """
+        self.s.setblocking(False)
+        try:
+            while True:
+                self.s.recv(1024)
+        except (BlockingIOError, ConnectionRefusedError):
+            pass
+        finally:
+            self.s.settimeout(self.timeout)
+
     def send(self, msg):
         if self.s is not None:
             try:
-                self.s.sendto(msg, (self.host, self.port))
+                self.drain()
+                self.s.send(msg)
             except Exception as e:
                 self.s = None
                 logging.error('UDP send message to host %s port %s exception %s',  self.host,  self.port,  e)
-    
+
     def receive(self, length=1024):
         antw = None
         if self.s is not None:
             try:
-                antw,  sender = self.s.recvfrom(length)
+                antw = self.s.recv(length)
             except Exception as e:
                 self.s = None
                 logging.error('UDP receive message from host %s port %s exception %s',  self.host,  self.port,  e)
@@ -43,27 +148,59 @@ class TransPathUDP:
 
     def sendAndReceive(self, msg,  max_antw=1024):
         antw = None
+        hook = trace.hook
+        if hook is not None:
+            start = time.monotonic()
         if self.s is not None:
+            rto = self.rtt.rto
+            first = time.monotonic()
+            deadline = first + self.timeout
+            resent = False
+            sends = 0
             try:
-                self.s.settimeout(self.timeout / 5)
-                for x in range(5):
-                    try:
-                        self.s.sendto(msg, (self.host, self.port))
-                        antw,  sender = self.s.recvfrom(max_antw)
-                        if sender[1] != self.port:
+                self.drain()
+                while antw is None:
+                    now = time.monotonic()
+                    if now >= deadline:
+                        break
+                    if sends > 0:
+                        resent = True
+                        if self.metrics is not None:
+                            self.metrics.count('retransmits')
+                    self.s.send(msg)
+                    sends += 1
+                    timer = min(now + rto, deadline)
+                    while antw is None:
+                        wait = timer - time.monotonic()
+                        if wait <= 0:
+                            rto = self.rtt.backoff(rto)
+                            break
+                        self.s.settimeout(wait)
+                        try:
+                            antw = self.s.recv(max_antw)
+                        except socket.timeout:
+                            rto = self.rtt.backoff(rto)
+                            break
+                        if not answers(msg, antw):
                             antw = None
-                    except Exception as e:
-                        if e != TimeoutError:
-                            raise
-                        else:
-                            pass
+                if antw is not None:
+                    if resent:
+                        # the answer can belong to any transmission
+                        self.rtt.keep(rto)
                     else:
-                        break
+                        self.rtt.sample(time.monotonic() - first)
+                self.s.settimeout(self.timeout)
             except Exception as e:
-                self.s = None
+                self.disconnect()
                 logging.error('UDP message exchange to host %s port %s exception %s',  self.host,  self.port,  e)
             if antw is None:
                 logging.error('UDP message exchange to host %s port %s timeout',  self.host,  self.port)
+                if self.s is not None:
+                    # start again with a new socket (and source port), the address may have changed
+                    self.disconnect()
+                    self.connect()
+        if hook is not None:
+            trace.call(hook, 'exchange', self.path, start, time.monotonic())
         return antw
 
     def disconnect(self):
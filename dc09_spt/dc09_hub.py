@@ -0,0 +1,304 @@
+# ----------------------------
+# Multi account dialler hub
+# (c 2018 van Ovost Automatisering b.v.
+# Author : Jacq. van Ovost
+# ----------------------------
+from dc09_spt.dc09_spt import dc09_spt, event_thread
+import time
+import heapq
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+
+class hub_account(dc09_spt):
+    """
+    A dialler owned by a dc09_hub
+
+    It has the same interface as dc09_spt, but instead of starting its own poll and event
+    threads the polling, routines and queue handling are done by the worker pool of the hub.
+    """
+
+    def __init__(self, hub, account, receiver=None, line=None, callback=None, queue=None, *, max_queue=None,
+                 max_queue_bytes=None, overflow='block'):
+        dc09_spt.__init__(self, account, receiver, line, callback, queue, max_queue=max_queue,
+                          max_queue_bytes=max_queue_bytes, overflow=overflow)
+        self.hub = hub
+        self.send = event_thread(self.account, self.receiver, self.line, self.queue, self.queuelock, self.tpaths,
+                                 self.tpaths_lock, self)
+        self.send_busy = False
+        self.send_next = 0
+        self.poll_busy = False
+        self.poll_next = 0
+        self.poll_preconnect = False
+
+    def start_poll(self, main, backup=None, retry_delay=5, ok_msg=None, fail_msg=None):
+        dc09_spt.start_poll(self, main, backup, retry_delay, ok_msg, fail_msg)
+        self.hub.schedule_poll(self, time.monotonic())
+
+    def start_routine(self, rlist):
+        dc09_spt.start_routine(self, rlist)
+        if self.poll is not None:
+            self.hub.schedule_poll(self, time.monotonic())
+
+    def start_poller(self):
+        self.poll_active = 1
+        self.poll_preconnect = True
+
+    def stop_poller(self):
+        self.poll.stop()
+        self.poll_active = 0
+        self.poll = None
+
+    def wake_sender(self):
+        self.hub.submit_send(self)
+
+    def set_race(self, delay=0.2, pool=None):
+        if pool is None and delay is not None:
+            pool = self.hub.get_race_pool()
+        dc09_spt.set_race(self, delay, pool)
+
+
+class dc09_hub:
+    """
+    Handle many diallers (accounts) with a fixed number of threads
+
+    All accounts share one scheduler thread and a bounded pool of worker threads
+    that transmit the queued messages and do the polls and routines.
+    Per account at most one worker sends and one worker polls at the same time,
+    so the order of the messages of an account is kept.
+
+    example
+        hub = dc09_hub(workers=16)
+        spt = hub.add_account("0123")
+        spt.set_path("main", "primary", "ovost.eu", 12128)
+        spt.start_poll(85)
+        spt.send_msg('SIA-DCS', {'code': 'OP', 'zone': 14})
+
+    Copyright (c) 2018  van Ovost Automatisering b.v.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    you may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+    """
+
+    def __init__(self, workers=8, tick=None):
+        """
+        Create a hub
+
+        parameters
+            workers
+                number of worker threads shared by all accounts
+            tick
+                optional maximum time in seconds the scheduler sleeps without checking its deadlines.
+                by default it only wakes for the first deadline or for new work
+        """
+        self.accounts = {}
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.tick = tick
+        self.heap = []
+        self.seq = 0
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dc09_hub')
+        self.race_pool = None
+        self.running = True
+        self.scheduler = threading.Thread(target=self.run, name='dc09_hub scheduler', daemon=True)
+        self.scheduler.start()
+
+    def add_account(self, account, receiver=None, line=None, callback=None, queue=None, *, max_queue=None,
+                    max_queue_bytes=None, overflow='block'):
+        """
+        Add a dialler to the hub
+
+        parameters
+            account
+                Account number to be used.
+            receiver
+                an optional integer to be used as receiver number in the block header
+            line
+                an optional integer to be used as line number in the block header
+            callback
+                optional callback for generated messages
+            queue
+                optional send queue, see dc09_spt
+            max_queue, max_queue_bytes, overflow
+                optional limits of the send queue, see dc09_spt
+        return value
+            the hub_account object, to be used like a dc09_spt object
+        """
+        self.lock.acquire()
+        if account in self.accounts:
+            self.lock.release()
+            raise Exception('Account {} already in hub'.format(account))
+        spt = hub_account(self, account, receiver, line, callback, queue, max_queue=max_queue,
+                          max_queue_bytes=max_queue_bytes, overflow=overflow)
+        self.accounts[account] = spt
+        self.lock.release()
+        return spt
+
+    def del_account(self, account):
+        """
+        Remove a dialler from the hub, messages still queued are dropped
+        """
+        self.lock.acquire()
+        spt = self.accounts.pop(account, None)
+        self.lock.release()
+        if spt is not None and spt.poll is not None:
+            spt.stop_poller()
+        return spt
+
+    def get_account(self, account):
+        """
+        Returns the dialler for an account or None
+        """
+        return self.accounts.get(account)
+
+    def state(self):
+        """
+        Returns a dictionary with the state of each account, see dc09_spt.state
+        """
+        ret = {}
+        for account, spt in list(self.accounts.items()):
+            ret[account] = spt.state()
+        return ret
+
+    def stop(self):
+        """
+        Stop the scheduler and the worker threads
+        """
+        self.cond.acquire()
+        self.running = False
+        self.cond.notify()
+        self.cond.release()
+        self.scheduler.join()
+        self.pool.shutdown(wait=True)
+        if self.race_pool is not None:
+            self.race_pool.shutdown(wait=True)
+
+    def get_race_pool(self):
+        """
+        Returns the executor shared by the accounts that race their paths, see dc09_spt.set_race
+
+        note
+            it is not the worker pool, a worker waiting for its race would otherwise
+            take a thread the race needs
+        """
+        self.lock.acquire()
+        if self.race_pool is None:
+            self.race_pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='dc09_race')
+        self.lock.release()
+        return self.race_pool
+
+    def schedule_poll(self, spt, when):
+        """
+        Schedule the next poll round of an account at monotonic time -when-
+        """
+        self.cond.acquire()
+        spt.poll_next = when
+        self.push(when, spt, 'poll')
+        self.cond.release()
+
+    def push(self, when, spt, kind):
+        # call with lock held
+        self.seq += 1
+        heapq.heappush(self.heap, (when, self.seq, spt, kind))
+        if self.heap[0][1] == self.seq:
+            self.cond.notify()
+
+    def submit_send(self, spt):
+        """
+        Hand the queue of an account to a worker unless one is already busy with it
+        """
+        self.lock.acquire()
+        if spt.send_busy or not self.running:
+            self.lock.release()
+            return
+        spt.send_busy = True
+        self.lock.release()
+        self.pool.submit(self.do_send, spt)
+
+    # -----------------
+    # scheduler, sleeps until the first deadline in the heap
+    # and hands due work to the workers
+    # -----------------
+    def run(self):
+        self.cond.acquire()
+        while self.running:
+            now = time.monotonic()
+            while len(self.heap) and self.heap[0][0] <= now:
+                when, seq, spt, kind = heapq.heappop(self.heap)
+                if self.accounts.get(spt.account) is not spt:
+                    continue
+                if kind == 'poll':
+                    # skip rescheduled entries, a busy worker schedules the next round itself
+                    if spt.poll_busy or when != spt.poll_next or spt.poll is None or not spt.poll.active():
+                        continue
+                    spt.poll_busy = True
+                    self.pool.submit(self.do_poll, spt)
+                else:
+                    if spt.send_busy or len(spt.queue) == 0:
+                        continue
+                    spt.send_busy = True
+                    self.pool.submit(self.do_send, spt)
+            timeout = self.tick
+            if len(self.heap) and (timeout is None or self.heap[0][0] - now < timeout):
+                timeout = self.heap[0][0] - now
+            self.cond.wait(timeout)
+        self.cond.release()
+
+    # -----------------
+    # worker tasks
+    # -----------------
+    def do_send(self, spt):
+        sender = spt.send
+        sender.running = True
+        try:
+            while True:
+                while len(spt.queue):
+                    if not sender.send():
+                        spt.send_next = time.monotonic() + sender.send_retry_delay
+                        break
+                self.lock.acquire()
+                if len(spt.queue) == 0:
+                    spt.send_busy = False
+                    self.lock.release()
+                    break
+                if spt.send_next > time.monotonic():
+                    spt.send_busy = False
+                    self.push(spt.send_next, spt, 'send')
+                    self.lock.release()
+                    break
+                self.lock.release()
+        except Exception as e:
+            logging.error('Hub send for account %s exception %s', spt.account, repr(e))
+            self.lock.acquire()
+            spt.send_busy = False
+            self.push(time.monotonic() + sender.send_retry_delay, spt, 'send')
+            self.lock.release()
+        sender.running = False
+
+    def do_poll(self, spt):
+        poll = spt.poll
+        try:
+            if poll is not None:
+                if spt.poll_preconnect:
+                    spt.poll_preconnect = False
+                    poll.preconnect()
+                poll.poll_once()
+        except Exception as e:
+            logging.error('Hub poll for account %s exception %s', spt.account, repr(e))
+        self.cond.acquire()
+        spt.poll_busy = False
+        if poll is not None and poll is spt.poll and poll.active():
+            spt.poll_next = poll.next_due()
+            self.push(spt.poll_next, spt, 'poll')
+        self.cond.release()
@@ -0,0 +1,359 @@
+# ----------------------------
+# DC09 receiver for asyncio
+# (c 2018 van Ovost Automatisering b.v.
+# Author : Jacq. van Ovost
+# ----------------------------
+from dc09_spt.msg.dc09_msg import dc09_msg, _cipher, _padding
+from dc09_spt.msg import dc09_time
+import time
+import asyncio
+import logging
+
+# python 3.6 has no get_running_loop, there get_event_loop returns the running loop
+_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+class _TCPReceive(asyncio.Protocol):
+    """
+    TCP connection of the receiver, frames the received data into blocks
+    """
+    def __init__(self, receiver):
+        self.receiver = receiver
+        self.transport = None
+        self.buf = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.receiver.connections += 1
+
+    def connection_lost(self, exc):
+        self.receiver.connections -= 1
+        self.transport = None
+
+    def data_received(self, data):
+        if self.buf:
+            data = self.buf + data
+        answers, self.buf = self.receiver.feed(data, self.transport.get_extra_info('peername'))
+        if answers:
+            self.transport.write(answers)
+
+
+class _UDPReceive(asyncio.DatagramProtocol):
+    """
+    UDP endpoint of the receiver, every datagram holds one block
+    """
+    def __init__(self, receiver):
+        self.receiver = receiver
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        answers = self.receiver.feed(data, addr)[0]
+        if answers:
+            self.transport.sendto(answers, addr)
+
+    def error_received(self, exc):
+        logging.error('UDP receive exception %s',  exc)
+
+
+class dc09_receiver:
+    """
+    SIA DC09 receiver in an asyncio event loop
+
+    Accepts blocks over TCP and UDP, checks the CRC and the length, decrypts the blocks
+    of accounts with a key and answers with ACK, NAK or DUH.
+    Encrypted blocks are answered with NAK when their timestamp is outside the allowed window,
+    the NAK carries the receiver time so the dialler can correct its offset.
+    Blocks with a wrong CRC or length are ignored as prescribed by DC09.
+
+    The receiver can be used as a local stand-in for a real receiver in tests and benchmarks,
+    or as a lightweight receiver.
+
+    example
+        def event(account, mtype, msg_nr, msg):
+            print(account, mtype, msg_nr, msg)
+
+        rcv = dc09_receiver(keys={'0123': b'0123456789abcdef'}, callback=event)
+        await rcv.start('0.0.0.0', 12128)
+
+    Copyright (c) 2018  van Ovost Automatisering b.v.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    you may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+    """
+
+    cache_size = 1024
+
+    def __init__(self, keys=None, callback=None, *, max_ahead=20, max_behind=40):
+        """
+        Define a receiver
+
+        parameters
+            keys
+                optional dictionary with the encryption key (16 or 32 bytes) per account
+            callback
+                optional function called as callback(account, mtype, msg_nr, msg) for every correct block,
+                polls included (mtype 'NULL').
+                msg is the content after the header as string, decrypted if needed.
+                it may return 'ACK', 'NAK' or 'DUH' to choose the answer, None means 'ACK',
+                any other value is answered with 'DUH'.
+                the callback runs in the event loop and should not block.
+            max_ahead
+                seconds the timestamp of an encrypted block may be ahead of the receiver time
+            max_behind
+                seconds the timestamp of an encrypted block may be behind the receiver time
+        """
+        self.keys = {} if keys is None else dict(keys)
+        self.callback = callback
+        self.max_ahead = max_ahead
+        self.max_behind = max_behind
+        self.servers = []
+        self.transports = []
+        self.connections = 0
+        self.counts = {'blocks': 0, 'ACK': 0, 'NAK': 0, 'DUH': 0, 'errors': 0}
+        # the receiver time is formatted once per second
+        self.stamp_second = None
+        self.stamp = None
+        self.nak = None
+        # the answer parts around the message number per (answer, block header, encrypted)
+        self.parts = {}
+
+    def set_key(self, account, key):
+        """
+        Set or remove (key None) the encryption key of an account
+        """
+        if key is None:
+            self.keys.pop(account, None)
+        else:
+            if len(key) != 16 and len(key) != 32:
+                raise Exception('Keylength is {} but must be either 16 or 32'.format(len(key)))
+            self.keys[account] = key
+
+    async def start(self, host='0.0.0.0', port=12128, *, tcp=True, udp=True):
+        """
+        Start listening for blocks
+
+        parameters
+            host
+                address to listen on
+            port
+                port number, 0 picks a free port (see ports)
+            tcp
+                listen for TCP connections
+            udp
+                listen for UDP datagrams
+        """
+        loop = _running_loop()
+        if tcp:
+            server = await loop.create_server(lambda: _TCPReceive(self), host, port)
+            self.servers.append(server)
+            if port == 0:
+                port = server.sockets[0].getsockname()[1]
+        if udp:
+            transport = (await loop.create_datagram_endpoint(lambda: _UDPReceive(self), local_addr=(host, port)))[0]
+            self.transports.append(transport)
+
+    def ports(self):
+        """
+        Returns a list of (type, port) tuples the receiver listens on
+        """
+        ret = [('tcp', server.sockets[0].getsockname()[1]) for server in self.servers]
+        ret += [('udp', transport.get_extra_info('sockname')[1]) for transport in self.transports]
+        return ret
+
+    def close(self):
+        """
+        Stop listening
+        """
+        for server in self.servers:
+            server.close()
+        for transport in self.transports:
+            transport.close()
+        self.servers = []
+        self.transports = []
+
+    def state(self):
+        """
+        Returns a dictionary with the number of blocks, answers per type, rejected blocks
+        and open TCP connections
+        """
+        ret = dict(self.counts)
+        ret['connections'] = self.connections
+        return ret
+
+    def feed(self, data, addr=None):
+        """
+        Handle received data
+
+        parameters
+            data
+                received bytes, may contain more blocks and an incomplete block at the end
+            addr
+                address of the sender, only used for logging
+        return value
+            [0]
+                the answers as bytes
+            [1]
+                the remaining bytes of an incomplete block
+        """
+        answers = []
+        pos = 0
+        end = len(data)
+        while True:
+            start = data.find(b'\n', pos)
+            if start < 0 or start + 9 > end:
+                rest = data[start:] if start >= 0 else b''
+                break
+            try:
+                length = int(data[start + 5:start + 9], 16)
+            except ValueError:
+                self.counts['errors'] += 1
+                pos = start + 1
+                continue
+            stop = start + 10 + length
+            if stop > end:
+                rest = data[start:]
+                break
+            frame = data[start:stop]
+            pos = stop
+            if frame[-1] != 13:
+                self.counts['errors'] += 1
+                pos = start + 1
+                continue
+            answer = self.handle_frame(frame, addr)
+            if answer is not None:
+                answers.append(answer)
+        return b''.join(answers), rest
+
+    def handle_frame(self, frame, addr=None):
+        """
+        Check and decode one block and return the answer block, or None to ignore the block
+        """
+        content = frame[9:-1]
+        try:
+            crc = int(frame[1:5], 16)
+        except ValueError:
+            crc = None
+        if len(content) != int(frame[5:9], 16) or dc09_msg.dc09crc(content) != crc:
+            self.counts['errors'] += 1
+            logging.warning('Block with wrong CRC or length from %s', addr)
+            return None
+        self.counts['blocks'] += 1
+        try:
+            encrypted = content[1] == 42
+            tstart = 2 if encrypted else 1
+            tend = content.index(b'"', tstart)
+            mtype = content[tstart:tend].decode('ascii')
+            msg_nr = int(content[tend + 1:tend + 5])
+            bracket = content.index(b'[', tend)
+            header = content[tend + 5:bracket]
+            account = header[header.index(b'#') + 1:].decode('ascii')
+        except ValueError:
+            return self.answer('DUH', b'0000', b'', None)
+        nr = content[tend + 1:tend + 5]
+        key = None
+        if encrypted:
+            key = self.keys.get(account)
+            if key is None:
+                logging.warning('Encrypted block from %s for account %s without key', addr, account)
+                return self.answer('DUH', nr, header, None)
+            try:
+                plain = self.decrypt(key, bytes.fromhex(content[bracket + 1:].decode('ascii')))
+                msg = plain[plain.index(b'|') + 1:-20]
+                skew = self.timestamp(plain[-19:]) - time.time()
+            except Exception as e:
+                logging.warning('Block from %s for account %s not decrypted: %s', addr, account, e)
+                return self.answer('DUH', nr, header, None)
+            if skew > self.max_ahead or skew < -self.max_behind:
+                return self.answer('NAK', nr, header, None)
+        else:
+            msg = content[bracket + 1:]
+        res = None
+        if self.callback is not None:
+            try:
+                res = self.callback(account, mtype, msg_nr, msg.decode('latin-1'))
+            except Exception as e:
+                logging.error('Receiver callback exception %s', repr(e))
+                res = 'DUH'
+            if res is not None and res not in ('ACK', 'NAK', 'DUH'):
+                logging.error('Receiver callback returned %s, answered with DUH', repr(res))
+                res = 'DUH'
+        return self.answer(res or 'ACK', nr, header, key)
+
+    def answer(self, res, nr, header, key):
+        """
+        Build an answer block
+        """
+        self.counts[res] += 1
+        if res == 'NAK':
+            return self.nak_block()
+        head, tail = self.answer_parts(res, header, key is not None)
+        if key is None:
+            body = b''.join((head, nr, tail))
+        else:
+            plain = b''.join((_padding(10), b'|]_', self.receiver_time()))
+            encryptor = _cipher(key).encryptor()
+            crypt = encryptor.update(plain) + encryptor.finalize()
+            body = b''.join((head, nr, tail, crypt.hex().upper().encode('ascii')))
+        return b'\n%04X%04X' % (dc09_msg.dc09crc(body), len(body)) + body + b'\r'
+
+    def answer_parts(self, res, header, encrypted):
+        """
+        Returns the parts of an answer block in front of and after the message number,
+        they are formatted once per answer, block header (account) and encryption
+        """
+        ident = (res, header, encrypted)
+        ret = self.parts.get(ident)
+        if ret is None:
+            if encrypted:
+                ret = (('"*' + res + '"').encode('ascii'), header + b'[')
+            else:
+                ret = (('"' + res + '"').encode('ascii'), header + b'[]')
+            if len(self.parts) >= self.cache_size:
+                self.parts.clear()
+            self.parts[ident] = ret
+        return ret
+
+    def receiver_time(self):
+        """
+        Returns the receiver time as used in DC09 timestamps (HH:MM:SS,MM-DD-YYYY) as bytes
+        """
+        now = int(time.time())
+        if now != self.stamp_second:
+            self.stamp = dc09_time.format_stamp(now)
+            body = b'"NAK"0000R0L0A0[]_' + self.stamp
+            self.nak = b'\n%04X%04X' % (dc09_msg.dc09crc(body), len(body)) + body + b'\r'
+            self.stamp_second = now
+        return self.stamp
+
+    def nak_block(self):
+        """
+        Returns the NAK block with the current receiver time, it is formatted once per second
+        """
+        self.receiver_time()
+        return self.nak
+
+    @staticmethod
+    def decrypt(key, data):
+        if len(data) % 16 != 0:
+            raise Exception('Data length not a multiple of 16')
+        decryptor = _cipher(key).decryptor()
+        return decryptor.update(data) + decryptor.finalize()
+
+    @staticmethod
+    def timestamp(stamp):
+        """
+        Convert a DC09 timestamp (HH:MM:SS,MM-DD-YYYY) to seconds since the epoch
+        """
+        return dc09_time.parse(stamp)
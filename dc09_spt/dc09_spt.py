@@ -7,10 +7,25 @@ from dc09_spt.msg.dc09_msg import *
 from dc09_spt.msg.dc05_msg import *
 from dc09_spt.msg.dc03_msg import *
 import time
+import atexit
+import weakref
 import threading
-from collections import deque
 import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dc09_spt.comm.transpath import TransPath
+from dc09_spt.msgqueue import msg_queue, queued_msg, transmission_classes
+from dc09_spt import trace
+
+# the sender threads of all diallers, drained when the program exits
+_senders = weakref.WeakSet()
+
+
+def _drain_senders():
+    for sender in list(_senders):
+        sender.drain()
+
+
+atexit.register(_drain_senders)
 
 
 class dc09_spt:
@@ -32,7 +47,8 @@ class dc09_spt:
     limitations under the License.
     """
 
-    def __init__(self, account, receiver=None, line=None, callback=None):
+    def __init__(self, account, receiver=None, line=None, callback=None, queue=None, *, max_queue=None,
+                 max_queue_bytes=None, overflow='block'):
         """
         Define a basic dialler (SPT Secure Premises Transceiver)
         
@@ -44,6 +60,25 @@ class dc09_spt:
                 an optional integer to be used as receiver number in the block header
             line
                 an optional integer to be used as line number in the block header
+            callback
+                optional function called for generated poll state messages
+            queue
+                optional send queue, e.g. a msgqueue.persistent_queue to keep undelivered messages
+                over a restart. The default is an in memory queue.
+            max_queue
+                optional maximum number of undelivered messages
+            max_queue_bytes
+                optional maximum size in bytes of the payloads of the undelivered messages
+            overflow
+                what send_msg does when the queue is full
+                    'block'
+                        wait until a message is delivered (default)
+                        do not use this from the thread that calls the callback
+                    'reject'
+                        raise an exception
+                    'drop'
+                        queue the message and drop the message that would be sent last,
+                        with a priority queue that is the least urgent one
         """
         self.account = account
         self.receiver = receiver
@@ -78,8 +113,21 @@ class dc09_spt:
         self.main_poll = None
         self.backup_poll = None
         self.msg_nr = 0
-        self.queue = deque()
-        self.queuelock = threading.Lock()
+        if queue is None:
+            queue = msg_queue()
+        self.queue = queue
+        self.max_queue = max_queue
+        self.max_queue_bytes = max_queue_bytes
+        self.overflow = overflow
+        self.queued = len(queue)
+        self.queued_bytes = sum([mess.size() for mess in queue])
+        # continue after the newest message recovered from a persistent queue,
+        # the numbers of the waiting messages must not be used again
+        for mess in queue:
+            self.msg_nr = mess.msg_nr
+        self.dropped = 0
+        # condition tied to the queue, the sender waits on it for new messages
+        self.queuelock = threading.Condition()
         self.running = False
         self.poll = None
         self.send = None
@@ -89,11 +137,15 @@ class dc09_spt:
         self.routines_changed = 0
         self.poll_active = 0
         self.msg_callback = callback
+        self.bulk = None
+        self.race_delay = None
+        self.race_pool = None
 
     # ---------------------
     # configure transmission paths
     # ---------------------
-    def set_path(self, mb, pb, host, port, *, account=None, key=None, receiver=None, line=None, type=None):
+    def set_path(self, mb, pb, host, port, *, account=None, key=None, receiver=None, line=None, type=None,
+                 keepalive=False, window=1):
         """
         Define the transmission path 
         
@@ -118,6 +170,12 @@ class dc09_spt:
                 an optional integer to be used as line number in the block header
             ptype
                 TCP or UDP
+            keepalive
+                Optional, keep the TCP connection open between messages and polls.
+                Only use this when the receiver allows persistent connections.
+            window
+                Optional, number of queued messages sent over one TCP connection before waiting for the answers.
+                Only use more than 1 when the receiver supports it.
         note
             The routing of the back-up path to use the secondary network adapter has to be done
             in the operating system. The decision which adapter to use is made at the moment of routing.
@@ -126,6 +184,8 @@ class dc09_spt:
             acc = account
             if self.account is None:
                 self.account = account
+                if self.poll is not None:
+                    self.poll.recompile()
         else:
             acc = self.account
         if receiver is not None:
@@ -141,9 +201,16 @@ class dc09_spt:
         else:
             lin = self.line
         self.tpaths_lock.acquire()
-        self.tpaths[mb][pb]['path'] = TransPath(host, port, acc, key=key, receiver=rec, line=lin, type=type)
+        old = self.tpaths[mb][pb]['path']
+        self.tpaths[mb][pb]['path'] = TransPath(host, port, acc, key=key, receiver=rec, line=lin, type=type,
+                                                keepalive=keepalive, window=window)
         self.tpaths[mb][pb]['ok'] = 0
         self.tpaths_lock.release()
+        if old is not None:
+            old.close()
+        # messages left in a persistent queue by a previous run
+        if len(self.queue):
+            self.wake_sender()
 
     def del_path(self, mb, pb):
         """
@@ -156,8 +223,11 @@ class dc09_spt:
                 value 'primary' or 'secondary'
         """
         self.tpaths_lock.acquire()
+        old = self.tpaths[mb][pb]['path']
         self.tpaths[mb][pb]['path'] = None
         self.tpaths_lock.release()
+        if old is not None:
+            old.close()
 
     def set_callback(self, cb):
         """
@@ -176,6 +246,56 @@ class dc09_spt:
         """
         return self.msg_callback
 
+    def set_bulk(self, bulk):
+        """
+        Set a bulk encoder for encrypted paths
+
+        parameters
+            bulk
+                a msg.dc09_bulk object or None.
+                when set and more messages are queued the sender takes a number of batches
+                from the queue and lets the bulk encoder encrypt them in advance,
+                while the batches encoded before are transmitted.
+                one bulk encoder can be shared by many diallers
+        """
+        self.bulk = bulk
+
+    def set_race(self, delay=0.2, pool=None):
+        """
+        Race the paths when sending a message
+
+        The message is sent on the first path (a known good one if any), when it is not
+        acknowledged within -delay- seconds, or the transfer failed, it is also sent on the next path,
+        and so on. The first ACK counts, the losing transfers keep running in the background until
+        they finish, a path with such a transfer is tried last for the next message.
+        The receivers recognise the copies by the same message number.
+
+        parameters
+            delay
+                seconds before the message is also sent on the next path, None switches racing off
+            pool
+                optional executor running the transfers, to be shared by many diallers.
+                by default the dialler starts its own pool with a thread per path
+        """
+        if pool is not None:
+            self.race_pool = pool
+        self.race_delay = delay
+
+    def get_race_pool(self):
+        """
+        Returns the executor running the transfers of a race, see set_race
+        """
+        if self.race_pool is None:
+            self.tpaths_lock.acquire()
+            count = 0
+            for mb in self.tpaths:
+                for ps in self.tpaths[mb]:
+                    if self.tpaths[mb][ps]['path'] is not None:
+                        count += 1
+            self.tpaths_lock.release()
+            self.race_pool = ThreadPoolExecutor(max_workers=max(count, 1), thread_name_prefix='dc09_race')
+        return self.race_pool
+
     def start_poll(self, main, backup=None, retry_delay=5, ok_msg=None, fail_msg=None):
         """
         Start the automatic polling to the receiver(s)
@@ -194,19 +314,14 @@ class dc09_spt:
             self.poll = poll_thread(self.account, self.receiver, self.line, self.tpaths, self.tpaths_lock, retry_delay,
                                     self)
             self.poll.set_poll(main, backup, ok_msg, fail_msg)
-            self.poll_active = 1
-            self.poll.start()
+            self.start_poller()
         else:
             self.poll.set_poll(main, backup, ok_msg, fail_msg)
 
     def stop_poll(self):
         """Stop the automatic polling to the receiver(s)"""
         if self.poll is not None and self.poll.active() == 1:
-            self.poll.stop()
-            self.poll_active = -1
-            self.poll.join()
-            self.poll_active = 0
-            self.poll = None
+            self.stop_poller()
 
     def start_routine(self, rlist):
         if self.poll is None:
@@ -214,19 +329,31 @@ class dc09_spt:
                 self.poll = poll_thread(self.account, self.receiver, self.line, self.tpaths, self.tpaths_lock, 5.0,
                                         self)
                 self.poll.set_routines(rlist)
-                self.poll_active = 1
-                self.poll.start()
+                self.start_poller()
         else:
             self.poll.set_routines(rlist)
             if len(rlist) == 0:
                 if self.poll.active() == 2:
-                    self.poll.stop()
-                    self.poll_active = -1
-                    self.poll.join()
-                    self.poll_active = 0
-                    self.poll = None
+                    self.stop_poller()
+
+    def start_poller(self):
+        """
+        Start the polling and routine task
+        """
+        self.poll_active = 1
+        self.poll.start()
 
-    def send_msg(self, mtype, mparam):
+    def stop_poller(self):
+        """
+        Stop the polling and routine task and wait for it to finish
+        """
+        self.poll.stop()
+        self.poll_active = -1
+        self.poll.join()
+        self.poll_active = 0
+        self.poll = None
+
+    def send_msg(self, mtype, mparam, tclass=None, deadline=None, overflow=None):
         """
         Schedule a message for sending to the receiver
         
@@ -239,39 +366,266 @@ class dc09_spt:
             mparam
                 a map of key value pairs defining the message content.
                 for a description of possible values see the documentation of the payload
+            tclass
+                optional EN 50136-1 transmission class 'D1' to 'D4' setting the deadline of the message
+            deadline
+                optional maximum time in seconds to deliver the message, overrides tclass
+                the deadline is only used with a queue that handles priorities like msgqueue.priority_queue
+            overflow
+                optional overflow policy for this message when the queue is full,
+                overrides the policy set in the constructor
         
+        return value
+            the message number of the queued message,
+            None when it is dropped right away because the queue is full (overflow 'drop')
+
         note
             this method can be called from more than one thread
         """
-        msg = ''
-        dc09type = ''
+        dc09type, msg = self.encode_msg(self.account, mtype, mparam)
+        return self.queue_msg(dc09type, msg, tclass, deadline, overflow)
+
+    def compile_msg(self, mtype, mparam):
+        """
+        Compile a message that is sent more than once, like a routine or a poll state message
+
+        parameters
+            mtype
+                type of message, see send_msg
+            mparam
+                a map of key value pairs defining the message content, see send_msg
+        return value
+            msg_template to pass to send_template
+        """
+        return msg_template(self.account, mtype, mparam)
+
+    def send_template(self, template, fields={}, tclass=None, deadline=None, overflow=None):
+        """
+        Schedule a compiled message for sending to the receiver
+
+        parameters
+            template
+                msg_template returned by compile_msg
+            fields
+                optional map with the values that differ from the compiled message,
+                zone, user and time for SIA-DCS and zone, user and q for ADM-CID
+            tclass, deadline, overflow
+                see send_msg
+        return value
+            the message number of the queued message, None when it is dropped, see send_msg
+
+        note
+            this method can be called from more than one thread
+        """
+        if template.account != self.account:
+            # compiled before the account was set, compile it again with compile_msg to keep it
+            template = msg_template(self.account, template.mtype, template.mparam)
+        dc09type, msg = template.encode(fields)
+        return self.queue_msg(dc09type, msg, tclass, deadline, overflow)
+
+    def queue_msg(self, dc09type, msg, tclass=None, deadline=None, overflow=None):
+        """
+        Number and queue an encoded message, see send_msg
+        """
         self.counterlock.acquire()
         self.msg_nr += 1
-        self.counter += 1
-        self.counterlock.release()
         if self.msg_nr > 9999:
             self.msg_nr = 1
-        if mtype == 'SIA' or mtype == 'SIA-DCS':
-            msg = dc03_msg.dc03event(self.account, mparam)
-            dc09type = 'SIA-DCS'
-        if mtype == 'CID' or mtype == 'ADM-CID':
-            msg = dc05_msg.dc05event(self.account, mparam)
-            dc09type = 'ADM-CID'
-        extra = dc09_msg.dc09_extra(mparam)
-        if extra is not None:
-            msg = msg + extra
-        tup = self.msg_nr, dc09type, msg
-        logging.debug('Message queued nr %s type %s content "%s"', self.msg_nr, dc09type, msg)
+        msg_nr = self.msg_nr
+        self.counter += 1
+        self.counterlock.release()
+        mess = queued_msg(msg_nr, dc09type, msg, self.deadline(tclass, deadline))
+        logging.debug('Message queued nr %s type %s content "%s"', msg_nr, dc09type, msg)
+        self.queuelock.acquire()
+        try:
+            dropped = self.enqueue(mess, overflow)
+        finally:
+            self.queuelock.notify_all()
+            self.queuelock.release()
+        self.queue.commit()
+        self.wake_sender()
+        if mess in dropped:
+            return None
+        return msg_nr
+
+    def send_msgs(self, msgs, overflow=None):
+        """
+        Schedule a batch of messages for sending to the receiver
+
+        The messages are encoded first and then numbered and queued at once,
+        the sender is woken once for the whole batch.
+
+        parameters
+            msgs
+                iterable of (mtype, mparam) or (mtype, mparam, tclass) tuples, see send_msg
+            overflow
+                optional overflow policy for this batch, see send_msg.
+                when a message is rejected the rest of the batch is not queued
+        return value
+            list with the message number of each message,
+            None for the messages that are dropped, rejected or not queued after a rejected one
+
+        note
+            this method can be called from more than one thread
+        """
+        encoded = []
+        for mess in msgs:
+            due = self.deadline(mess[2] if len(mess) > 2 else None)
+            encoded.append(self.encode_msg(self.account, mess[0], mess[1]) + (due,))
+        if len(encoded) == 0:
+            return []
+        batch = []
+        self.counterlock.acquire()
+        for dc09type, msg, due in encoded:
+            self.msg_nr += 1
+            if self.msg_nr > 9999:
+                self.msg_nr = 1
+            batch.append(queued_msg(self.msg_nr, dc09type, msg, due))
+        self.counter += len(encoded)
+        self.counterlock.release()
+        self.queuelock.acquire()
+        done = 0
+        dropped = []
+        try:
+            for mess in batch:
+                dropped.extend(self.enqueue(mess, overflow))
+                done += 1
+        except Exception as e:
+            # the messages after a rejected one are not queued either
+            self.counterlock.acquire()
+            self.counter -= len(batch) - done - 1
+            self.counterlock.release()
+            logging.error('%s, %s messages of the batch not queued', e, len(batch) - done)
+        finally:
+            self.queuelock.notify_all()
+            self.queuelock.release()
+        self.queue.commit()
+        logging.debug('Messages queued nr %s to %s', batch[0].msg_nr, batch[done - 1].msg_nr if done else None)
+        self.wake_sender()
+        ret = []
+        for cnt, mess in enumerate(batch):
+            if cnt >= done or mess in dropped:
+                ret.append(None)
+            else:
+                ret.append(mess.msg_nr)
+        return ret
+
+    def enqueue(self, mess, overflow=None):
+        """
+        Put a message in the queue applying the size limits (call with queuelock held)
+
+        return value
+            list of the messages dropped to make room, this can be -mess- itself
+        """
+        dropped = []
+        if overflow is None:
+            overflow = self.overflow
+        if self.queue_full(mess):
+            if overflow == 'block':
+                while self.queue_full(mess):
+                    self.queuelock.wait()
+            elif overflow == 'reject':
+                self.counterlock.acquire()
+                self.counter -= 1
+                self.counterlock.release()
+                raise Exception('Send queue full, message nr {} rejected'.format(mess.msg_nr))
+        self.queue.push(mess)
+        self.queued += 1
+        self.queued_bytes += mess.size()
+        if overflow == 'drop':
+            while len(self.queue) and self.queue_full():
+                last = self.queue.drop_last()
+                self.queued -= 1
+                self.queued_bytes -= last.size()
+                self.dropped += 1
+                dropped.append(last)
+                logging.warning('Send queue full, message nr %s dropped', last.msg_nr)
+        return dropped
+
+    def queue_full(self, mess=None):
+        """
+        Returns true if the queue (including -mess-) exceeds max_queue or max_queue_bytes
+        """
+        count = self.queued
+        size = self.queued_bytes
+        if mess is not None:
+            count += 1
+            size += mess.size()
+        if self.max_queue is not None and count > self.max_queue:
+            return True
+        if self.max_queue_bytes is not None and size > self.max_queue_bytes:
+            return True
+        return False
+
+    def delivered(self, mess):
+        """
+        Release the queue space of a delivered message
+        """
         self.queuelock.acquire()
-        self.queue.append(tup)
+        self.queued -= 1
+        self.queued_bytes -= mess.size()
+        self.queuelock.notify_all()
         self.queuelock.release()
-        if self.send is not None and self.send.active() == 0:
-            self.send.join()
-            self.send = None
-        if self.send is None:
+        self.queue.ack(mess)
+
+    def wake_sender(self):
+        """
+        Make sure the queued messages get sent
+
+        The sender thread is started once and then waits for new messages in the queue
+        """
+        self.queuelock.acquire()
+        if self.send is None or not self.send.is_alive():
             self.send = event_thread(self.account, self.receiver, self.line, self.queue, self.queuelock, self.tpaths,
                                      self.tpaths_lock, self)
             self.send.start()
+        self.queuelock.release()
+
+    def stop_send(self):
+        """
+        Stop the sender thread, messages still queued are kept in the queue
+        """
+        if self.send is not None:
+            self.send.stop()
+            if self.send.is_alive():
+                self.send.join()
+            self.send = None
+
+    @staticmethod
+    def deadline(tclass=None, deadline=None):
+        """
+        Returns the monotonic time a message has to be delivered or None
+
+        parameters
+            tclass
+                EN 50136-1 transmission class 'D1' to 'D4'
+            deadline
+                maximum time in seconds to deliver the message, overrides tclass
+        """
+        if deadline is None and tclass is not None:
+            if tclass not in transmission_classes:
+                raise Exception('Unknown transmission class {}'.format(tclass))
+            deadline = transmission_classes[tclass]
+        if deadline is None:
+            return None
+        return time.monotonic() + deadline
+
+    @staticmethod
+    def encode_msg(account, mtype, mparam):
+        """
+        Build the DC09 type and payload of a message
+
+        parameters
+            account
+                default account number for the payload
+            mtype
+                type of message as accepted by send_msg
+            mparam
+                a map of key value pairs defining the message content.
+        return value
+            tuple of DC09 type and payload
+        """
+        return msg_template(account, mtype, mparam).encode()
 
     def state(self):
         """
@@ -283,6 +637,10 @@ class dc09_spt:
                     number of messages in send queue
                 msgs sent:
                     number of messages sent since start
+                msgs dropped:
+                    number of messages dropped because the queue was full
+                deadline breaches:
+                    number of messages delivered after their deadline (priority queue only)
                 main primary path ok:
                     true if main primary path is ok
                 main secondary path ok:
@@ -298,7 +656,8 @@ class dc09_spt:
                 send active:
                     true if at least one message is currently being sent
         """
-        ret = {'msgs queued': len(self.queue), 'msgs sent': self.counter}
+        ret = {'msgs queued': len(self.queue), 'msgs sent': self.counter,
+               'msgs dropped': self.dropped, 'deadline breaches': self.queue.breaches}
         for mb in ('main', 'back-up'):
             for ps in ('primary', 'secondary'):
                 if self.tpaths[mb][ps]['path'] is not None:
@@ -310,6 +669,37 @@ class dc09_spt:
             ret['send active'] = self.send.active()
         return ret
 
+    def metrics(self):
+        """
+        Returns a snapshot of the metrics of the dialler and its paths
+
+        returns
+            dictionary
+                msgs queued, msgs sent, msgs dropped, deadline breaches:
+                    see state
+                oldest age:
+                    seconds the oldest message in the queue is waiting, None if the queue is empty
+                paths:
+                    dictionary with per path ('main primary' etc.) the metrics.path_metrics snapshot,
+                    'ok' and 'health', see metrics.path_metrics and comm.health.path_health
+        """
+        self.queuelock.acquire()
+        oldest = self.queue.oldest()
+        queued = len(self.queue)
+        self.queuelock.release()
+        ret = {'msgs queued': queued, 'msgs sent': self.counter, 'msgs dropped': self.dropped,
+               'deadline breaches': self.queue.breaches,
+               'oldest age': None if oldest is None else time.monotonic() - oldest, 'paths': {}}
+        for mb in ('main', 'back-up'):
+            for ps in ('primary', 'secondary'):
+                path = self.tpaths[mb][ps]['path']
+                if path is not None:
+                    snap = path.metrics.snapshot()
+                    snap['ok'] = self.tpaths[mb][ps]['ok']
+                    snap['health'] = path.health.snapshot()
+                    ret['paths'][mb + ' ' + ps] = snap
+        return ret
+
     def isConnected(self):
         """Returns true if there is a connection"""
         antw = False
@@ -324,7 +714,7 @@ class dc09_spt:
         """Returns the number of messages in the send queue"""
         return len(self.queue)
 
-    def transfer_msg(self, msg_nr, mtype, message, path):
+    def transfer_msg(self, msg_nr, mtype, message, path, block=None):
         """
         Transfer a message and decode the answer
         if needed repeat with correct time offset
@@ -334,38 +724,199 @@ class dc09_spt:
                 the message to transfer
             path
                 the path to transfer the message over
+            block
+                optional block already encoded for this path
         return value
             true if message is transferred correct
         """
         ret = False
-        dc09 = dc09_msg(path.get_account(), path.get_key(), path.get_receiver(), path.get_line(), path.get_offset())
-        mesg = str.encode(dc09.dc09block(msg_nr, mtype, message))
+        hook = trace.hook
+        if hook is not None:
+            begin = time.monotonic()
+        dc09 = path.get_encoder()
+        if block is not None:
+            mesg = block
+        else:
+            mesg = dc09.block(msg_nr, mtype, message)
+        path.health.begin()
+        rtt = None
         conn = path.connect()
-        if conn is not None:
-            antw = conn.sendAndReceive(mesg, 512)
-            if antw is not None:
-                try:
-                    res = dc09.dc09answer(msg_nr, antw.decode())
-                    if res is not None:
-                        path.set_offset(res[1])
-                        if res[0] == 'NAK':
-                            dc09.set_offset(res[1])
-                            mesg = str.encode(dc09.dc09block(msg_nr, mtype, message))
-                            conn.send(mesg)
-                            antw = conn.receive(1024)
-                            if antw is not None:
-                                res = dc09.dc09answer(self.msg_nr, antw)
+        try:
+            if conn is not None:
+                start = time.monotonic()
+                antw = conn.sendAndReceive(mesg, 512)
+                if antw is None:
+                    path.metrics.count('timeouts')
+                else:
+                    path.metrics.observe_rtt(time.monotonic() - start)
+                    try:
+                        res = dc09.dc09answer(msg_nr, antw)
+                        if res is not None:
+                            rtt = time.monotonic() - start
+                            path.metrics.answer(res[0])
+                            if res[1] is not None:
+                                path.set_offset(res[1])
+                            if res[0] == 'NAK':
+                                dc09 = path.get_encoder()
+                                mesg = dc09.block(msg_nr, mtype, message)
+                                path.metrics.count('retransmits')
+                                start = time.monotonic()
+                                conn.send(mesg)
+                                antw = conn.receive(1024)
+                                if hook is not None:
+                                    trace.call(hook, 'resend', path, start, time.monotonic())
+                                if antw is None:
+                                    path.metrics.count('timeouts')
+                                else:
+                                    path.metrics.observe_rtt(time.monotonic() - start)
+                                    res = dc09.dc09answer(msg_nr, antw)
+                                    path.metrics.answer(res[0])
+                            if res[0] == 'ACK':
+                                ret = True
+                    except Exception as e:
+                        logging.error("Answer decode error %s", repr(e))
+                logging.debug('Sent message nr %s mtype %s content %s to %s port %s answer %s', msg_nr, mtype, message,
+                              path.host, path.port, antw)
+        finally:
+            # a kept connection is reserved until it is released
+            path.release(conn)
+        if rtt is None:
+            path.health.failure()
+        else:
+            path.health.success(rtt)
+        if hook is not None:
+            trace.call(hook, 'transfer', path, begin, time.monotonic())
+        return ret
+
+    def transfer_window(self, messages, path, blocks=None):
+        """
+        Transfer a number of messages over one connection without waiting for each answer
+        the answers are matched to the messages by message number
+
+        messages that are not acknowledged (NAK, DUH, timeout or a lost connection)
+        are retransmitted one by one with transfer_msg
+
+        parameters
+            messages
+                list of queued_msg records
+            path
+                the path to transfer the messages over
+            blocks
+                optional list with the blocks of the messages already encoded for this path
+        return value
+            list with for each message true if it is transferred correct
+        """
+        dc09 = path.get_encoder()
+        pending = [mess.msg_nr for mess in messages]
+        acked = set()
+        if blocks is None:
+            blocks = [dc09.block(mess.msg_nr, mess.mtype, mess.message) for mess in messages]
+        path.health.begin()
+        rtt = None
+        conn = path.connect()
+        try:
+            if conn is not None:
+                start = time.monotonic()
+                conn.send(b''.join(blocks))
+                buf = b''
+                while len(pending):
+                    antw = conn.receive(1024)
+                    if antw is None:
+                        path.metrics.count('timeouts')
+                        # answers still underway must not be read by the next transfer
+                        conn.disconnect()
+                        break
+                    buf += antw
+                    while len(pending) and b'\r' in buf:
+                        frame, buf = buf.split(b'\r', 1)
+                        if b'\n' not in frame:
+                            continue
+                        frame = frame[frame.find(b'\n'):] + b'\r'
+                        try:
+                            res = dc09.dc09answer_nr(frame)
+                        except Exception as e:
+                            logging.error("Answer decode error %s", repr(e))
+                            continue
+                        if res[2] in pending:
+                            mnr = res[2]
+                        elif res[0] == 'NAK' and res[2] == 0:
+                            # a NAK carries no message number, it belongs to the oldest block
+                            mnr = pending[0]
+                        else:
+                            # like a late answer to an earlier window, never count it for another message
+                            logging.warning('Answer %s for unknown message nr %s from %s port %s ignored', res[0],
+                                            res[2], path.host, path.port)
+                            continue
+                        pending.remove(mnr)
+                        if rtt is None:
+                            rtt = time.monotonic() - start
+                        path.metrics.observe_rtt(time.monotonic() - start)
+                        path.metrics.answer(res[0])
+                        if res[1] is not None:
+                            path.set_offset(res[1])
                         if res[0] == 'ACK':
-                            ret = True
-                except Exception as e:
-                    logging.error("Answer decode error %s", repr(e))
-            logging.debug('Sent message nr %s mtype %s content %s to %s port %s answer %s', msg_nr, mtype, message,
-                          path.host, path.port, antw)
-        if conn is not None:
-            conn.disconnect()
+                            acked.add(mnr)
+                        logging.debug('Sent message nr %s in window to %s port %s answer %s', mnr, path.host, path.port,
+                                      frame)
+        finally:
+            # a kept connection is reserved until it is released
+            path.release(conn)
+        if rtt is None:
+            path.health.failure()
+        else:
+            path.health.success(rtt)
+        ret = []
+        for mess in messages:
+            if mess.msg_nr in acked:
+                ret.append(True)
+            else:
+                ret.append(self.transfer_msg(mess.msg_nr, mess.mtype, mess.message, path))
         return ret
 
 
+class msg_template:
+    """
+    Compiled message of the dialler
+
+    Holds the DC03 or DC05 template of the payload together with the DC09 type,
+    see dc09_spt.compile_msg and dc09_spt.send_template
+    """
+    def __init__(self, account, mtype, mparam):
+        """
+        parameters
+            account
+                default account number for the payload
+            mtype
+                type of message as accepted by dc09_spt.send_msg
+            mparam
+                a map of key value pairs defining the message content.
+        """
+        self.account = account
+        self.mtype = mtype
+        self.mparam = mparam
+        self.payload = None
+        self.dc09type = ''
+        if mtype == 'SIA' or mtype == 'SIA-DCS':
+            self.payload = dc03_template(account, mparam)
+            self.dc09type = 'SIA-DCS'
+        if mtype == 'CID' or mtype == 'ADM-CID':
+            self.payload = dc05_template(account, mparam)
+            self.dc09type = 'ADM-CID'
+        extra = dc09_msg.dc09_extra(mparam)
+        if extra is None:
+            extra = ''
+        self.extra = extra
+
+    def encode(self, fields={}):
+        """
+        Returns the tuple of DC09 type and payload,
+        fields optionally overrides the variable values of the message
+        """
+        if self.payload is None:
+            return self.dc09type, self.extra
+        return self.dc09type, self.payload.payload(fields) + self.extra
+
+
 class poll_thread(threading.Thread):
     """
     Handle the polling tasks of SPT (Secured Premises Transciever)
@@ -403,6 +954,7 @@ class poll_thread(threading.Thread):
         self.main_poll = None
         self.backup_poll = None
         self.routines = []
+        self.templates = []
         self.ok_msg = None
         self.fail_msg = None
         self.main_poll_next = 0
@@ -414,6 +966,8 @@ class poll_thread(threading.Thread):
         self.running = False
         self.backup_ok = False
         self.main_ok = False
+        self.first = True
+        self.wakeup = threading.Condition()
 
     def set_poll(self, main, backup, ok_msg, fail_msg):
         """
@@ -431,8 +985,44 @@ class poll_thread(threading.Thread):
         """
         self.main_poll = main
         self.backup_poll = backup
-        self.ok_msg = ok_msg
-        self.fail_msg = fail_msg
+        self.ok_msg = self.state_template(ok_msg)
+        self.fail_msg = self.state_template(fail_msg)
+        self.wake()
+
+    def state_template(self, msg):
+        """
+        Compile a poll state message
+
+        return value
+            None when no message is sent, else tuple of the template and
+            a flag telling that the CID qualifier follows the state of the path
+        """
+        if msg is None:
+            return None
+        mtype = None
+        qualify = False
+        if 'type' in msg:
+            mtype = msg['type']
+        elif 'code' in msg:
+            code = msg['code']
+            if len(code) == 3:
+                mtype = 'ADM-CID'
+                qualify = True
+            elif len(code) == 2:
+                mtype = 'SIA-DCS'
+        if mtype is None:
+            return None
+        return self.parent.compile_msg(mtype, msg), qualify
+
+    def recompile(self):
+        """
+        Compile the routine and poll state messages again, called when the account of the dialler is set
+        """
+        self.templates = [self.parent.compile_msg(template.mtype, template.mparam) for template in self.templates]
+        if self.ok_msg is not None:
+            self.ok_msg = self.parent.compile_msg(self.ok_msg[0].mtype, self.ok_msg[0].mparam), self.ok_msg[1]
+        if self.fail_msg is not None:
+            self.fail_msg = self.parent.compile_msg(self.fail_msg[0].mtype, self.fail_msg[0].mparam), self.fail_msg[1]
 
     def set_routines(self, routines):
         """
@@ -446,10 +1036,15 @@ class poll_thread(threading.Thread):
                     start
                         delay in seconds to first message
 
+        note
+            the start moment is calculated on the wall clock,
+            the schedule itself runs on the monotonic clock
         """
-        self.routines = routines
         now = time.time()
-        for routine in self.routines:
+        mono = time.monotonic()
+        nexts = []
+        templates = []
+        for routine in routines:
             if 'interval' in routine:
                 interval = routine['interval']
             else:
@@ -460,127 +1055,195 @@ class poll_thread(threading.Thread):
                 start = now
             while start < now:
                 start += interval
-            self.routine_nexts.append(start)
+            nexts.append(mono + start - now)
+            if 'type' in routine:
+                mtype = routine['type']
+            elif 'code' in routine and len(routine['code']) == 3:
+                mtype = 'ADM-CID'
+            else:
+                mtype = 'SIA-DCS'
+            templates.append(self.parent.compile_msg(mtype, routine))
+        self.routine_nexts = nexts
+        self.templates = templates
+        self.routines = routines
+        self.wake()
 
     # -----------------
     # send polls while needed (call in thread)
     # at first run check all paths
     # ------------------
     def run(self):
-        first = True
+        self.preconnect()
         while self.main_poll or self.backup_poll or len(self.routines) > 0:
-            # on first poll check validity of all paths
-            self.running = True
-            now = time.time()
-            # ---------------
-            # main poll 
-            # ---------------
-            main_polled = False
-            back_up_for_main = False
-            backup_polled = False
-            if self.main_poll is not None and self.main_poll_next <= now:
-                for ps in ('primary', 'secondary'):
-                    if first or not main_polled:
-                        if self.tpaths['main'][ps]['path'] is not None:
-                            if self.parent.transfer_msg(0, "NULL", "]", self.tpaths['main'][ps]['path']):
-                                main_polled = True
-                                self.counter += 1
-                                if self.tpaths['main'][ps]['ok'] != 1:
-                                    self.tpaths_lock.acquire()
-                                    self.tpaths['main'][ps]['ok'] = 1
-                                    self.tpaths_lock.release()
-                                    self.msg(self.ok_msg, 1, 1)
-                            else:
-                                if self.tpaths['main'][ps]['ok'] != 0:
-                                    self.tpaths_lock.acquire()
-                                    self.tpaths['main'][ps]['ok'] = 0
-                                    self.tpaths_lock.release()
-                                    self.msg(self.fail_msg, 1, 0)
-                if not main_polled:
-                    self.main_poll_ok = False
-                    self.main_ok = False
-                    back_up_for_main = True
-                else:
-                    self.main_poll_ok = True
-                    self.main_ok = True
-                    self.main_poll_next = now + self.main_poll
-            # ---------------
-            # backup poll 
-            # also triggered when main poll failed 
-            # ---------------
-            if self.backup_poll is not None and (self.main_poll_next <= now or self.backup_poll_next <= now or first):
-                for ps in ('primary', 'secondary'):
-                    if first or backup_polled == 0:
-                        if self.tpaths['back-up'][ps]['path'] is not None:
-                            if self.parent.transfer_msg(0, "NULL", "]", self.tpaths['back-up'][ps]['path']):
-                                backup_polled = 1
-                                self.counter += 1
-                                if self.tpaths['back-up'][ps]['ok'] != 1:
-                                    self.tpaths_lock.acquire()
-                                    self.tpaths['back-up'][ps]['ok'] = 1
-                                    self.tpaths_lock.release()
-                                    self.msg(self.ok_msg, 2, 1)
-                            else:
-                                if self.tpaths['back-up'][ps]['ok'] != 0:
-                                    self.tpaths_lock.acquire()
-                                    self.tpaths['back-up'][ps]['ok'] = 0
-                                    self.tpaths_lock.release()
-                                    self.msg(self.fail_msg, 2, 0)
-                if not backup_polled:
-                    self.backup_poll_ok = False
-                    self.backup_ok = False
-                else:
-                    self.backup_poll_ok = True
-                    self.backup_ok = True
-                    self.backup_poll_next = now + self.backup_poll
-            if self.main_poll is not None and main_polled and (self.backup_poll is None or backup_polled):
-                first = False
-            # -----------------
-            # schedule retry of main
-            # -----------------
-            if main_polled or (back_up_for_main and backup_polled):
-                if self.main_poll is not None and self.main_poll_next < now:
-                    self.main_poll_next = now + self.main_poll
-            # ------------------------------
-            # handle routine messages
-            # -----------------------------
-            if len(self.routines) > 0:
-                self.do_routines()
+            self.poll_once()
             # -------------------------
-            # decide how long to sleep
+            # sleep until the next poll, retry or routine is due
+            # or until the settings are changed
             # -------------------------
-            time.sleep(self.poll_retry_delay)
+            self.wakeup.acquire()
+            delay = self.next_due() - time.monotonic()
+            if delay > 0:
+                self.wakeup.wait(delay)
+            self.wakeup.release()
+
+    def wake(self):
+        """
+        Wake the thread to reschedule after a change of settings
+        """
+        self.wakeup.acquire()
+        self.wakeup.notify()
+        self.wakeup.release()
+
+    def next_due(self):
+        """
+        Returns the monotonic time the next poll, poll retry or routine is due
+        """
+        now = time.monotonic()
+        retry = now + self.poll_retry_delay
+        due = []
+        if self.main_poll is not None:
+            due.append(self.main_poll_next if self.main_poll_next > now else retry)
+        if self.backup_poll is not None:
+            if self.first:
+                due.append(retry)
+            due.append(self.backup_poll_next if self.backup_poll_next > now else retry)
+        due.extend(self.routine_nexts[:len(self.routines)])
+        if len(due) == 0:
+            return retry
+        return min(due)
+
+    def preconnect(self):
+        """
+        open the kept alive connections before the first poll
+        """
+        for mb in ('main', 'back-up'):
+            for ps in ('primary', 'secondary'):
+                if self.tpaths[mb][ps]['path'] is not None:
+                    self.tpaths[mb][ps]['path'].preconnect()
+
+    def poll_once(self):
+        """
+        Do one round of polls and routines that are due
+        on the first round the validity of all paths is checked
+        """
+        self.running = True
+        now = time.monotonic()
+        # ---------------
+        # main poll 
+        # ---------------
+        main_polled = False
+        back_up_for_main = False
+        backup_polled = False
+        if self.main_poll is not None and self.main_poll_next <= now:
+            for ps in self.order('main'):
+                if self.first or not main_polled:
+                    if self.tpaths['main'][ps]['path'] is not None:
+                        if self.poll_path(self.tpaths['main'][ps]['path']):
+                            main_polled = True
+                            self.counter += 1
+                            if self.tpaths['main'][ps]['ok'] != 1:
+                                self.tpaths_lock.acquire()
+                                self.tpaths['main'][ps]['ok'] = 1
+                                self.tpaths_lock.release()
+                                self.msg(self.ok_msg, 1, 1)
+                        else:
+                            if self.tpaths['main'][ps]['ok'] != 0:
+                                self.tpaths_lock.acquire()
+                                self.tpaths['main'][ps]['ok'] = 0
+                                self.tpaths_lock.release()
+                                self.msg(self.fail_msg, 1, 0)
+            if not main_polled:
+                self.main_poll_ok = False
+                self.main_ok = False
+                back_up_for_main = True
+            else:
+                self.main_poll_ok = True
+                self.main_ok = True
+                self.main_poll_next = now + self.main_poll
+        # ---------------
+        # backup poll 
+        # also triggered when main poll failed 
+        # ---------------
+        if self.backup_poll is not None and (self.main_poll_next <= now or self.backup_poll_next <= now or self.first):
+            for ps in self.order('back-up'):
+                if self.first or backup_polled == 0:
+                    if self.tpaths['back-up'][ps]['path'] is not None:
+                        if self.poll_path(self.tpaths['back-up'][ps]['path']):
+                            backup_polled = 1
+                            self.counter += 1
+                            if self.tpaths['back-up'][ps]['ok'] != 1:
+                                self.tpaths_lock.acquire()
+                                self.tpaths['back-up'][ps]['ok'] = 1
+                                self.tpaths_lock.release()
+                                self.msg(self.ok_msg, 2, 1)
+                        else:
+                            if self.tpaths['back-up'][ps]['ok'] != 0:
+                                self.tpaths_lock.acquire()
+                                self.tpaths['back-up'][ps]['ok'] = 0
+                                self.tpaths_lock.release()
+                                self.msg(self.fail_msg, 2, 0)
+            if not backup_polled:
+                self.backup_poll_ok = False
+                self.backup_ok = False
+            else:
+                self.backup_poll_ok = True
+                self.backup_ok = True
+                self.backup_poll_next = now + self.backup_poll
+        if self.main_poll is not None and main_polled and (self.backup_poll is None or backup_polled):
+            self.first = False
+        # -----------------
+        # schedule retry of main
+        # -----------------
+        if main_polled or (back_up_for_main and backup_polled):
+            if self.main_poll is not None and self.main_poll_next < now:
+                self.main_poll_next = now + self.main_poll
+        # ------------------------------
+        # handle routine messages
+        # -----------------------------
+        if len(self.routines) > 0:
+            self.do_routines()
+
+    def order(self, mb):
+        """
+        Returns primary and secondary ordered by the health of their paths, healthiest first
+        """
+        ranks = []
+        for ps in ('primary', 'secondary'):
+            path = self.tpaths[mb][ps]['path']
+            ranks.append((path.health.rank() if path is not None else (True, True, float('inf')), ps))
+        ranks.sort()
+        return [ps for rank, ps in ranks]
+
+    def poll_path(self, path):
+        """
+        Poll one path, a path with an open circuit breaker counts as failed without a transfer
+        except on the first round
+        """
+        if not self.first and not path.health.available():
+            return False
+        return self.parent.transfer_msg(0, "NULL", "]", path)
 
     def msg(self, msg, ps, ok):
         """
         Send a message on poll state change
         """
         if msg is not None:
-            nmsg = msg
-            nmsg['zone'] = ps
-            mtype = None
-            if 'type' in msg:
-                mtype = msg['type']
-            else:
-                if 'code' in msg:
-                    code = msg['code']
-                    if len(code) == 3:
-                        mtype = 'ADM-CID'
-                        if ok:
-                            nmsg['q'] = 1
-                        else:
-                            nmsg['q'] = 3
-                    elif len(code) == 2:
-                        mtype = 'SIA-DCS'
-            if mtype is not None:
-                self.parent.send_msg(mtype, msg)
-                if self.parent.get_callback() is not None:
-                    self.parent.get_callback()(mtype, msg)
+            template, qualify = msg
+            fields = {'zone': ps}
+            if qualify:
+                if ok:
+                    fields['q'] = 1
+                else:
+                    fields['q'] = 3
+            self.parent.send_template(template, fields)
+            if self.parent.get_callback() is not None:
+                self.parent.get_callback()(template.mtype, dict(template.mparam, **fields))
 
     def stop(self):
         self.main_poll = None
         self.backup_poll = None
         self.routines = []
+        self.wake()
 
     def active(self):
         ret = 0
@@ -594,27 +1257,19 @@ class poll_thread(threading.Thread):
         return self.counter
 
     def do_routines(self):
-        now = time.time()
+        now = time.monotonic()
         cnt = 0
-        for n, r in zip(self.routine_nexts, self.routines):
+        for n, r, template in zip(self.routine_nexts, self.routines, self.templates):
             if n <= now:
-                if 'type' in r:
-                    mtype = r['type']
-                else:
-                    if 'code' in r:
-                        code = r['code']
-                        if len(code) == 3:
-                            mtype = 'ADM-CID'
-                        else:
-                            mtype = 'SIA-DCS'
-                    else:
-                        mtype = 'SIA-DCS'
-                self.parent.send_msg(mtype, r)
+                self.parent.send_template(template)
                 if 'interval' in r:
                     interval = r['interval']
                 else:
                     interval = 86400
-                self.routine_nexts[cnt] = now + interval
+                n += interval
+                if n <= now:
+                    n = now + interval
+                self.routine_nexts[cnt] = n
             cnt += 1
 
 
@@ -637,8 +1292,18 @@ class event_thread(threading.Thread):
                 an optional integer to be used as receiver number in the block header
             line
                 an optional integer to be used as line number in the block header
+            queue
+                the message queue
+            queuelock
+                threading.Condition governing the queue, notified when a message is queued
+            tpaths
+                dictionary defining the transmission paths to use
+            tpaths_lock
+                reference to the lock governing the paths dictionary
+            parent
+                reference to parent class for the transfer of the messages
         """
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, name='dc09 sender', daemon=True)
         self.account = account
         self.receiver = receiver
         self.line = line
@@ -649,68 +1314,272 @@ class event_thread(threading.Thread):
         self.send_retry_delay = 0.5
         self.parent = parent
         self.running = False
+        self.stopped = False
+        # per path the transfer that lost a race and is still running
+        self.losers = {}
 
     # -----------------
     # send events while needed (call in thread)
-    # checks message queue and retries
+    # waits for new messages in the queue, sends them back to back
+    # and retries after send_retry_delay when no path accepted a message
+    # the thread ends when stopped, at exit it is stopped once the queue is empty (see drain)
     # ------------------
     def run(self):
-        while len(self.queue) > 0:
-            # --------------------
-            # first handle queue
-            # --------------------
+        _senders.add(self)
+        self.queuelock.acquire()
+        delivered = False
+        while not self.stopped:
+            if len(self.queue) == 0:
+                self.running = False
+                if delivered:
+                    # store the acknowledgements of a persistent queue
+                    delivered = False
+                    self.queuelock.release()
+                    try:
+                        self.queue.commit()
+                    except Exception as e:
+                        logging.error('Send queue commit exception %s', repr(e))
+                    self.queuelock.acquire()
+                    continue
+                # wake a drain waiting for the empty queue
+                self.queuelock.notify_all()
+                self.queuelock.wait()
+                continue
             self.running = True
-            sent = 1
-            while sent and len(self.queue):
-                sent = self.send()
-                #            now = time.time()
-                # -------------------------
-                # decide how long to sleep
-                # -------------------------
-                #            if self.main_poll_next < self.backup_poll_next:
-                #                next = self.main_poll_next
-                #            else:
-                #                next = self.backup_poll_next
-                #            if next > now:
-                if len(self.queue):
-                    time.sleep(self.send_retry_delay)
+            self.queuelock.release()
+            sent = self.send()
+            self.queuelock.acquire()
+            delivered = delivered or sent
+            if not sent:
+                retry = time.monotonic() + self.send_retry_delay
+                delay = self.send_retry_delay
+                while delay > 0 and not self.stopped:
+                    self.queuelock.wait(delay)
+                    delay = retry - time.monotonic()
         self.running = False
+        self.queuelock.release()
+
+    def stop(self):
+        """
+        Let the thread end after the message currently being sent
+        """
+        self.queuelock.acquire()
+        self.stopped = True
+        self.queuelock.notify_all()
+        self.queuelock.release()
+
+    def drain(self):
+        """
+        Wait until the queued messages are sent and end the thread
+
+        Called when the program exits, the thread is a daemon so an idle sender does not delay the exit
+        but the program still waits for the delivery of the queued messages.
+        """
+        if not self.is_alive():
+            return
+        self.queuelock.acquire()
+        while self.is_alive() and not self.stopped and (len(self.queue) or self.running):
+            self.queuelock.wait(self.send_retry_delay)
+        self.stopped = True
+        self.queuelock.notify_all()
+        self.queuelock.release()
+        self.join()
 
     def send(self):
+        if len(self.queue) > 1 and self.send_window():
+            return True
         self.queuelock.acquire()
         if len(self.queue) == 0:
             self.queuelock.release()
             return
         mess = self.queue.popleft()
         self.queuelock.release()
+        if self.parent.race_delay is not None:
+            msg_sent = self.send_race(mess, self.parent.race_delay)
+        else:
+            msg_sent = self.send_serial(mess)
+        if not msg_sent:
+            self.queuelock.acquire()
+            self.queue.appendleft(mess)
+            self.queuelock.release()
+        else:
+            self.parent.delivered(mess)
+        return msg_sent
+
+    def send_serial(self, mess):
+        """
+        Send a message on the paths one after the other until it is acknowledged
+        """
         msg_sent = False
         # ---------------------------
-        # first try known good paths
+        # known good paths first, then the other paths
+        # skip the paths with an open breaker
         # --------------------------
+        for mb, ps, path in self.paths():
+            if not msg_sent:
+                if self.parent.transfer_msg(mess.msg_nr, mess.mtype, mess.message, path):
+                    msg_sent = True
+                    if not self.tpaths[mb][ps]['ok']:
+                        self.tpaths_lock.acquire()
+                        self.tpaths[mb][ps]['ok'] = 1
+                        self.tpaths_lock.release()
+        return msg_sent
+
+    def paths(self):
+        """
+        Returns a list of (main/back-up, primary/secondary, path) of the paths to try for a message
+        the known good paths come first, then the healthiest paths, otherwise the configured order is kept.
+        paths with an open circuit breaker are left out, see comm.health.path_health
+        """
+        paths = []
         for mb in ('main', 'back-up'):
             for ps in ('primary', 'secondary'):
-                if msg_sent == 0 and self.tpaths[mb][ps]['path'] is not None:
-                    if self.tpaths[mb][ps]['ok']:
-                        if self.parent.transfer_msg(mess[0], mess[1], mess[2], self.tpaths[mb][ps]['path']):
-                            msg_sent = True
-        # ---------------------------
-        # then try all available paths
-        # --------------------------
-        if not msg_sent:
-            for mb in ('main', 'back-up'):
-                for ps in ('primary', 'secondary'):
-                    if not msg_sent and self.tpaths[mb][ps]['path'] is not None:
-                        if self.parent.transfer_msg(mess[0], mess[1], mess[2], self.tpaths[mb][ps]['path']):
-                            msg_sent = True
-                            self.tpaths_lock.acquire()
-                            self.tpaths[mb][ps]['ok'] = 1
-                            self.tpaths_lock.release()
-        if not msg_sent:
-            self.queuelock.acquire()
-            tup = mess[0], mess[1], mess[2]
-            self.queue.appendleft(tup)
-            self.queuelock.release()
-        return msg_sent
+                path = self.tpaths[mb][ps]['path']
+                if path is not None and path.health.available():
+                    paths.append((not self.tpaths[mb][ps]['ok'], path.health.rank(), len(paths), mb, ps, path))
+        paths.sort()
+        return [entry[3:] for entry in paths]
+
+    def send_race(self, mess, delay):
+        """
+        Send a message on the paths in parallel, a next path is started after -delay- seconds
+        or when a transfer fails, the first acknowledge wins.
+        the transfers that lost keep running until they finish (see losers),
+        when no path acknowledged all transfers are finished on return
+        """
+        self.losers = {path: future for path, future in self.losers.items() if not future.done()}
+        paths = self.paths()
+        # a path still busy with a lost transfer would make this message wait for it
+        busy = [entry for entry in paths if entry[2] in self.losers]
+        paths = [entry for entry in paths if entry[2] not in self.losers] + busy
+        running = {}
+        winner = None
+        start_next = 0
+        while winner is None and (len(paths) or len(running)):
+            if len(paths) and (len(running) == 0 or time.monotonic() >= start_next):
+                mb, ps, path = paths.pop(0)
+                future = self.parent.get_race_pool().submit(self.parent.transfer_msg, mess.msg_nr, mess.mtype,
+                                                            mess.message, path)
+                running[future] = (mb, ps, path)
+                start_next = time.monotonic() + delay
+            timeout = None
+            if len(paths):
+                timeout = max(0, start_next - time.monotonic())
+            done = wait(list(running), timeout, FIRST_COMPLETED)[0]
+            for future in done:
+                mb, ps, path = running.pop(future)
+                try:
+                    ok = future.result()
+                except Exception as e:
+                    logging.error('Transfer exception %s', repr(e))
+                    ok = False
+                if ok and winner is None:
+                    winner = (mb, ps)
+                elif not ok:
+                    # start the next path at once
+                    start_next = 0
+        for future, (mb, ps, path) in running.items():
+            # a transfer that did not start yet is not needed anymore
+            if not future.cancel():
+                self.losers[path] = future
+        if winner is not None:
+            self.tpaths_lock.acquire()
+            self.tpaths[winner[0]][winner[1]]['ok'] = 1
+            self.tpaths_lock.release()
+            logging.debug('Message nr %s delivered first over %s %s path', mess.msg_nr, winner[0], winner[1])
+        return winner is not None
+
+    def send_window(self):
+        """
+        Send a number of queued messages at once over the first known good path with a window
+        the messages that could not be delivered are put back in front of the queue
+
+        return value
+            true if at least one message is sent
+        """
+        path = None
+        for mb, ps, good in self.paths():
+            if path is None and self.tpaths[mb][ps]['ok']:
+                path = good
+        if path is not None and self.parent.bulk is not None and path.get_key() is not None:
+            return self.send_bulk(path, self.parent.bulk)
+        if path is None or path.get_window() < 2:
+            return False
+        batch = []
+        self.queuelock.acquire()
+        while len(self.queue) and len(batch) < path.get_window():
+            batch.append(self.queue.popleft())
+        self.queuelock.release()
+        res = self.parent.transfer_window(batch, path)
+        self.queuelock.acquire()
+        for mess, ok in reversed(list(zip(batch, res))):
+            if not ok:
+                self.queue.appendleft(mess)
+        self.queuelock.release()
+        for mess, ok in zip(batch, res):
+            if ok:
+                self.parent.delivered(mess)
+        return any(res)
+
+    def send_bulk(self, path, bulk):
+        """
+        Send a number of batches of queued messages over a path, encoded in advance by a bulk encoder
+        a batch is transmitted while the next batches are still being encoded.
+        blocks that waited longer than bulk.max_age are encoded again with a current timestamp.
+        after a failure the rest of the messages is put back in front of the queue
+
+        return value
+            true if at least one message is sent
+        """
+        window = path.get_window()
+        size = window if window > 1 else bulk.batch
+        batches = []
+        self.queuelock.acquire()
+        while len(self.queue) and len(batches) < bulk.ahead:
+            batch = []
+            while len(self.queue) and len(batch) < size:
+                batch.append(self.queue.popleft())
+            batches.append(batch)
+        self.queuelock.release()
+        futures = [bulk.encode(path, [(mess.msg_nr, mess.mtype, mess.payload) for mess in batch]) for batch in batches]
+        stale = time.monotonic() + bulk.max_age
+        sent = []
+        unsent = []
+        for batch, future in zip(batches, futures):
+            if len(unsent):
+                future.cancel()
+                unsent += batch
+                continue
+            try:
+                blocks = future.result()
+            except Exception as e:
+                logging.error('Bulk encoding exception %s', repr(e))
+                blocks = [None] * len(batch)
+            if window > 1:
+                if time.monotonic() >= stale:
+                    blocks = [None]
+                res = self.parent.transfer_window(batch, path, blocks if blocks[0] is not None else None)
+            else:
+                res = []
+                for mess, block in zip(batch, blocks):
+                    if len(res) and not res[-1]:
+                        res.append(False)
+                    else:
+                        if time.monotonic() >= stale:
+                            block = None
+                        res.append(self.parent.transfer_msg(mess.msg_nr, mess.mtype, mess.message, path, block))
+            for mess, ok in zip(batch, res):
+                if ok:
+                    sent.append(mess)
+                else:
+                    unsent.append(mess)
+        self.queuelock.acquire()
+        for mess in reversed(unsent):
+            self.queue.appendleft(mess)
+        self.queuelock.release()
+        for mess in sent:
+            self.parent.delivered(mess)
+        return len(sent) > 0
 
     def active(self):
         return self.running
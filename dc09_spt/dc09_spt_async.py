@@ -0,0 +1,581 @@
+# ----------------------------
+# Dialler class for asyncio
+# (c 2018 van Ovost Automatisering b.v.
+# Author : Jacq. van Ovost
+# ----------------------------
+from dc09_spt.msg.dc09_msg import *
+from dc09_spt.dc09_spt import dc09_spt, msg_template
+import time
+import asyncio
+from collections import deque
+import logging
+from dc09_spt.comm.transpath import TransPath
+from dc09_spt.comm.transpathaio import TransPathAIO, _running_loop
+from dc09_spt import trace
+
+
+def new_event_loop():
+    """
+    Create an event loop, using uvloop when it is installed
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.new_event_loop()
+    return uvloop.new_event_loop()
+
+
+class dc09_spt_async:
+    """
+    Handle the basic tasks of SPT (Secured Premises Transciever) in an asyncio event loop
+
+    This is the asyncio counterpart of dc09_spt with the same methods and behaviour.
+    Instead of a poll thread and an event thread per dialler, polling and sending are tasks
+    in the running event loop, so many diallers can share one loop and one thread.
+
+    All methods have to be called from the thread running the event loop.
+    From other threads use loop.call_soon_threadsafe.
+
+    Copyright (c) 2018  van Ovost Automatisering b.v.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    you may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+    """
+
+    def __init__(self, account, receiver=None, line=None, callback=None):
+        """
+        Define a basic dialler (SPT Secure Premises Transceiver)
+
+        parameters
+            account
+                Account number to be used.
+                Most receivers expect a numeric string of 4 to 8 digits
+            receiver
+                an optional integer to be used as receiver number in the block header
+            line
+                an optional integer to be used as line number in the block header
+            callback
+                optional function called for generated poll state messages
+        """
+        self.account = account
+        self.receiver = receiver
+        self.line = line
+        self.tpaths = {}
+        for mb in ('main', 'back-up'):
+            self.tpaths[mb] = {}
+            for ps in ('primary', 'secondary'):
+                self.tpaths[mb][ps] = {'path': None, 'conn': None, 'ok': 0}
+        self.msg_nr = 0
+        self.queue = deque()
+        # the events are created with their task, in the event loop that runs it
+        self.queue_event = None
+        self.poll_event = None
+        self.poll_first = True
+        self.counter = 0
+        self.msg_callback = callback
+        self.send_task = None
+        self.send_retry_delay = 0.5
+        self.sending = False
+        self.poll_task = None
+        self.main_poll = None
+        self.backup_poll = None
+        self.poll_retry_delay = 5
+        self.ok_msg = None
+        self.fail_msg = None
+        self.main_poll_next = 0
+        self.backup_poll_next = 0
+        self.poll_counter = 0
+        self.routines = []
+        self.routine_nexts = []
+        self.templates = []
+
+    # ---------------------
+    # configure transmission paths
+    # ---------------------
+    def set_path(self, mb, pb, host, port, *, account=None, key=None, receiver=None, line=None, type=None,
+                 keepalive=False):
+        """
+        Define the transmission path, see dc09_spt.set_path
+        """
+        if account is not None:
+            acc = account
+            if self.account is None:
+                self.account = account
+                self.recompile()
+        else:
+            acc = self.account
+        if receiver is not None:
+            rec = receiver
+            if self.receiver is None:
+                self.receiver = receiver
+        else:
+            rec = self.receiver
+        if line is not None:
+            lin = line
+            if self.line is None:
+                self.line = lin
+        else:
+            lin = self.line
+        if self.tpaths[mb][pb]['conn'] is not None:
+            self.tpaths[mb][pb]['conn'].disconnect()
+        path = TransPath(host, port, acc, key=key, receiver=rec, line=lin, type=type, keepalive=keepalive)
+        self.tpaths[mb][pb]['path'] = path
+        self.tpaths[mb][pb]['conn'] = TransPathAIO(path)
+        self.tpaths[mb][pb]['ok'] = 0
+
+    def del_path(self, mb, pb):
+        """
+        Remove a transmission path
+        """
+        if self.tpaths[mb][pb]['conn'] is not None:
+            self.tpaths[mb][pb]['conn'].disconnect()
+        self.tpaths[mb][pb]['path'] = None
+        self.tpaths[mb][pb]['conn'] = None
+
+    def set_callback(self, cb):
+        """
+        Set a callback for generated messages
+        """
+        self.msg_callback = cb
+
+    def get_callback(self):
+        """
+        returns the callback for generated messages
+        """
+        return self.msg_callback
+
+    def start_poll(self, main, backup=None, retry_delay=5, ok_msg=None, fail_msg=None):
+        """
+        Start the automatic polling to the receiver(s), see dc09_spt.start_poll
+        """
+        self.main_poll = main
+        self.backup_poll = backup
+        self.poll_retry_delay = retry_delay
+        self.ok_msg = self.state_template(ok_msg)
+        self.fail_msg = self.state_template(fail_msg)
+        self.wake_poller()
+
+    def state_template(self, msg):
+        """
+        Compile a poll state message, see poll_thread.state_template
+        """
+        if msg is None:
+            return None
+        mtype = None
+        qualify = False
+        if 'type' in msg:
+            mtype = msg['type']
+        elif 'code' in msg:
+            code = msg['code']
+            if len(code) == 3:
+                mtype = 'ADM-CID'
+                qualify = True
+            elif len(code) == 2:
+                mtype = 'SIA-DCS'
+        if mtype is None:
+            return None
+        return self.compile_msg(mtype, msg), qualify
+
+    def recompile(self):
+        """
+        Compile the routine and poll state messages again, see poll_thread.recompile
+        """
+        self.templates = [self.compile_msg(template.mtype, template.mparam) for template in self.templates]
+        if self.ok_msg is not None:
+            self.ok_msg = self.compile_msg(self.ok_msg[0].mtype, self.ok_msg[0].mparam), self.ok_msg[1]
+        if self.fail_msg is not None:
+            self.fail_msg = self.compile_msg(self.fail_msg[0].mtype, self.fail_msg[0].mparam), self.fail_msg[1]
+
+    def stop_poll(self):
+        """Stop the automatic polling to the receiver(s)"""
+        self.main_poll = None
+        self.backup_poll = None
+        if len(self.routines) == 0 and self.poll_task is not None:
+            self.poll_task.cancel()
+            self.poll_task = None
+
+    def start_routine(self, rlist):
+        """
+        Configure the routine messages, see poll_thread.set_routines
+        """
+        self.routines = rlist
+        self.routine_nexts = []
+        self.templates = []
+        now = time.time()
+        mono = time.monotonic()
+        for routine in self.routines:
+            interval = routine.get('interval', 86400)
+            if 'start' in routine:
+                start = (now % 86400) + routine['start']
+            else:
+                start = now
+            while start < now:
+                start += interval
+            self.routine_nexts.append(mono + start - now)
+            if 'type' in routine:
+                mtype = routine['type']
+            elif 'code' in routine and len(routine['code']) == 3:
+                mtype = 'ADM-CID'
+            else:
+                mtype = 'SIA-DCS'
+            self.templates.append(self.compile_msg(mtype, routine))
+        if len(rlist) == 0 and not (self.main_poll or self.backup_poll):
+            if self.poll_task is not None:
+                self.poll_task.cancel()
+                self.poll_task = None
+        else:
+            self.wake_poller()
+
+    def wake_poller(self):
+        """
+        Wake the poll task after a change of settings, start it when it is not running
+        """
+        if self.poll_task is None or self.poll_task.done():
+            self.poll_event = asyncio.Event()
+            self.poll_task = _running_loop().create_task(self.poll_run())
+        self.poll_event.set()
+
+    def wake_sender(self):
+        """
+        Wake the send task for queued messages, start it when it is not running
+        """
+        if self.send_task is None or self.send_task.done():
+            self.queue_event = asyncio.Event()
+            self.send_task = _running_loop().create_task(self.send_run())
+        self.queue_event.set()
+
+    def send_msg(self, mtype, mparam):
+        """
+        Schedule a message for sending to the receiver, see dc09_spt.send_msg
+        """
+        dc09type, msg = dc09_spt.encode_msg(self.account, mtype, mparam)
+        return self.queue_msg(dc09type, msg)
+
+    def compile_msg(self, mtype, mparam):
+        """
+        Compile a message that is sent more than once, see dc09_spt.compile_msg
+        """
+        return msg_template(self.account, mtype, mparam)
+
+    def send_template(self, template, fields={}):
+        """
+        Schedule a compiled message for sending to the receiver, see dc09_spt.send_template
+        """
+        if template.account != self.account:
+            template = msg_template(self.account, template.mtype, template.mparam)
+        dc09type, msg = template.encode(fields)
+        return self.queue_msg(dc09type, msg)
+
+    def queue_msg(self, dc09type, msg):
+        """
+        Number and queue an encoded message
+        """
+        self.msg_nr += 1
+        if self.msg_nr > 9999:
+            self.msg_nr = 1
+        self.counter += 1
+        logging.debug('Message queued nr %s type %s content "%s"', self.msg_nr, dc09type, msg)
+        self.queue.append((self.msg_nr, dc09type, msg))
+        self.wake_sender()
+        return self.msg_nr
+
+    def send_msgs(self, msgs):
+        """
+        Schedule a batch of messages for sending to the receiver, see dc09_spt.send_msgs
+        """
+        encoded = [dc09_spt.encode_msg(self.account, mtype, mparam) for mtype, mparam in msgs]
+        nrs = []
+        for dc09type, msg in encoded:
+            self.msg_nr += 1
+            if self.msg_nr > 9999:
+                self.msg_nr = 1
+            nrs.append(self.msg_nr)
+            self.queue.append((self.msg_nr, dc09type, msg))
+        self.counter += len(encoded)
+        if len(nrs):
+            self.wake_sender()
+        return nrs
+
+    def state(self):
+        """
+        Returns a dictionary with current state information, see dc09_spt.state
+        """
+        ret = {'msgs queued': len(self.queue), 'msgs sent': self.counter}
+        for mb in ('main', 'back-up'):
+            for ps in ('primary', 'secondary'):
+                if self.tpaths[mb][ps]['path'] is not None:
+                    ret[mb + ' ' + ps + ' path ok'] = self.tpaths[mb][ps]['ok']
+        if self.poll_task is not None:
+            ret['poll active'] = self.poll_active()
+            ret['poll count'] = self.poll_counter
+        if self.send_task is not None:
+            ret['send active'] = self.sending
+        return ret
+
+    def metrics(self):
+        """
+        Returns a snapshot of the metrics of the dialler and its paths, see dc09_spt.metrics
+        the asyncio dialler does not keep the queue time of its messages, oldest age is always None
+        """
+        ret = {'msgs queued': len(self.queue), 'msgs sent': self.counter, 'msgs dropped': 0, 'deadline breaches': 0,
+               'oldest age': None, 'paths': {}}
+        for mb in ('main', 'back-up'):
+            for ps in ('primary', 'secondary'):
+                path = self.tpaths[mb][ps]['path']
+                if path is not None:
+                    snap = path.metrics.snapshot()
+                    snap['ok'] = self.tpaths[mb][ps]['ok']
+                    snap['health'] = path.health.snapshot()
+                    ret['paths'][mb + ' ' + ps] = snap
+        return ret
+
+    def isConnected(self):
+        """Returns true if there is a connection"""
+        for mb in ('main', 'back-up'):
+            for ps in ('primary', 'secondary'):
+                if self.tpaths[mb][ps]['path'] is not None and self.tpaths[mb][ps]['ok'] > 0:
+                    return True
+        return False
+
+    def notSent(self):
+        """Returns the number of messages in the send queue"""
+        return len(self.queue)
+
+    async def close(self):
+        """
+        Stop polling and sending and close all connections
+        """
+        for task in (self.poll_task, self.send_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.poll_task = None
+        self.send_task = None
+        for mb in ('main', 'back-up'):
+            for ps in ('primary', 'secondary'):
+                if self.tpaths[mb][ps]['conn'] is not None:
+                    self.tpaths[mb][ps]['conn'].disconnect()
+
+    async def transfer_msg(self, msg_nr, mtype, message, conn):
+        """
+        Transfer a message over the connection of a path and decode the answer
+        if needed repeat with correct time offset
+
+        return value
+            true if message is transferred correct
+        """
+        ret = False
+        hook = trace.hook
+        if hook is not None:
+            begin = time.monotonic()
+        path = conn.path
+        dc09 = path.get_encoder()
+        mesg = dc09.block(msg_nr, mtype, message)
+        path.health.begin()
+        rtt = None
+        async with conn.get_lock():
+            if await conn.connect():
+                start = time.monotonic()
+                antw = await conn.sendAndReceive(mesg, 512)
+                if antw is None:
+                    path.metrics.count('timeouts')
+                else:
+                    path.metrics.observe_rtt(time.monotonic() - start)
+                    try:
+                        res = dc09.dc09answer(msg_nr, antw)
+                        if res is not None:
+                            rtt = time.monotonic() - start
+                            path.metrics.answer(res[0])
+                            if res[1] is not None:
+                                path.set_offset(res[1])
+                            if res[0] == 'NAK':
+                                dc09 = path.get_encoder()
+                                mesg = dc09.block(msg_nr, mtype, message)
+                                path.metrics.count('retransmits')
+                                start = time.monotonic()
+                                antw = await conn.sendAndReceive(mesg, 1024)
+                                if hook is not None:
+                                    trace.call(hook, 'resend', path, start, time.monotonic())
+                                if antw is None:
+                                    path.metrics.count('timeouts')
+                                else:
+                                    path.metrics.observe_rtt(time.monotonic() - start)
+                                    res = dc09.dc09answer(msg_nr, antw)
+                                    path.metrics.answer(res[0])
+                            if res[0] == 'ACK':
+                                ret = True
+                    except Exception as e:
+                        logging.error("Answer decode error %s", repr(e))
+                logging.debug('Sent message nr %s mtype %s content %s to %s port %s answer %s', msg_nr, mtype,
+                              message, path.host, path.port, antw)
+            conn.release()
+        if rtt is None:
+            path.health.failure()
+        else:
+            path.health.success(rtt)
+        if hook is not None:
+            trace.call(hook, 'transfer', path, begin, time.monotonic())
+        return ret
+
+    # -----------------
+    # send events while needed (task)
+    # -----------------
+    async def send_run(self):
+        while True:
+            await self.queue_event.wait()
+            self.queue_event.clear()
+            self.sending = True
+            while len(self.queue):
+                if not await self.send():
+                    await asyncio.sleep(self.send_retry_delay)
+            self.sending = False
+
+    async def send(self):
+        mess = self.queue.popleft()
+        msg_sent = False
+        # ---------------------------
+        # known good paths first, then the healthiest paths
+        # skip the paths with an open breaker
+        # --------------------------
+        entries = []
+        for mb in ('main', 'back-up'):
+            for ps in ('primary', 'secondary'):
+                entry = self.tpaths[mb][ps]
+                if entry['conn'] is not None and entry['path'].health.available():
+                    entries.append((not entry['ok'], entry['path'].health.rank(), len(entries), entry))
+        entries.sort(key=lambda e: e[:3])
+        for good, rank, nr, entry in entries:
+            if not msg_sent:
+                if await self.transfer_msg(mess[0], mess[1], mess[2], entry['conn']):
+                    msg_sent = True
+                    entry['ok'] = 1
+        if not msg_sent:
+            self.queue.appendleft(mess)
+        return msg_sent
+
+    # -----------------
+    # send polls and routines while needed (task)
+    # at first run check all paths
+    # ------------------
+    async def poll_run(self):
+        while self.main_poll or self.backup_poll or len(self.routines) > 0:
+            first = self.poll_first
+            now = time.monotonic()
+            main_polled = False
+            back_up_for_main = False
+            backup_polled = False
+            if self.main_poll is not None and self.main_poll_next <= now:
+                main_polled = await self.poll_paths('main', first, 1)
+                if not main_polled:
+                    back_up_for_main = True
+                else:
+                    self.main_poll_next = now + self.main_poll
+            if self.backup_poll is not None and (self.main_poll_next <= now or self.backup_poll_next <= now or first):
+                backup_polled = await self.poll_paths('back-up', first, 2)
+                if backup_polled:
+                    self.backup_poll_next = now + self.backup_poll
+            if self.main_poll is not None and main_polled and (self.backup_poll is None or backup_polled):
+                self.poll_first = False
+            if main_polled or (back_up_for_main and backup_polled):
+                if self.main_poll is not None and self.main_poll_next < now:
+                    self.main_poll_next = now + self.main_poll
+            if len(self.routines) > 0:
+                self.do_routines()
+            # sleep until the next poll, retry or routine is due or the settings change
+            self.poll_event.clear()
+            delay = self.next_due() - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.poll_event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        self.poll_task = None
+
+    def next_due(self):
+        """
+        Returns the monotonic time the next poll, poll retry or routine is due
+        """
+        now = time.monotonic()
+        retry = now + self.poll_retry_delay
+        due = []
+        if self.main_poll is not None:
+            due.append(self.main_poll_next if self.main_poll_next > now else retry)
+        if self.backup_poll is not None:
+            if self.poll_first:
+                due.append(retry)
+            due.append(self.backup_poll_next if self.backup_poll_next > now else retry)
+        due.extend(self.routine_nexts)
+        if len(due) == 0:
+            return retry
+        return min(due)
+
+    async def poll_paths(self, mb, first, zone):
+        """
+        Poll the paths of main or back-up, all of them on the first run
+        otherwise until one succeeds
+        """
+        polled = False
+        order = sorted(('primary', 'secondary'), key=lambda ps: self.tpaths[mb][ps]['path'].health.rank()
+                       if self.tpaths[mb][ps]['path'] is not None else (True, True))
+        for ps in order:
+            entry = self.tpaths[mb][ps]
+            if (first or not polled) and entry['conn'] is not None:
+                # a path with an open circuit breaker counts as failed without a transfer
+                if (first or entry['path'].health.available()) and \
+                        await self.transfer_msg(0, "NULL", "]", entry['conn']):
+                    polled = True
+                    self.poll_counter += 1
+                    if entry['ok'] != 1:
+                        entry['ok'] = 1
+                        self.poll_msg(self.ok_msg, zone, 1)
+                else:
+                    if entry['ok'] != 0:
+                        entry['ok'] = 0
+                        self.poll_msg(self.fail_msg, zone, 0)
+        return polled
+
+    def poll_msg(self, msg, ps, ok):
+        """
+        Send a message on poll state change
+        """
+        if msg is not None:
+            template, qualify = msg
+            fields = {'zone': ps}
+            if qualify:
+                if ok:
+                    fields['q'] = 1
+                else:
+                    fields['q'] = 3
+            self.send_template(template, fields)
+            if self.msg_callback is not None:
+                self.msg_callback(template.mtype, dict(template.mparam, **fields))
+
+    def poll_active(self):
+        ret = 0
+        if self.main_poll or self.backup_poll:
+            ret += 1
+        if len(self.routines) > 0:
+            ret += 2
+        return ret
+
+    def do_routines(self):
+        now = time.monotonic()
+        for cnt, r in enumerate(self.routines):
+            if self.routine_nexts[cnt] <= now:
+                self.send_template(self.templates[cnt])
+                n = self.routine_nexts[cnt] + r.get('interval', 86400)
+                if n <= now:
+                    n = now + r.get('interval', 86400)
+                self.routine_nexts[cnt] = n
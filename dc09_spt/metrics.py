@@ -0,0 +1,274 @@
+# ----------------------------
+# Metrics of the diallers and their transmission paths
+# (c 2018 van Ovost Automatisering b.v.
+# Author : Jacq. van Ovost
+# ----------------------------
+import bisect
+import threading
+import logging
+from http.server import BaseHTTPRequestHandler, HTTPServer
+try:
+    from http.server import ThreadingHTTPServer
+except ImportError:
+    # python 3.6
+    from socketserver import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+"""
+
+    Copyright (c) 2018  van Ovost Automatisering b.v.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    you may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# ----------------------------
+# upper bounds in seconds of the histogram buckets, the last bucket is +Inf
+# ----------------------------
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class histogram:
+    """
+    Histogram with fixed buckets, not thread safe on its own
+    """
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """
+        Returns a dictionary with the cumulative count per upper bound, the sum and the count
+        """
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return {'buckets': cumulative, 'sum': self.sum, 'count': self.count}
+
+
+class path_metrics:
+    """
+    Metrics of one transmission path
+
+    Kept by TransPath and updated by the diallers and the connections of the path:
+        rtt
+            histogram of the time from sending a block until its answer
+        connect
+            histogram of the time to set up a connection
+        answers
+            number of ACK, NAK, DUH and RSP answers
+        timeouts
+            exchanges without an answer
+        retransmits
+            blocks sent again, after a NAK, a lost kept alive connection or a lost UDP datagram
+        connect errors
+            failed connection attempts
+        offset
+            last clock offset of the receiver in seconds
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rtt = histogram()
+        self.connect = histogram()
+        self.answers = {'ACK': 0, 'NAK': 0, 'DUH': 0, 'RSP': 0}
+        self.counters = {'timeouts': 0, 'retransmits': 0, 'connect errors': 0}
+        self.offset = None
+
+    def observe_rtt(self, seconds):
+        self.lock.acquire()
+        self.rtt.observe(seconds)
+        self.lock.release()
+
+    def observe_connect(self, seconds):
+        self.lock.acquire()
+        self.connect.observe(seconds)
+        self.lock.release()
+
+    def answer(self, res):
+        self.lock.acquire()
+        self.answers[res] = self.answers.get(res, 0) + 1
+        self.lock.release()
+
+    def count(self, name, inc=1):
+        self.lock.acquire()
+        self.counters[name] = self.counters.get(name, 0) + inc
+        self.lock.release()
+
+    def set_offset(self, offset):
+        self.offset = offset
+
+    def snapshot(self):
+        """
+        Returns a copy of the metrics as a dictionary
+        """
+        self.lock.acquire()
+        ret = {'rtt': self.rtt.snapshot(), 'connect': self.connect.snapshot(), 'answers': dict(self.answers),
+               'offset': self.offset}
+        ret.update(self.counters)
+        self.lock.release()
+        return ret
+
+
+# ----------------------------
+# Prometheus text exposition
+# ----------------------------
+def _labels(labels):
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+def _histogram_lines(lines, name, labels, hist):
+    for bound, count in hist['buckets']:
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        lines.append('{}_bucket{} {}'.format(name, _labels(labels + [('le', le)]), count))
+    lines.append('{}_sum{} {}'.format(name, _labels(labels), hist['sum']))
+    lines.append('{}_count{} {}'.format(name, _labels(labels), hist['count']))
+
+
+def prometheus_text(diallers):
+    """
+    Format the metrics of a number of diallers in the Prometheus text format
+
+    parameters
+        diallers
+            iterable of dc09_spt objects, or a dc09_hub
+    return value
+        the text as a string
+    """
+    if hasattr(diallers, 'accounts'):
+        diallers = list(diallers.accounts.values())
+    families = {
+        'dc09_msgs_queued': ('gauge', 'Messages in the send queue'),
+        'dc09_queue_oldest_age_seconds': ('gauge', 'Age of the oldest message in the send queue'),
+        'dc09_msgs_sent_total': ('counter', 'Messages queued for sending since start'),
+        'dc09_msgs_dropped_total': ('counter', 'Messages dropped because the queue was full'),
+        'dc09_deadline_breaches_total': ('counter', 'Messages delivered after their deadline'),
+        'dc09_path_ok': ('gauge', 'Path known to be good'),
+        'dc09_path_rtt_seconds': ('histogram', 'Time from sending a block until its answer'),
+        'dc09_path_connect_seconds': ('histogram', 'Time to set up a connection'),
+        'dc09_path_answers_total': ('counter', 'Answers received per answer type'),
+        'dc09_path_timeouts_total': ('counter', 'Exchanges without an answer'),
+        'dc09_path_retransmits_total': ('counter', 'Blocks sent again'),
+        'dc09_path_connect_errors_total': ('counter', 'Failed connection attempts'),
+        'dc09_path_clock_offset_seconds': ('gauge', 'Clock offset of the receiver'),
+        'dc09_path_breaker_open': ('gauge', 'Circuit breaker of the path open (1) or half-open (0.5)'),
+        'dc09_path_success_ratio': ('gauge', 'Part of the recent transfers that got an answer'),
+    }
+    samples = dict((name, []) for name in families)
+    for spt in diallers:
+        snap = spt.metrics()
+        account = [('account', spt.account)]
+        samples['dc09_msgs_queued'].append('dc09_msgs_queued{} {}'.format(_labels(account), snap['msgs queued']))
+        if snap['oldest age'] is not None:
+            samples['dc09_queue_oldest_age_seconds'].append('dc09_queue_oldest_age_seconds{} {}'.format(
+                _labels(account), snap['oldest age']))
+        for name, key in (('dc09_msgs_sent_total', 'msgs sent'), ('dc09_msgs_dropped_total', 'msgs dropped'),
+                          ('dc09_deadline_breaches_total', 'deadline breaches')):
+            samples[name].append('{}{} {}'.format(name, _labels(account), snap[key]))
+        for path, pm in snap['paths'].items():
+            labels = account + [('path', path)]
+            samples['dc09_path_ok'].append('dc09_path_ok{} {}'.format(_labels(labels), int(pm['ok'])))
+            _histogram_lines(samples['dc09_path_rtt_seconds'], 'dc09_path_rtt_seconds', labels, pm['rtt'])
+            _histogram_lines(samples['dc09_path_connect_seconds'], 'dc09_path_connect_seconds', labels,
+                             pm['connect'])
+            for res, count in pm['answers'].items():
+                samples['dc09_path_answers_total'].append('dc09_path_answers_total{} {}'.format(
+                    _labels(labels + [('answer', res)]), count))
+            for name, key in (('dc09_path_timeouts_total', 'timeouts'),
+                              ('dc09_path_retransmits_total', 'retransmits'),
+                              ('dc09_path_connect_errors_total', 'connect errors')):
+                samples[name].append('{}{} {}'.format(name, _labels(labels), pm[key]))
+            if pm['offset'] is not None:
+                samples['dc09_path_clock_offset_seconds'].append('dc09_path_clock_offset_seconds{} {}'.format(
+                    _labels(labels), pm['offset']))
+            if 'health' in pm:
+                breaker = {'closed': 0, 'half-open': 0.5, 'open': 1}[pm['health']['state']]
+                samples['dc09_path_breaker_open'].append('dc09_path_breaker_open{} {}'.format(
+                    _labels(labels), breaker))
+                samples['dc09_path_success_ratio'].append('dc09_path_success_ratio{} {}'.format(
+                    _labels(labels), pm['health']['success rate']))
+    lines = []
+    for name, (mtype, text) in families.items():
+        lines.append('# HELP {} {}'.format(name, text))
+        lines.append('# TYPE {} {}'.format(name, mtype))
+        lines += samples[name]
+    return '\n'.join(lines) + '\n'
+
+
+class metrics_server:
+    """
+    Local HTTP listener serving the metrics in the Prometheus text format on /metrics
+
+    example
+        server = metrics_server([spt1, spt2], port=9109)
+        ...
+        server.stop()
+    """
+    def __init__(self, diallers, port=9109, host='127.0.0.1'):
+        """
+        Start the listener in a daemon thread
+
+        parameters
+            diallers
+                list of dc09_spt objects or a dc09_hub, a list may be changed later
+            port
+                port to listen on, 0 picks a free port (see port)
+            host
+                address to listen on, the default only accepts local connections
+        """
+        self.diallers = diallers
+        source = self
+
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                try:
+                    body = prometheus_text(source.diallers).encode('utf-8')
+                except Exception as e:
+                    logging.error('Metrics exception %s', repr(e))
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug('Metrics request ' + format, *args)
+
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='dc09 metrics', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the listener
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
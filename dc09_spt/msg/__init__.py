@@ -1,5 +1,7 @@
 from dc09_spt.msg.dc03_msg import dc03_msg
 from dc09_spt.msg.dc05_msg import dc05_msg
-from dc09_spt.msg.dc09_msg import dc09_msg
+from dc09_spt.msg.dc09_msg import dc09_msg, dc09_encoder
+from dc09_spt.msg.dc09_bulk import dc09_bulk
+from dc09_spt.msg import dc09_time
 
-__all__ = ["dc03_msg", "dc05_msg", "dc09_msg"]
+__all__ = ["dc03_msg", "dc05_msg", "dc09_msg", "dc09_encoder", "dc09_bulk", "dc09_time"]
@@ -24,6 +24,18 @@ import logging
 """
 
 
+# ----------------------------
+# codes that have the user, door or area number following the code
+# ----------------------------
+codes_with_user = frozenset(("BC", "CE", "CF", "CJ", "CK", "CL", "CP", "CQ", "CR", "DA", "DB", "EE",
+                             "JD", "JH", "JK", "JP", "JS", "JT", "JV", "JX", "JY", "JZ", "OC", "OH", "OJ", "OK", "OL",
+                             "OP", "OQ", "OR", "OT", "RX"))
+codes_with_door = frozenset(("DC", "DD", "DE", "DF", "DG", "DH", "DI", "DJ", "DK", "DL", "DM", "DN",
+                             "DO", "DP", "DQ", "DR", "DS", "DV", "DW", "DX", "DY", "DZ"))
+codes_with_area = frozenset(("BV", "CA", "CD", "CG", "CI", "CT", "CW", "FI", "FK", "JA", "JR", "NF",
+                             "NL", "NM", "OA", "OG", "OI"))
+
+
 class dc03_codes:
     """
     Some special codes
@@ -34,9 +46,6 @@ class dc03_codes:
         Codes that have the user number following the code.
         Note that there is no way to transfer a zone in the message
         """
-        codes_with_user = {"BC", "CE", "CF", "CJ", "CK", "CL", "CP", "CQ", "CR", "DA", "DB", "EE",
-                           "JD", "JH", "JK", "JP", "JS", "JT", "JV", "JX", "JY", "JZ", "OC", "OH", "OJ", "OK", "OL",
-                           "OP", "OQ", "OR", "OT", "RX"}
         return code in codes_with_user
 
     @staticmethod
@@ -45,8 +54,6 @@ class dc03_codes:
         Codes that have the door number following the code.
         Note that there is no way to transfer a zone in the message
         """
-        codes_with_door = {"DC", "DD", "DE", "DF", "DG", "DH", "DI", "DJ", "DK", "DL", "DM", "DN", 
-                           "DO", "DP", "DQ", "DR", "DS", "DV", "DW", "DX", "DY", "DZ"}
         return code in codes_with_door
 
     @staticmethod
@@ -55,8 +62,6 @@ class dc03_codes:
         Codes that have the area number following the code.
         Note that there is no way to transfer a zone in the message
         """
-        codes_with_area = {"BV", "CA", "CD", "CG", "CI", "CT", "CW", "FI", "FK", "JA", "JR", "NF",
-                           "NL", "NM", "OA", "OG", "OI"}
         return code in codes_with_area
 
 
@@ -112,60 +117,113 @@ class dc03_msg:
                         an time string in format 'hh:mm:ss' or the word 'now'
             all name and text fields can only use ascii characters in the range space to '~' but except [ ] | ^ and /
         """
+        return dc03_template(spt_account, params).payload()
+
+
+class dc03_template:
+    """
+    Precompiled DC03 message
+
+    The parameter map is checked and formatted once, only the fields that vary between messages
+    (zone, user and time) are filled in by payload.
+    Used for messages that are sent again and again, like routines and poll state messages.
+
+    example
+        tpl = dc03_template('1234', {'code': 'YS', 'zonename': 'line'})
+        msg = tpl.payload({'zone': 2})
+    """
+    def __init__(self, spt_account, params={}):
+        """
+        parameters
+            spt_account
+                the account of the alarm transceiver
+            params
+                a map with key-value pairs, see dc03_msg.dc03event
+        """
         account = param.strpar(params,  'account', spt_account)
         area = param.numpar(params, 'area')
-        zone = param.numpar(params, 'zone')
-        user = param.numpar(params, 'user')
-        msg = ''
+        self.zone = param.numpar(params, 'zone')
+        self.user = param.numpar(params, 'user')
+        self.time = params.get('time')
         if account is None:
-            msg += '#0000|'
+            head = '#0000|'
         else:
-            msg += '#' + account + '|'
+            head = '#' + account + '|'
         code = param.strpar(params, 'code', None)
         text = param.strpar(params, 'text', None)
         flavor = param.strpar(params, 'flavor', None)
-        if (code is None or code == 'A') and text is not None:
-            msg += 'A' + text
-            if zone is not None or area is not None or zone is not None or user is not None:
-                logging.warning("Text message can not contain zone, area or user id's")
+        self.area = area
+        self.text = (code is None or code == 'A') and text is not None
+        if self.text:
+            self.head = head + 'A' + text
+            return
+        head += 'N'
+        if code is None:
+            code = 'RP'
+        if area is not None and code not in codes_with_area:
+            head += 'ri' + area
+            if 'areaname' in params:
+                head += '^' + params['areaname'] + '^'
+        self.head = head
+        self.code = code
+        self.username = '^' + params['username'] + '^' if 'username' in params else ''
+        self.zonename = '^' + params['zonename'] + '^' if 'zonename' in params else ''
+        if code in codes_with_user:
+            self.follows = 'user'
+        elif code in codes_with_area and area is not None:
+            self.follows = 'area'
         else:
-            msg += 'N'
-            if code is None:
-                code = 'RP'
-            if area is not None:
-                if not dc03_codes.dc03_is_area(code):
-                    msg += 'ri' + area
-                    if 'areaname' in params:
-                        msg += '^' + params['areaname'] + '^'
-            if user is not None:
-                if not dc03_codes.dc03_is_user(code):
-                    msg += 'id' + user
-                    if 'username' in params:
-                        msg += '^' + params['username'] + '^'
-            if 'time' in params:
-                timep = params['time']
-                if timep == 'now':
-                    timep = time.strftime('%H:%M:%S')
-                msg += 'ti' + timep
-            msg += code
-            if dc03_codes.dc03_is_user(code):
-                if user is not None:
-                    msg += user
-                if zone is not None:
-                    logging.warning('Zone %s not included in message because code %s is user related',  zone,  code)
-            elif dc03_codes.dc03_is_area(code) and area is not None:
-                if area is not None:
-                    msg += area
-                if zone is not None:
-                    logging.warning('Zone %s not included in message because code %s is area related',  zone,  code)
+            self.follows = 'zone'
+        tail = ''
+        if text is not None:
+            if flavor == 'xsia':
+                tail = '*"' + text + '"NM'
             else:
-                if zone is not None:
-                    msg += zone
-                    if 'zonename' in params:
-                        msg += '^' + params['zonename'] + '^'
-            if text is not None:
-                if flavor == 'xsia':
-                    msg += '*"' + text + '"NM'
-                else:
-                    msg += '|A' + text
-        return msg + ']'
+                tail = '|A' + text
+        self.tail = tail + ']'
+
+    def payload(self, fields={}):
+        """
+        Build the message
+
+        parameters
+            fields
+                optional map with zone, user and time for this message,
+                the values of the compiled parameter map are used for the missing ones
+        return value
+            the DC03 message as string
+        """
+        zone = self.zone
+        user = self.user
+        timep = self.time
+        if len(fields):
+            if 'zone' in fields:
+                zone = param.numpar(fields, 'zone')
+            if 'user' in fields:
+                user = param.numpar(fields, 'user')
+            if 'time' in fields:
+                timep = fields['time']
+        if self.text:
+            if zone is not None or self.area is not None or user is not None:
+                logging.warning("Text message can not contain zone, area or user id's")
+            return self.head + ']'
+        msg = self.head
+        if user is not None and self.follows != 'user':
+            msg += 'id' + user + self.username
+        if timep is not None:
+            if timep == 'now':
+                timep = time.strftime('%H:%M:%S')
+            msg += 'ti' + timep
+        msg += self.code
+        if self.follows == 'user':
+            if user is not None:
+                msg += user
+            if zone is not None:
+                logging.warning('Zone %s not included in message because code %s is user related',  zone,  self.code)
+        elif self.follows == 'area':
+            msg += self.area
+            if zone is not None:
+                logging.warning('Zone %s not included in message because code %s is area related',  zone,  self.code)
+        elif zone is not None:
+            msg += zone + self.zonename
+        return msg + self.tail
@@ -22,6 +22,16 @@ limitations under the License.
 """
 
 
+# ----------------------------
+# codes that have the user number following the code
+# ----------------------------
+codes_with_user = frozenset(("121",  "313",  "400",  "401",  "402",  "403",  "404",  "405",
+                             "406",  "407",  "408",  "409",  "441",  "442",  "450",  "451",  "452",  "453",
+                             "454",  "455",  "456",  "457",  "458",  "459",  "462",  "463",  "464",  "466",
+                             "411",  "412",  "413",  "414",  "415",  "421",  "422",  "424",  "425",  "429",
+                             "430",  "431",  "574",  "604",  "607",  "625",  "642",  "652",  "653"))
+
+
 class dc05_codes:
     """
     Some special codes
@@ -32,11 +42,6 @@ class dc05_codes:
         Codes that have the user number following the code.
         Note that there is no way to transfer a zone in the message
         """
-        codes_with_user = {"121",  "313",  "400",  "401",  "402",  "403",  "404",  "405",
-                           "406",  "407",  "408",  "409",  "441",  "442",  "450",  "451",  "452",  "453",
-                           "454",  "455",  "456",  "457",  "458",  "459",  "462",  "463",  "464",  "466",
-                           "411",  "412",  "413",  "414",  "415",  "421",  "422",  "424",  "425",  "429",
-                           "430",  "431",  "574",  "604",  "607",  "625",  "642",  "652",  "653"}
         return code in codes_with_user
 
 
@@ -70,29 +75,79 @@ class dc05_msg:
                         3 means new restore
                         6 means old alarm
         """
+        return dc05_template(spt_account, params).payload()
+
+
+class dc05_template:
+    """
+    Precompiled DC05 message
+
+    The parameter map is checked and formatted once, only the fields that vary between messages
+    (zone, user and q) are filled in by payload.
+    Used for messages that are sent again and again, like routines and poll state messages.
+
+    example
+        tpl = dc05_template('1234', {'code': '350'})
+        msg = tpl.payload({'zone': 2, 'q': 3})
+    """
+    def __init__(self, spt_account, params={}):
+        """
+        parameters
+            spt_account
+                the account of the alarm transceiver
+            params
+                a map with key-value pairs, see dc05_msg.dc05event
+        """
         account = param.strpar(params,  'account',  spt_account)
-        zone = param.numpar(params, 'zone',  '000')
-        user = param.numpar(params, 'user',  None)
-        msg = ''
+        self.zone = param.numpar(params, 'zone',  '000')
+        self.user = param.numpar(params, 'user',  None)
         if account is None:
-            msg += '#0000|'
+            self.head = '#0000|'
         else:
-            msg += '#' + account + '|'
+            self.head = '#' + account + '|'
         code = param.numpar(params,  'code',  '602')
         if len(code) != 3:
             raise Exception('Code should be 3 positions')
-        q = param.numpar(params,  'q', '1')
-        if q != '1' and q != '3' and q != '3':
-            raise Exception('Qualifier q should be 1 or 3 or 6')
+        self.code = code
+        self.q = self.qualifier(params, '1')
         area = param.numpar(params,  'area', '00')
         if len(area) != 2:
             area = ('00' + area)[-2:]
-        if dc05_codes.dc05_is_user(code) and user is not None:
+        self.area = area
+        self.with_user = code in codes_with_user
+
+    @staticmethod
+    def qualifier(params, default=None):
+        q = param.numpar(params,  'q', default)
+        if q not in ('1', '3', '6'):
+            raise Exception('Qualifier q should be 1 or 3 or 6')
+        return q
+
+    def payload(self, fields={}):
+        """
+        Build the message
+
+        parameters
+            fields
+                optional map with zone, user and q for this message,
+                the values of the compiled parameter map are used for the missing ones
+        return value
+            the DC05 message as string
+        """
+        zone = self.zone
+        user = self.user
+        q = self.q
+        if len(fields):
+            if 'zone' in fields:
+                zone = param.numpar(fields, 'zone')
+            if 'user' in fields:
+                user = param.numpar(fields, 'user')
+            if 'q' in fields:
+                q = self.qualifier(fields)
+        if self.with_user and user is not None:
             if len(user) != 3:
                 user = ('000' + user)[-3:]
-            msg += q + code + ' ' + area + ' ' + user + ']'
-        else:
-            if len(zone) != 3:
-                zone = ('000' + zone)[-3:]
-            msg += q + code + ' ' + area + ' ' + zone + ']'
-        return msg 
+            return self.head + q + self.code + ' ' + self.area + ' ' + user + ']'
+        if len(zone) != 3:
+            zone = ('000' + zone)[-3:]
+        return self.head + q + self.code + ' ' + self.area + ' ' + zone + ']'
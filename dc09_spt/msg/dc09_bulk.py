@@ -0,0 +1,107 @@
+# ----------------------------
+# Bulk encoding of DC09 blocks in a worker pool
+# (c 2018 van Ovost Automatisering b.v.
+# Author : Jacq. van Ovost
+# ----------------------------
+from dc09_spt.msg.dc09_msg import dc09_encoder
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+"""
+
+    Copyright (c) 2018  van Ovost Automatisering b.v.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    you may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# encoders of the worker, per (account, key, receiver, line, clock)
+_encoders = {}
+
+
+def _encode(params, items):
+    """
+    Encode a batch of (msg_nr, type, payload) items with the path parameters -params-
+    runs in a worker, returns the blocks as bytes in the order of -items-
+    """
+    encoder = _encoders.get(params)
+    if encoder is None:
+        if len(_encoders) > 64:
+            _encoders.clear()
+        encoder = dc09_encoder(*params[:4])
+        encoder.clock = params[4]
+        _encoders[params] = encoder
+    return [encoder.build(msg_nr, dc09type, payload) for msg_nr, dc09type, payload in items]
+
+
+class dc09_bulk:
+    """
+    Encode batches of DC09 blocks in a pool of worker processes or threads
+
+    Used by dc09_spt to encrypt a backlog of queued messages on more cores while
+    the blocks encoded before are being transmitted, see dc09_spt.set_bulk.
+
+    The worker processes are started with the spawn method, forking a dialler with running
+    threads can deadlock the children. Like with multiprocessing, create the encoder
+    under the if __name__ == '__main__' guard of the main module.
+
+    example
+        bulk = dc09_bulk(workers=4)
+        spt.set_bulk(bulk)
+    """
+
+    def __init__(self, workers=None, *, processes=True, batch=32, ahead=4, max_age=10.0):
+        """
+        Create a bulk encoder
+
+        parameters
+            workers
+                number of workers, the default is the number of processors
+            processes
+                when true the blocks are encoded in worker processes,
+                otherwise in threads (the AES encryption itself does not hold the GIL)
+            batch
+                number of messages per batch for paths without a window,
+                on a path with a window a batch is one window
+            ahead
+                maximum number of batches taken from the queue and encoded in advance
+            max_age
+                seconds an encoded block may wait for its transmission,
+                an older block is encoded again because its timestamp may be outside the window of the receiver
+        """
+        if processes:
+            self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dc09_bulk')
+        self.batch = batch
+        self.ahead = ahead
+        self.max_age = max_age
+
+    def encode(self, path, items):
+        """
+        Start encoding a batch of blocks for a path
+
+        parameters
+            path
+                the TransPath the blocks are for
+            items
+                list of (msg_nr, type, payload) tuples
+        return value
+            a future with the list of blocks as bytes, in the order of items
+        """
+        params = (path.get_account(), path.get_key(), path.get_receiver(), path.get_line(), path.get_clock())
+        return self.pool.submit(_encode, params, items)
+
+    def close(self):
+        """
+        Stop the workers
+        """
+        self.pool.shutdown(wait=True)
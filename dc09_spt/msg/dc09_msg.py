@@ -3,11 +3,98 @@
 # (c 2018 van Ovost Automatisering b.v.
 # Author : Jacq. van Ovost
 # ----------------------------
-import datetime
-import random
+import time
+import os
+import threading
+from dc09_spt import trace
+from dc09_spt.msg import dc09_time
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
 
+def _crc_table_init():
+    """
+    Build the 256 entry lookup table for the CRC16 (polynomial 0xA001) of SIA DC07
+    """
+    table = []
+    for i in range(0, 256):
+        crc = i
+        for j in range(0, 8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xa001
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+
+_crc_table = _crc_table_init()
+
+# ----------------------------
+# AES cipher objects per key, shared by all dc09_msg instances.
+# DC09 always uses an all zero IV so a Cipher can be reused for every block.
+# ----------------------------
+_cipher_cache = {}
+_cipher_lock = threading.Lock()
+
+
+def _cipher(key):
+    """
+    Return the cached AES CBC cipher for -key-, creating it on first use
+    """
+    cipher = _cipher_cache.get(key)
+    if cipher is None:
+        key = bytes(key)
+        _cipher_lock.acquire()
+        cipher = _cipher_cache.get(key)
+        if cipher is None:
+            cipher = Cipher(algorithms.AES(key), modes.CBC(bytes(16)))
+            _cipher_cache[key] = cipher
+        _cipher_lock.release()
+    return cipher
+
+
+_ecb_cache = {}
+
+
+def _ecb(key):
+    """
+    Return the cached AES ECB cipher for -key-, used to decrypt single CBC blocks
+    """
+    cipher = _ecb_cache.get(key)
+    if cipher is None:
+        key = bytes(key)
+        cipher = Cipher(algorithms.AES(key), modes.ECB())
+        _ecb_cache[key] = cipher
+    return cipher
+
+
+# ----------------------------
+# Random padding characters are taken from a pre-filled pool of random bytes
+# and mapped on the allowed character range (20 to 125 except [ ] and |)
+# ----------------------------
+_pad_chars = bytes(c for c in range(20, 126) if c not in b'[]|')
+_pad_table = bytes(_pad_chars[i % len(_pad_chars)] for i in range(0, 256))
+_pad_pool_size = 4096
+_pad_pool = b''
+_pad_pos = 0
+_pad_lock = threading.Lock()
+
+
+def _padding(length):
+    """
+    Return -length- random padding bytes
+    """
+    global _pad_pool, _pad_pos
+    _pad_lock.acquire()
+    if _pad_pos + length > len(_pad_pool):
+        _pad_pool = os.urandom(_pad_pool_size).translate(_pad_table)
+        _pad_pos = 0
+    ret = _pad_pool[_pad_pos:_pad_pos + length]
+    _pad_pos += length
+    _pad_lock.release()
+    return ret
+
+
 class dc09_msg:
     """
     SIA DC09 message block implementation
@@ -60,6 +147,8 @@ class dc09_msg:
         self.receiver = receiver
         self.line = line
         self.offset = offset
+        self.clock = dc09_time.clock(offset)
+        self.path = None
         if self.key is not None and len(self.key) != 16 and len(self.key) != 32:
             raise Exception('Keylength is {} but must be either 16 or 32'.format(len(key)))
     
@@ -67,38 +156,61 @@ class dc09_msg:
     def dc09crc(data):
         """
         Static method to calculate CRC16 According to SIA DC07
+
+        parameters
+            data
+                the block content as str, bytes, bytearray or memoryview
         """
-        def calc_crc(crc, debyte):
-            deze = ord(debyte)
-            for i in range(0, 8):
-                deze ^= crc & 1
-                crc >>= 1
-                if deze & 1:
-                    crc ^= 0xa001
-                deze >>= 1
-            return crc
+        if isinstance(data, str):
+            data = data.encode('latin-1')
+        table = _crc_table
         crc = 0
-        for j in range(0, len(data)):
-            crc = calc_crc(crc, data[j])
+        for debyte in data:
+            crc = (crc >> 8) ^ table[(crc ^ debyte) & 0xff]
         return crc
-        
+
+    @staticmethod
+    def dc09crc_many(frames):
+        """
+        Static method to check the CRC of a list of complete DC09 blocks in one call
+
+        parameters
+            frames
+                an iterable of blocks as constructed by dc09block or received as answer,
+                either str or bytes, including the leading LF and trailing CR
+        return value
+            a list with for each frame True if the CRC in the header matches the content
+        """
+        table = _crc_table
+        ret = []
+        for frame in frames:
+            if isinstance(frame, str):
+                frame = frame.encode('latin-1')
+            frame = memoryview(frame)
+            if len(frame) < 10:
+                ret.append(False)
+                continue
+            crc = 0
+            for debyte in frame[9:-1]:
+                crc = (crc >> 8) ^ table[(crc ^ debyte) & 0xff]
+            try:
+                ret.append(crc == int(bytes(frame[1:5]), 16))
+            except ValueError:
+                ret.append(False)
+        return ret
+
     def dc09crypt(self,  data):
         """
         Encrypt -data- with -key- in AES CBC mode
+
+        -data- can be a str or bytes, the plain text is built as bytes
         """
-        crypt = ''
+        if isinstance(data, str):
+            data = data.encode('ascii')
         pad = (len(data) + 21) % 16
-        for i in range(0, 17-pad):
-            rnd = '['
-            while rnd == '[' or rnd == ']' or rnd == '|':
-                rnd = chr(random.randint(20, 125))
-            crypt += rnd
-        now = datetime.datetime.utcnow()+datetime.timedelta(seconds=self.offset)
-        crypt += data + '_{:%H:%M:%S,%m-%d-%Y}'.format(now)
-        iv = 16 * chr(0)
-        cipher = Cipher(algorithms.AES(self.key), modes.CBC(bytes(iv, "ASCII")))
-        encryptor = cipher.encryptor()
-        return encryptor.update(bytes(crypt, "ASCII")) + encryptor.finalize()
+        crypt = b''.join((_padding(17-pad), data, b'_', dc09_time.stamp(self.clock)))
+        encryptor = _cipher(self.key).encryptor()
+        return encryptor.update(crypt) + encryptor.finalize()
 
     def dc09decrypt(self,  data):
         """
@@ -106,9 +218,7 @@ class dc09_msg:
         """
         if len(data) % 16 != 0:
             raise Exception('Data length not a multiple of 16')
-        iv = 16 * chr(0)
-        cipher = Cipher(algorithms.AES(self.key),modes.CBC(bytes(iv,"ASCII")))
-        decryptor = cipher.decryptor()
+        decryptor = _cipher(self.key).decryptor()
         return decryptor.update(data) + decryptor.finalize()
 
     def dc09block(self,  msg_nr=0,  dc09type="NULL",  msg="]"):   
@@ -131,6 +241,9 @@ class dc09_msg:
                 
                 the payload may be extended with the extra data constructed with dc09_extra
         """
+        hook = trace.hook
+        if hook is not None:
+            start = time.monotonic()
         if self.key is None:
             ret = '"' + dc09type + '"'
         else:
@@ -148,6 +261,8 @@ class dc09_msg:
                 msg = '|' + msg
             ret += self.dc09crypt(msg).hex().upper()
         ret = '\n' + '{0:04X}'.format(self.dc09crc(ret)) + '{0:04X}'.format(len(ret)) + ret + '\r'
+        if hook is not None:
+            trace.call(hook, 'encode', self.path, start, time.monotonic())
         return ret
 
     def dc09poll(self):
@@ -161,6 +276,15 @@ class dc09_msg:
         set the time offset in seconds for this receiver
         """
         self.offset = int(offset)
+        self.clock = dc09_time.clock(self.offset)
+
+    def set_clock(self, offset, clock):
+        """
+        set the time offset in seconds and the clock of this receiver as measured by the caller,
+        see msg.dc09_time.clock
+        """
+        self.offset = offset
+        self.clock = clock
 
     def dc09answer(self,  msg_nr,  answer):
         """
@@ -170,13 +294,40 @@ class dc09_msg:
             msg_nr  
                 the expected message number
             answer
-                the received answer block
+                the received answer block as str, bytes or memoryview
+        Return values
+            [0]
+                the answer ('ACK', 'NAK', 'DUH' or RSP')
+            [1]
+                the calculated time offset for this receiver in seconds
+        """
+        ret, offset, mnr = self.dc09answer_nr(answer)
+        if mnr != msg_nr and ret != 'NAK':
+            raise Exception("Invalid message number")
+        return ret, offset
+
+    def dc09answer_nr(self,  answer):
+        """
+        Check the validity of an answer block without expecting a message number
+
+        Used to match the answers to blocks sent in a window
+        The answer can be str, bytes or memoryview. Of an encrypted answer only the last
+        two cipher blocks, holding the timestamp, are decrypted.
         Return values
             [0]
                 the answer ('ACK', 'NAK', 'DUH' or RSP')
             [1]
                 the calculated time offset for this receiver in seconds
+            [2]
+                the message number in the answer
         """
+        hook = trace.hook
+        if hook is not None:
+            start = time.monotonic()
+        if isinstance(answer, str):
+            answer = answer.encode('latin-1')
+        else:
+            answer = bytes(answer)
         alen = len(answer)
         if alen < 10:
             raise Exception("Answer too short")
@@ -187,33 +338,52 @@ class dc09_msg:
         i = int(answer[1:5], 16)
         if crc != i:
             raise Exception("CRC of Answer incorrect")
-        if answer[10] == '*':
+        encrypted = answer[10] == 42
+        if encrypted:
             mnr = int(answer[15:19], 10)
-            ret = answer[11:14]
+            ret = answer[11:14].decode('ascii')
         else:
             mnr = int(answer[14:18], 10)
-            ret = answer[10:13]
-        if mnr != msg_nr and ret != 'NAK':
-            raise Exception("Invalid message number")
+            ret = answer[10:13].decode('ascii')
         offset = None
-        if answer[10] == '*':
-            bracket = answer.find('[')
-            ct = bytes.fromhex(answer[bracket+1:alen-1])
-            answer = self.dc09decrypt(ct)
-            answer = answer[-21:].decode()
+        if encrypted:
+            bracket = answer.find(b'[')
+            if (alen - 2 - bracket) % 32 != 0:
+                raise Exception('Data length not a multiple of 16')
+            # the timestamp is in the last two blocks, the block before them is their IV
+            first = max(bracket + 1, alen - 1 - 96)
+            answer = self.dc09decrypt_tail(bytes.fromhex(answer[first:alen-1].decode('ascii')))
         tm = None
-        if len(answer) > 22 and answer[-22:-20] == ']_':
+        if len(answer) > 22 and answer[-22:-20] == b']_':
             tm = answer[-20:-1]
-        if len(answer) > 20 and answer[-21:-19] == ']_':
+        if len(answer) > 20 and answer[-21:-19] == b']_':
             tm = answer[-19:]
         if tm is not None:
-            now = datetime.datetime.utcnow()
             try:
-                receivertime = datetime.datetime.strptime(tm, "%H:%M:%S,%m-%d-%Y")
-                offset = (receivertime-now).total_seconds()
-            except:
-                raise Exception("Invalid time string ({0})".format(tm))
-        return ret, offset
+                offset = dc09_time.parse(tm) - time.time()
+            except ValueError:
+                raise Exception("Invalid time string ({0})".format(tm.decode('latin-1')))
+        if hook is not None:
+            trace.call(hook, 'decode', self.path, start, time.monotonic())
+        return ret, offset, mnr
+
+    def dc09decrypt_tail(self,  data):
+        """
+        Decrypt the last two blocks of -data- with -key- in AES CBC mode
+
+        -data- is the end of the cipher text, if it is longer than two blocks
+        the block in front of the last two is used as IV
+        """
+        if len(data) % 16 != 0:
+            raise Exception('Data length not a multiple of 16')
+        if len(data) <= 32:
+            return self.dc09decrypt(data)
+        iv = data[-48:-32]
+        data = data[-32:]
+        decryptor = _ecb(self.key).decryptor()
+        plain = decryptor.update(data) + decryptor.finalize()
+        chain = iv + data[:-16]
+        return (int.from_bytes(plain, 'big') ^ int.from_bytes(chain, 'big')).to_bytes(len(plain), 'big')
 
     @staticmethod
     def dc09_extra(params={}):   
@@ -242,3 +412,78 @@ class dc09_msg:
             extra += '[M' + params['mac'] + ']'
         if 'verification' in params:
             extra += '[V' + params['verification'] + ']'
+
+
+class dc09_encoder(dc09_msg):
+    """
+    DC09 block encoder for one transmission path
+
+    The static parts of the block header (type, receiver, line and account) are formatted once
+    and kept as bytes. Unencrypted blocks, like the polls, are complete after formatting
+    and are cached so a retransmission or the next poll reuses the encoded block.
+    Encrypted blocks contain a timestamp and random padding and are built for every call.
+
+    An encoder is bound to the account, key, receiver and line it is created with,
+    the time offset only changes the timestamp and is updated in place, see TransPath.get_encoder.
+    """
+    cache_size = 256
+
+    def __init__(self, account,  key=None,  receiver=None,  line=None, offset=0):
+        dc09_msg.__init__(self, account, key, receiver, line, offset)
+        suffix = ''
+        if self.receiver is not None:
+            suffix += 'R{0:X}'.format(self.receiver)
+        if self.line is not None:
+            suffix += 'L{0:X}'.format(self.line)
+        suffix += '#' + self.account + '['
+        self.suffix = suffix.encode('ascii')
+        self.prefixes = {}
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+
+    def prefix(self, dc09type):
+        """
+        Return the header part in front of the message number for -dc09type-
+        """
+        ret = self.prefixes.get(dc09type)
+        if ret is None:
+            if self.key is None:
+                ret = ('"' + dc09type + '"').encode('ascii')
+            else:
+                ret = ('"*' + dc09type + '"').encode('ascii')
+            self.prefixes[dc09type] = ret
+        return ret
+
+    def block(self, msg_nr=0, dc09type="NULL", msg="]"):
+        """
+        Construct a DC09 message block as bytes, see dc09block for the parameters
+        """
+        if self.key is not None:
+            return self.build(msg_nr, dc09type, msg)
+        ident = (msg_nr, dc09type, msg)
+        ret = self.cache.get(ident)
+        if ret is None:
+            ret = self.build(msg_nr, dc09type, msg)
+            self.cache_lock.acquire()
+            if len(self.cache) >= self.cache_size:
+                self.cache.pop(next(iter(self.cache)))
+            self.cache[ident] = ret
+            self.cache_lock.release()
+        return ret
+
+    def build(self, msg_nr, dc09type, msg):
+        hook = trace.hook
+        if hook is not None:
+            start = time.monotonic()
+        if isinstance(msg, str):
+            msg = msg.encode('latin-1')
+        if self.key is not None:
+            msg = self.dc09crypt(b'|' + msg).hex().upper().encode('ascii')
+        body = b''.join((self.prefix(dc09type), b'%04d' % msg_nr, self.suffix, msg))
+        ret = b'\n%04X%04X' % (self.dc09crc(body), len(body)) + body + b'\r'
+        if hook is not None:
+            trace.call(hook, 'encode', self.path, start, time.monotonic())
+        return ret
+
+    def dc09block(self,  msg_nr=0,  dc09type="NULL",  msg="]"):
+        return self.block(msg_nr, dc09type, msg).decode('latin-1')
@@ -0,0 +1,118 @@
+# ----------------------------
+# DC09 timestamp codec
+# (c 2018 van Ovost Automatisering b.v.
+# Author : Jacq. van Ovost
+# ----------------------------
+import time
+"""
+
+    Copyright (c) 2018  van Ovost Automatisering b.v.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    you may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    The timestamp of an encrypted DC09 block is the UTC time as HH:MM:SS,MM-DD-YYYY.
+
+    The clock of a receiver is kept as an offset to time.monotonic (see clock),
+    so the timestamps sent to it stay correct when the system clock is adjusted.
+    Without a measured offset the system clock is used.
+"""
+
+# formatted timestamps per second since the epoch and the reverse
+_stamps = {}
+_parsed = {}
+_days_before_month = (0, 0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334)
+_days_in_month = (0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+
+def format_stamp(seconds):
+    """
+    Returns the DC09 timestamp of -seconds- since the epoch as bytes
+    the result is cached per second
+    """
+    seconds = int(seconds)
+    ret = _stamps.get(seconds)
+    if ret is None:
+        tm = time.gmtime(seconds)
+        ret = b'%02d:%02d:%02d,%02d-%02d-%04d' % (tm.tm_hour, tm.tm_min, tm.tm_sec, tm.tm_mon, tm.tm_mday,
+                                                  tm.tm_year)
+        if len(_stamps) >= 64:
+            _stamps.clear()
+        _stamps[seconds] = ret
+    return ret
+
+
+def parse(stamp):
+    """
+    Convert a DC09 timestamp (HH:MM:SS,MM-DD-YYYY as bytes or str) to seconds since the epoch
+    the result is cached per timestamp
+
+    exceptions
+        ValueError when stamp is not a valid timestamp
+    """
+    if isinstance(stamp, str):
+        stamp = stamp.encode('latin-1')
+    else:
+        stamp = bytes(stamp)
+    ret = _parsed.get(stamp)
+    if ret is None:
+        ret = _parse(stamp)
+        if len(_parsed) >= 64:
+            _parsed.clear()
+        _parsed[stamp] = ret
+    return ret
+
+
+def _parse(stamp):
+    digits = stamp.translate(None, b':,-')
+    if len(stamp) != 19 or stamp[2] != 58 or stamp[5] != 58 or stamp[8] != 44 or stamp[11] != 45 \
+            or stamp[14] != 45 or len(digits) != 14 or not digits.isdigit():
+        raise ValueError('Invalid time string ({0})'.format(stamp))
+    d = [c - 48 for c in stamp]
+    hour = d[0] * 10 + d[1]
+    minute = d[3] * 10 + d[4]
+    second = d[6] * 10 + d[7]
+    month = d[9] * 10 + d[10]
+    day = d[12] * 10 + d[13]
+    year = d[15] * 1000 + d[16] * 100 + d[17] * 10 + d[18]
+    leap = year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+    if hour > 23 or minute > 59 or second > 61 or month < 1 or month > 12 or day < 1 \
+            or day > _days_in_month[month] or (month == 2 and day == 29 and not leap):
+        raise ValueError('Invalid time string ({0})'.format(stamp))
+    # days since 1-1-1970
+    y = year - 1
+    days = y * 365 + y // 4 - y // 100 + y // 400 - 719162 + _days_before_month[month] + day - 1
+    if month > 2 and leap:
+        days += 1
+    return ((days * 24 + hour) * 60 + minute) * 60 + second
+
+
+def clock(offset):
+    """
+    Returns the monotonic clock of a receiver that is -offset- seconds ahead of the system clock now,
+    None when offset is 0 (the system clock is used)
+
+    note
+        call it when the offset is measured, the result no longer depends on the system clock
+    """
+    if not offset:
+        return None
+    return offset + time.time() - time.monotonic()
+
+
+def stamp(clock=None):
+    """
+    Returns the current DC09 timestamp as bytes of a receiver clock (see clock) or of the system clock
+    """
+    if clock is None:
+        return format_stamp(time.time())
+    return format_stamp(time.monotonic() + clock)
@@ -0,0 +1,434 @@
+# ----------------------------
+# Message queues for the dialler
+# (c 2018 van Ovost Automatisering b.v.
+# Author : Jacq. van Ovost
+# ----------------------------
+import os
+import time
+import heapq
+import mmap
+import struct
+import zlib
+import threading
+import logging
+from collections import deque
+"""
+
+    Copyright (c) 2018  van Ovost Automatisering b.v.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    you may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+
+# ----------------------------
+# EN 50136-1 transmission time classes, maximum transmission time in seconds
+# ----------------------------
+transmission_classes = {'D1': 240, 'D2': 120, 'D3': 60, 'D4': 20}
+
+
+class queued_msg:
+    """
+    A message in a send queue
+
+    the payload is kept encoded as bytes, message returns it as string
+    """
+    __slots__ = ('msg_nr', 'mtype', 'payload', 'deadline', 'seq', 'ref', 'queued')
+
+    def __init__(self, msg_nr, mtype, payload, deadline=None, ref=None):
+        self.msg_nr = msg_nr
+        self.mtype = mtype
+        if isinstance(payload, str):
+            payload = payload.encode('latin-1')
+        self.payload = payload
+        self.deadline = deadline
+        self.seq = 0
+        self.ref = ref
+        self.queued = time.monotonic()
+
+    @property
+    def message(self):
+        return self.payload.decode('latin-1')
+
+    def size(self):
+        return len(self.payload)
+
+    def __repr__(self):
+        return 'queued_msg({}, {}, {})'.format(self.msg_nr, self.mtype, self.payload)
+
+
+class msg_queue(deque):
+    """
+    In memory send queue of a dialler
+
+    The entries are queued_msg records.
+    Besides the deque methods the queue has the hooks used by other queues:
+        push
+            queue a message, a plain queue ignores its deadline
+        commit
+            called after queueing and when the sender is idle, outside the queue lock,
+            returns when the queued messages and the acknowledgements are stored
+        ack
+            called with the entry when a message is delivered
+        drop_last
+            remove and return the message that would be sent last
+        oldest
+            the time.monotonic() value the oldest message was queued, or None
+    except commit they are called with the queuelock of the dialler held, like the deque methods
+    """
+    breaches = 0
+
+    def push(self, mess):
+        self.append(mess)
+
+    def commit(self):
+        pass
+
+    def ack(self, mess):
+        pass
+
+    def drop_last(self):
+        return self.pop()
+
+    def oldest(self):
+        if len(self) == 0:
+            return None
+        return self[0].queued
+
+
+class priority_queue:
+    """
+    In memory send queue that sends the most urgent message first (earliest deadline first)
+
+    Messages are queued with a deadline, an absolute time.monotonic() value, usually derived from
+    an EN 50136-1 transmission class with dc09_spt.send_msg(..., tclass='D4').
+    Messages without a deadline are sent after all messages with one, in the order they are queued.
+    A message delivered after its deadline is counted in breaches and logged.
+
+    example
+        spt = dc09_spt("0123", queue=priority_queue())
+        spt.send_msg('SIA-DCS', {'code': 'BA', 'zone': 3}, tclass='D4')
+    """
+    def __init__(self):
+        self.heap = []
+        self.seq = 0
+        self.breaches = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __iter__(self):
+        return iter([entry[2] for entry in sorted(self.heap)])
+
+    def push(self, mess):
+        self.seq += 1
+        mess.seq = self.seq
+        heapq.heappush(self.heap, (self.key(mess), mess.seq, mess))
+
+    @staticmethod
+    def key(mess):
+        if mess.deadline is None:
+            return float('inf')
+        return mess.deadline
+
+    def append(self, mess):
+        self.push(mess)
+
+    def extend(self, messages):
+        for mess in messages:
+            self.push(mess)
+
+    def popleft(self):
+        return heapq.heappop(self.heap)[2]
+
+    def appendleft(self, mess):
+        """
+        Put a message that could not be sent back with its original deadline and order
+        """
+        heapq.heappush(self.heap, (self.key(mess), mess.seq, mess))
+
+    def drop_last(self):
+        last = max(range(len(self.heap)), key=lambda i: self.heap[i][0:2])
+        mess = self.heap[last][2]
+        self.heap[last] = self.heap[-1]
+        self.heap.pop()
+        heapq.heapify(self.heap)
+        return mess
+
+    def commit(self):
+        pass
+
+    def oldest(self):
+        if len(self.heap) == 0:
+            return None
+        return min([entry[2].queued for entry in self.heap])
+
+    def ack(self, mess):
+        if mess.deadline is not None and time.monotonic() > mess.deadline:
+            self.breaches += 1
+            logging.warning('Message nr %s delivered %.1f seconds after its deadline', mess.msg_nr,
+                            time.monotonic() - mess.deadline)
+
+
+class _segment:
+    """
+    One segment file of the persistent queue with its memory mapped acknowledge bitmap
+    """
+    def __init__(self, directory, first, max_records):
+        self.first = first
+        self.max_records = max_records
+        self.log_name = os.path.join(directory, 'seg-{0:016d}.log'.format(first))
+        self.ack_name = os.path.join(directory, 'seg-{0:016d}.ack'.format(first))
+        self.fd = os.open(self.log_name, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        size = (max_records + 7) // 8
+        afd = os.open(self.ack_name, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(afd).st_size < size:
+            os.ftruncate(afd, size)
+        self.acks = mmap.mmap(afd, size)
+        os.close(afd)
+        self.count = 0
+        self.acked = 0
+        # acknowledgements not yet flushed to disk
+        self.dirty = False
+
+    def is_acked(self, idx):
+        return self.acks[idx >> 3] & (1 << (idx & 7)) != 0
+
+    def set_acked(self, idx):
+        if not self.is_acked(idx):
+            self.acks[idx >> 3] |= 1 << (idx & 7)
+            self.acked += 1
+            self.dirty = True
+
+    def full(self):
+        return self.count >= self.max_records
+
+    def remove(self):
+        os.close(self.fd)
+        self.acks.close()
+        os.remove(self.log_name)
+        os.remove(self.ack_name)
+
+
+class persistent_queue(msg_queue):
+    """
+    Send queue of a dialler that survives a restart
+
+    Queued messages are appended to a log of segment files in -directory-.
+    The writes are synced to disk in groups: every commit waits for one fsync that covers
+    all messages written until then, so many messages queued at the same time share one fsync.
+    Delivered messages are marked in a memory mapped bitmap per segment.
+    A segment is removed as soon as it is full and all of its messages are delivered.
+
+    Messages that are not acknowledged when the dialler stops are queued again on opening.
+    The delivery is at least once, a message may be sent again after a restart:
+    the acknowledgements are flushed to disk by commit, after a crash the messages
+    delivered since the last commit are sent again.
+
+    example
+        spt = dc09_spt("0123", queue=persistent_queue("/var/lib/dialler/0123"))
+    """
+    _header = struct.Struct('<II')
+    _nr = struct.Struct('<H')
+
+    def __init__(self, directory, segment_records=4096):
+        """
+        Open or create a persistent queue
+
+        parameters
+            directory
+                directory for the segment files, it is created if needed
+            segment_records
+                number of messages per segment file
+        """
+        msg_queue.__init__(self)
+        self.directory = directory
+        self.segment_records = segment_records
+        self.segments = {}
+        self.current = None
+        self.lock = threading.Lock()
+        self.sync_cond = threading.Condition()
+        self.written = 0
+        self.synced = 0
+        self.syncing = False
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+
+    def recover(self):
+        """
+        Load the messages that are not acknowledged from the segment files
+        """
+        firsts = sorted(int(name[4:20]) for name in os.listdir(self.directory)
+                        if name.startswith('seg-') and name.endswith('.log'))
+        for first in firsts:
+            seg = _segment(self.directory, first, self.segment_records)
+            self.segments[first] = seg
+            with open(seg.log_name, 'rb') as f:
+                data = f.read()
+            pos = 0
+            while pos + self._header.size <= len(data) and seg.count < seg.max_records:
+                length, crc = self._header.unpack_from(data, pos)
+                record = data[pos + self._header.size:pos + self._header.size + length]
+                if len(record) != length or zlib.crc32(record) != crc:
+                    break
+                pos += self._header.size + length
+                if seg.is_acked(seg.count):
+                    seg.acked += 1
+                else:
+                    deque.append(self, self.decode(record, (first, seg.count)))
+                seg.count += 1
+            if pos != len(data):
+                logging.warning('Persistent queue segment %s truncated at %s', seg.log_name, pos)
+                os.ftruncate(seg.fd, pos)
+            self.current = seg
+        for seg in list(self.segments.values()):
+            if seg is not self.current and seg.acked == seg.count:
+                self.drop(seg)
+        if self.current is None or self.current.full():
+            self.new_segment()
+
+    def new_segment(self):
+        old = self.current
+        if old is None:
+            first = 0
+        else:
+            first = old.first + old.count
+        self.current = _segment(self.directory, first, self.segment_records)
+        self.segments[first] = self.current
+        if old is not None and old.acked == old.count:
+            self.drop(old)
+        dfd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dfd)
+        except OSError:
+            pass
+        os.close(dfd)
+
+    def drop(self, seg):
+        del self.segments[seg.first]
+        seg.remove()
+
+    @classmethod
+    def encode(cls, mess):
+        return cls._nr.pack(mess.msg_nr) + mess.mtype.encode('ascii') + b'\0' + mess.payload
+
+    @classmethod
+    def decode(cls, record, ref):
+        nr = cls._nr.unpack_from(record)[0]
+        mtype, payload = record[cls._nr.size:].split(b'\0', 1)
+        return queued_msg(nr, mtype.decode('ascii'), payload, ref=ref)
+
+    def write(self, mess):
+        # write one record (without sync) and set its reference
+        self.lock.acquire()
+        if self.current.full():
+            self.new_segment()
+        seg = self.current
+        record = self.encode(mess)
+        os.write(seg.fd, self._header.pack(len(record), zlib.crc32(record)) + record)
+        mess.ref = seg.first, seg.count
+        seg.count += 1
+        self.written += 1
+        self.lock.release()
+        return mess
+
+    def append(self, mess):
+        """
+        Queue a message at the end and write it to the log, call commit to make it durable
+        """
+        deque.append(self, self.write(mess))
+
+    def drop_last(self):
+        mess = self.pop()
+        self.ack(mess)
+        return mess
+
+    def extend(self, messages):
+        for mess in messages:
+            self.append(mess)
+
+    def commit(self):
+        """
+        Wait until all messages written so far are synced to disk and flush the acknowledgements
+        one caller syncs for all that are waiting
+
+        exceptions
+            OSError when the segments can not be synced, the messages are not durable then
+        """
+        self.sync_cond.acquire()
+        target = self.written
+        while self.synced < target:
+            if self.syncing:
+                self.sync_cond.wait()
+                continue
+            self.syncing = True
+            upto = self.written
+            self.sync_cond.release()
+            error = None
+            try:
+                # hold the lock, ack and drop_last may remove a segment and close its file
+                self.lock.acquire()
+                try:
+                    for seg in self.segments.values():
+                        if seg.count > seg.acked:
+                            os.fsync(seg.fd)
+                finally:
+                    self.lock.release()
+            except OSError as e:
+                logging.error('Persistent queue sync exception %s', e)
+                error = e
+            finally:
+                self.sync_cond.acquire()
+                self.syncing = False
+                if error is None:
+                    self.synced = max(self.synced, upto)
+                self.sync_cond.notify_all()
+            if error is not None:
+                self.sync_cond.release()
+                raise error
+        self.sync_cond.release()
+        self.lock.acquire()
+        try:
+            for seg in self.segments.values():
+                if seg.dirty:
+                    seg.dirty = False
+                    seg.acks.flush()
+        finally:
+            self.lock.release()
+
+    def ack(self, mess):
+        """
+        Mark a delivered message, removes its segment when that is completely delivered
+        """
+        if mess.ref is None:
+            return
+        first, idx = mess.ref
+        self.lock.acquire()
+        seg = self.segments.get(first)
+        if seg is not None:
+            seg.set_acked(idx)
+            if seg is not self.current and seg.acked == seg.count:
+                self.drop(seg)
+        self.lock.release()
+
+    def close(self):
+        """
+        Sync and close the segment files
+        """
+        self.commit()
+        self.lock.acquire()
+        for seg in self.segments.values():
+            seg.acks.flush()
+            os.close(seg.fd)
+            seg.acks.close()
+        self.segments = {}
+        self.lock.release()
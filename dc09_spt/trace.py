@@ -0,0 +1,80 @@
+# ----------------------------
+# Tracing hook for the phases of a transfer
+# (c 2018 van Ovost Automatisering b.v.
+# Author : Jacq. van Ovost
+# ----------------------------
+"""
+
+    Copyright (c) 2018  van Ovost Automatisering b.v.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    you may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    When a hook is set it is called after every traced phase as
+        hook(phase, path, start, end)
+    where start and end are time.monotonic() values and path is the TransPath,
+    or None when a block is encoded or decoded outside a path.
+
+    phases
+        transfer
+            dc09_spt.transfer_msg, a complete transfer of one message over one path
+        encode
+            building a block (dc09_msg.dc09block or a block encoder)
+        resolve
+            looking up the addresses of a receiver (comm.resolver), only when they are not cached
+        connect
+            TransPath.connect, includes waiting for a kept alive connection and the name lookup
+        exchange
+            sending a block and waiting for the answer (TransPathTCP, TransPathUDP and TransPathAIO)
+        resend
+            sending a block again after a NAK and waiting for the answer
+        decode
+            checking an answer (dc09_msg.dc09answer)
+
+    Without a hook every traced phase only costs a test of trace.hook.
+    The hook is called in the thread (or event loop) doing the transfer and should return quickly,
+    an exception raised by the hook is logged and does not disturb the transfer.
+
+    example
+        def span(phase, path, start, end):
+            print(phase, path.host if path is not None else '-', round((end - start) * 1000, 3), 'ms')
+
+        trace.set_hook(span)
+"""
+import logging
+
+hook = None
+
+
+def set_hook(fn):
+    """
+    Set the tracing hook, None switches tracing off
+    """
+    global hook
+    hook = fn
+
+
+def get_hook():
+    """
+    Returns the current tracing hook or None
+    """
+    return hook
+
+
+def call(fn, phase, path, start, end):
+    """
+    Call the hook -fn- of a traced phase, exceptions of the hook are logged
+    """
+    try:
+        fn(phase, path, start, end)
+    except Exception as e:
+        logging.error('Trace hook exception in phase %s: %s', phase, repr(e))
@@ -0,0 +1,218 @@
+# ----------------------------
+# Loopback benchmark of the dialler
+# (c 2018 van Ovost Automatisering b.v.
+# Author : Jacq. van Ovost
+# ----------------------------
+import sys
+sys.path.append('../')
+import argparse
+import asyncio
+import json
+import platform
+import threading
+import time
+from dc09_spt import dc09_spt
+from dc09_spt.dc09_receiver import dc09_receiver
+
+"""
+    Copyright (c) 2018  van Ovost Automatisering b.v.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    you may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Runs dc09_spt against dc09_receiver over loopback and reports per scenario
+        msgs_per_s          throughput of a burst of queued messages
+        latency_p50/p99/p999_ms
+                            delivery latency (queued to received) of messages sent one at a time
+        cpu_us_per_msg      process CPU time per message of the burst, the receiver included
+        failover_s          time from stopping the primary receiver until the next message
+                            arrives at the secondary receiver (failover scenarios only)
+
+    usage
+        python benchmark.py [--count 2000] [--latency 1000] [--only tcp] [--json results.json]
+"""
+
+key16 = b"\x12\x34\x56\x78\x90\x12\x34\x56\x78\x90\x12\x34\x56\x78\x90\x12"
+key32 = key16 * 2
+
+# name, type, key, keepalive, window, number of receivers, failover
+scenarios = [
+    ('tcp-plain', 'tcp', None, False, 1, 1, False),
+    ('tcp-aes128', 'tcp', key16, False, 1, 1, False),
+    ('tcp-aes256', 'tcp', key32, False, 1, 1, False),
+    ('tcp-keepalive', 'tcp', None, True, 1, 1, False),
+    ('tcp-window8', 'tcp', key16, True, 8, 1, False),
+    ('udp-plain', 'udp', None, False, 1, 1, False),
+    ('udp-aes128', 'udp', key16, False, 1, 1, False),
+    ('udp-aes256', 'udp', key32, False, 1, 1, False),
+    ('tcp-2paths', 'tcp', key16, False, 1, 2, False),
+    ('tcp-failover', 'tcp', key16, False, 1, 2, True),
+    ('udp-failover', 'udp', key16, False, 1, 2, True),
+]
+
+
+class loopback:
+    """
+    Receivers in an event loop of their own thread, records the arrival time of every message
+    """
+    def __init__(self, account, key, count):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.arrived = {}
+        self.done = threading.Event()
+        self.expect = 0
+        # message numbers wrap at 9999, the wraps are counted to tell the messages apart
+        self.last = 0
+        self.wraps = 0
+        keys = {} if key is None else {account: key}
+        self.receivers = [dc09_receiver(keys, self.event) for x in range(count)]
+        self.ports = []
+        for rcv in self.receivers:
+            self.call(rcv.start('127.0.0.1', 0))
+            self.ports.append(rcv.ports()[0][1])
+
+    def call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def event(self, account, mtype, msg_nr, msg):
+        if mtype == 'NULL':
+            return
+        wraps = self.wraps
+        if msg_nr < self.last - 5000:
+            # the numbers started again at 1
+            wraps += 1
+            self.wraps = wraps
+        elif msg_nr > self.last + 5000:
+            # a late copy of a message from before the wrap
+            wraps -= 1
+        if wraps == self.wraps:
+            self.last = msg_nr
+        ident = (account, wraps, msg_nr)
+        if ident not in self.arrived:
+            self.arrived[ident] = time.perf_counter()
+            if len(self.arrived) >= self.expect:
+                self.done.set()
+
+    def wait(self, expect, timeout):
+        self.expect = expect
+        if len(self.arrived) >= expect:
+            return True
+        return self.done.wait(timeout)
+
+    def reset(self):
+        self.arrived = {}
+        self.done.clear()
+
+    def kill(self, idx):
+        self.loop.call_soon_threadsafe(self.receivers[idx].close)
+
+    def close(self):
+        for idx in range(len(self.receivers)):
+            self.kill(idx)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def percentile(values, pct):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run(name, ptype, key, keepalive, window, receivers, failover, count, samples, timeout):
+    account = '1234'
+    rcv = loopback(account, key, receivers)
+    spt = dc09_spt.dc09_spt(account)
+    for ps, port in zip(('primary', 'secondary'), rcv.ports):
+        spt.set_path('main', ps, '127.0.0.1', port, account=account, key=key, type=ptype, keepalive=keepalive,
+                     window=window)
+    ret = {'scenario': name, 'type': ptype, 'key_bits': 0 if key is None else len(key) * 8,
+           'keepalive': keepalive, 'window': window, 'paths': receivers}
+    # warm up, also marks the first path as known good
+    spt.send_msg('SIA-DCS', {'code': 'RP', 'zone': 99})
+    rcv.wait(1, timeout)
+    rcv.reset()
+    # throughput
+    cpu = time.process_time()
+    start = time.perf_counter()
+    queued = spt.send_msgs([('SIA-DCS', {'code': 'BA', 'zone': x % 999 + 1}) for x in range(count)])
+    ok = rcv.wait(len([nr for nr in queued if nr is not None]), timeout)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    ret['messages'] = len(rcv.arrived)
+    ret['complete'] = ok
+    ret['seconds'] = round(elapsed, 4)
+    ret['msgs_per_s'] = round(len(rcv.arrived) / elapsed, 1)
+    ret['cpu_us_per_msg'] = round(cpu * 1e6 / max(1, len(rcv.arrived)), 1)
+    # latency, one message at a time
+    latencies = []
+    for x in range(samples):
+        rcv.reset()
+        sent = time.perf_counter()
+        spt.send_msg('SIA-DCS', {'code': 'BA', 'zone': x % 999 + 1})
+        if not rcv.wait(1, timeout):
+            break
+        latencies.append(min(rcv.arrived.values()) - sent)
+    for pct in (50, 99, 99.9):
+        value = percentile(latencies, pct)
+        ret['latency_p{}_ms'.format(str(pct).replace('.', ''))] = None if value is None else round(value * 1000, 3)
+    # failover, stop the primary receiver and send one message
+    if failover:
+        rcv.kill(0)
+        time.sleep(0.1)
+        rcv.reset()
+        killed = time.perf_counter()
+        spt.send_msg('SIA-DCS', {'code': 'BA', 'zone': 1})
+        if rcv.wait(1, timeout):
+            ret['failover_s'] = round(min(rcv.arrived.values()) - killed, 4)
+        else:
+            ret['failover_s'] = None
+    spt.stop_send()
+    for ps in ('primary', 'secondary'):
+        spt.del_path('main', ps)
+    rcv.close()
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Loopback benchmark of dc09_spt')
+    parser.add_argument('--count', type=int, default=2000, help='messages in the throughput burst')
+    parser.add_argument('--latency', type=int, default=1000, help='messages sent one at a time for the latency')
+    parser.add_argument('--timeout', type=float, default=60.0, help='maximum seconds to wait for a phase')
+    parser.add_argument('--only', default=None, help='run the scenarios with this text in their name')
+    parser.add_argument('--json', default=None, help='write the results to this file, - for stdout')
+    args = parser.parse_args()
+    results = []
+    for scenario in scenarios:
+        if args.only is not None and args.only not in scenario[0]:
+            continue
+        res = run(*scenario, args.count, args.latency, args.timeout)
+        results.append(res)
+        if args.json != '-':
+            print('{scenario:14} {msgs_per_s:>10} msg/s  p50 {latency_p50_ms} ms  p99 {latency_p99_ms} ms  '
+                  'p999 {latency_p999_ms} ms  cpu {cpu_us_per_msg} us/msg'.format(**res)
+                  + ('  failover {} s'.format(res['failover_s']) if 'failover_s' in res else ''))
+    report = {'python': platform.python_version(), 'implementation': platform.python_implementation(),
+              'machine': platform.machine(), 'system': platform.system(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+              'count': args.count, 'latency_samples': args.latency, 'results': results}
+    if args.json == '-':
+        print(json.dumps(report, indent=2))
+    elif args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
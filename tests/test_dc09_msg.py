@@ -0,0 +1,44 @@
+# ----------------------------
+# Tests of the DC09 block codec
+# (c 2018 van Ovost Automatisering b.v.
+# Author : Jacq. van Ovost
+# ----------------------------
+import os
+import unittest
+from dc09_spt.msg.dc09_msg import dc09_msg
+from dc09_spt.dc09_receiver import dc09_receiver
+
+key16 = b"\x12\x34\x56\x78\x90\x12\x34\x56\x78\x90\x12\x34\x56\x78\x90\x12"
+key32 = key16 * 2
+
+
+class test_decrypt_tail(unittest.TestCase):
+    def test_tail_equals_full_decryption(self):
+        for key in (key16, key32):
+            dc09 = dc09_msg('1234', key)
+            for length in range(0, 200, 7):
+                crypt = dc09.dc09crypt(os.urandom(length))
+                plain = dc09.dc09decrypt(crypt)
+                tail = dc09.dc09decrypt_tail(crypt)
+                self.assertEqual(tail[-32:], plain[-32:])
+                # only the end of the cipher text is needed
+                self.assertEqual(dc09.dc09decrypt_tail(crypt[-48:])[-32:], plain[-32:])
+
+    def test_wrong_length(self):
+        dc09 = dc09_msg('1234', key16)
+        with self.assertRaises(Exception):
+            dc09.dc09decrypt_tail(b'\0' * 40)
+
+    def test_answer_timestamp(self):
+        rcv = dc09_receiver({'1234': key16})
+        dc09 = dc09_msg('1234', key16)
+        for res in ('ACK', 'DUH'):
+            answer = rcv.answer(res, b'0042', b'L0#1234', key16)
+            ret = dc09.dc09answer_nr(answer)
+            self.assertEqual(ret[0], res)
+            self.assertEqual(ret[2], 42)
+            self.assertLessEqual(abs(ret[1]), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
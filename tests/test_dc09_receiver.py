@@ -0,0 +1,100 @@
+# ----------------------------
+# Tests of the receiver
+# (c 2018 van Ovost Automatisering b.v.
+# Author : Jacq. van Ovost
+# ----------------------------
+import unittest
+from dc09_spt.msg.dc09_msg import dc09_encoder
+from dc09_spt.dc09_receiver import dc09_receiver
+
+key16 = b"\x12\x34\x56\x78\x90\x12\x34\x56\x78\x90\x12\x34\x56\x78\x90\x12"
+
+
+class test_receiver(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        self.result = None
+        self.rcv = dc09_receiver({'5678': key16}, self.event)
+        self.plain = dc09_encoder('1234', receiver=1, line=2)
+        self.crypt = dc09_encoder('5678', key16)
+
+    def event(self, account, mtype, msg_nr, msg):
+        self.events.append((account, mtype, msg_nr, msg))
+        return self.result
+
+    def answers(self, data, encoder=None):
+        """
+        Feed -data- and return the decoded answers (answer, offset, message number) and the rest
+        """
+        answers, rest = self.rcv.feed(data)
+        ret = []
+        while len(answers):
+            end = answers.index(b'\r') + 1
+            ret.append((encoder or self.plain).dc09answer_nr(answers[:end]))
+            answers = answers[end:]
+        return ret, rest
+
+    def test_blocks_and_partial_block(self):
+        blocks = [self.plain.block(nr, 'SIA-DCS', '#1234|NBA{}]'.format(nr)) for nr in (1, 2, 3)]
+        data = b''.join(blocks)
+        ret, rest = self.answers(b'noise' + data[:-10])
+        self.assertEqual([(res, nr) for res, offset, nr in ret], [('ACK', 1), ('ACK', 2)])
+        self.assertEqual(rest, blocks[2][:-10])
+        ret, rest = self.answers(rest + data[-10:])
+        self.assertEqual([(res, nr) for res, offset, nr in ret], [('ACK', 3)])
+        self.assertEqual(rest, b'')
+        self.assertEqual(self.events[0], ('1234', 'SIA-DCS', 1, '#1234|NBA1]'))
+        self.assertEqual(len(self.events), 3)
+
+    def test_answer_header(self):
+        answers, rest = self.rcv.feed(self.plain.block(7, 'NULL', ']') * 2)
+        body = b'"ACK"0007R1L2#1234[]'
+        self.assertEqual(answers, (b'\n%04X%04X' % (self.plain.dc09crc(body), len(body)) + body + b'\r') * 2)
+
+    def test_wrong_crc_or_length(self):
+        block = bytearray(self.plain.block(1, 'SIA-DCS', '#1234|NBA]'))
+        block[-3] ^= 1
+        ret, rest = self.answers(bytes(block))
+        self.assertEqual(ret, [])
+        block = self.plain.block(2, 'SIA-DCS', '#1234|NBA]')
+        short = block[:5] + b'%04X' % (int(block[5:9], 16) - 1) + block[9:]
+        ret, rest = self.answers(short + self.plain.block(3, 'SIA-DCS', '#1234|NBA]'))
+        self.assertEqual([nr for res, offset, nr in ret], [3])
+        self.assertEqual(self.rcv.state()['errors'], 2)
+        self.assertEqual([event[2] for event in self.events], [3])
+
+    def test_callback_answer(self):
+        block = self.plain.block(1, 'SIA-DCS', '#1234|NBA]')
+        self.result = 'DUH'
+        self.assertEqual(self.answers(block)[0][0][0], 'DUH')
+        self.result = 'OK'
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(self.answers(block)[0][0][0], 'DUH')
+
+    def test_encrypted(self):
+        block = self.crypt.block(4, 'SIA-DCS', '#5678|NBA]')
+        ret, rest = self.answers(block, self.crypt)
+        self.assertEqual(ret[0][0], 'ACK')
+        self.assertEqual(ret[0][2], 4)
+        self.assertLessEqual(abs(ret[0][1]), 2)
+        self.assertEqual(self.events, [('5678', 'SIA-DCS', 4, '#5678|NBA]')])
+
+    def test_stale_timestamp(self):
+        late = dc09_encoder('5678', key16, offset=-3600)
+        ret, rest = self.answers(late.block(5, 'SIA-DCS', '#5678|NBA]'), late)
+        # the NAK carries no message number but the receiver time
+        self.assertEqual(ret[0][0], 'NAK')
+        self.assertEqual(ret[0][2], 0)
+        self.assertLessEqual(abs(ret[0][1]), 2)
+        self.assertEqual(self.events, [])
+
+    def test_unknown_key(self):
+        other = dc09_encoder('9999', key16)
+        with self.assertLogs(level='WARNING'):
+            ret, rest = self.answers(other.block(6, 'SIA-DCS', '#9999|NBA]'))
+        self.assertEqual(ret[0][0], 'DUH')
+        self.assertEqual(self.events, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
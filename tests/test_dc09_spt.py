@@ -0,0 +1,190 @@
+# ----------------------------
+# Tests of the dialler
+# (c 2018 van Ovost Automatisering b.v.
+# Author : Jacq. van Ovost
+# ----------------------------
+import re
+import time
+import socket
+import threading
+import unittest
+from dc09_spt import dc09_spt
+from dc09_spt.dc09_receiver import dc09_receiver
+from dc09_spt.msgqueue import queued_msg, priority_queue
+
+
+class scripted_receiver(threading.Thread):
+    """
+    TCP receiver handling one connection at a time
+
+    The blocks of a connection are answered with the next script, a tuple of the number
+    of blocks to read first and a list of (answer, message number) to send then.
+    Without a script every block is acknowledged when it arrives.
+    """
+    block_nr = re.compile(rb'"\*?[A-Z0-9-]+"(\d{4})')
+
+    def __init__(self, scripts=()):
+        threading.Thread.__init__(self, daemon=True)
+        self.scripts = list(scripts)
+        self.received = []
+        self.answers = dc09_receiver()
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(4)
+        self.port = self.sock.getsockname()[1]
+        self.start()
+
+    def answer(self, res, nr):
+        return self.answers.answer(res, b'%04d' % nr, b'#1234', None)
+
+    def run(self):
+        while True:
+            try:
+                conn = self.sock.accept()[0]
+            except OSError:
+                return
+            numbers = []
+            self.received.append(numbers)
+            script = self.scripts.pop(0) if len(self.scripts) else None
+            buf = b''
+            while True:
+                data = conn.recv(4096)
+                if not data:
+                    break
+                buf += data
+                while b'\r' in buf:
+                    frame, buf = buf.split(b'\r', 1)
+                    nr = int(self.block_nr.search(frame).group(1))
+                    numbers.append(nr)
+                    if script is None:
+                        conn.sendall(self.answer('ACK', nr))
+                    elif len(numbers) == script[0]:
+                        conn.sendall(b''.join([self.answer(res, nr) for res, nr in script[1]]))
+            conn.close()
+
+    def close(self):
+        self.sock.close()
+
+
+class test_overflow(unittest.TestCase):
+    def dialler(self, **kwargs):
+        spt = dc09_spt.dc09_spt('1234', **kwargs)
+        self.addCleanup(spt.stop_send)
+        return spt
+
+    def test_reject(self):
+        spt = self.dialler(max_queue=2, overflow='reject')
+        self.assertEqual(spt.send_msg('SIA-DCS', {'code': 'BA'}), 1)
+        self.assertEqual(spt.send_msg('SIA-DCS', {'code': 'BA'}), 2)
+        with self.assertRaises(Exception):
+            spt.send_msg('SIA-DCS', {'code': 'BA'})
+        self.assertEqual(spt.queued, 2)
+        # the overflow policy of one message
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(spt.send_msg('SIA-DCS', {'code': 'BA'}, overflow='drop'))
+
+    def test_drop_newest(self):
+        spt = self.dialler(max_queue=2, overflow='drop')
+        spt.send_msg('SIA-DCS', {'code': 'BA'})
+        spt.send_msg('SIA-DCS', {'code': 'BA'})
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(spt.send_msg('SIA-DCS', {'code': 'BA'}))
+        self.assertEqual(spt.state()['msgs dropped'], 1)
+        # without a path the sender keeps taking the first message, stop it to look at the queue
+        spt.stop_send()
+        self.assertEqual([mess.msg_nr for mess in spt.queue], [1, 2])
+
+    def test_drop_least_urgent(self):
+        spt = self.dialler(queue=priority_queue(), max_queue=2, overflow='drop')
+        spt.send_msg('SIA-DCS', {'code': 'BA'})
+        spt.send_msg('SIA-DCS', {'code': 'BA'}, tclass='D1')
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(spt.send_msg('SIA-DCS', {'code': 'BA'}, tclass='D4'), 3)
+        spt.stop_send()
+        self.assertEqual([mess.msg_nr for mess in spt.queue], [3, 2])
+
+    def test_max_queue_bytes(self):
+        # the payload #1234|NBA] is 10 bytes
+        spt = self.dialler(max_queue_bytes=25, overflow='reject')
+        spt.send_msg('SIA-DCS', {'code': 'BA'})
+        spt.send_msg('SIA-DCS', {'code': 'BA'})
+        self.assertEqual(spt.queued_bytes, 20)
+        with self.assertRaises(Exception):
+            spt.send_msg('SIA-DCS', {'code': 'BA'})
+
+    def test_batch_rejected_part(self):
+        spt = self.dialler(max_queue=3, overflow='reject')
+        with self.assertLogs(level='ERROR'):
+            ret = spt.send_msgs([('SIA-DCS', {'code': 'BA', 'zone': x}) for x in range(5)])
+        self.assertEqual(ret, [1, 2, 3, None, None])
+        self.assertEqual(spt.queued, 3)
+        self.assertEqual(spt.send_msgs([]), [])
+
+    def test_batch_dropped_part(self):
+        spt = self.dialler(queue=priority_queue(), max_queue=2, overflow='drop')
+        with self.assertLogs(level='WARNING'):
+            ret = spt.send_msgs([('SIA-DCS', {'code': 'BA'}), ('SIA-DCS', {'code': 'BA'}, 'D1'),
+                                 ('SIA-DCS', {'code': 'BA'}, 'D4')])
+        self.assertEqual(ret, [None, 2, 3])
+        self.assertEqual(spt.state()['msgs dropped'], 1)
+
+    def test_block_until_delivered(self):
+        rcv = scripted_receiver()
+        self.addCleanup(rcv.close)
+        spt = self.dialler(max_queue=1)
+        spt.set_path('main', 'primary', '127.0.0.1', rcv.port, type='tcp')
+        ret = [spt.send_msg('SIA-DCS', {'code': 'BA', 'zone': x + 1}) for x in range(5)]
+        self.assertEqual(ret, [1, 2, 3, 4, 5])
+        deadline = time.monotonic() + 10
+        while spt.state()['msgs queued'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(spt.state()['msgs queued'], 0)
+        self.assertEqual([nr for numbers in rcv.received for nr in numbers], [1, 2, 3, 4, 5])
+
+
+class test_window(unittest.TestCase):
+    def transfer(self, count, *scripts):
+        rcv = scripted_receiver(scripts)
+        self.addCleanup(rcv.close)
+        spt = dc09_spt.dc09_spt('1234')
+        spt.set_path('main', 'primary', '127.0.0.1', rcv.port, type='tcp', window=8)
+        path = spt.tpaths['main']['primary']['path']
+        path.timeout = 0.5
+        self.metrics = path.metrics
+        messages = [queued_msg(nr, 'SIA-DCS', '#1234|NBA{}]'.format(nr)) for nr in range(1, count + 1)]
+        return spt.transfer_window(messages, path), rcv.received
+
+    def test_answers_in_any_order(self):
+        ret, received = self.transfer(3, (3, [('ACK', 3), ('ACK', 1), ('ACK', 2)]))
+        self.assertEqual(ret, [True, True, True])
+        self.assertEqual(received, [[1, 2, 3]])
+
+    def test_nak_belongs_to_oldest_block(self):
+        # the NAK of a receiver carries message number 0000
+        ret, received = self.transfer(3, (3, [('ACK', 2), ('NAK', 0), ('ACK', 3)]))
+        self.assertEqual(ret, [True, True, True])
+        self.assertEqual(received, [[1, 2, 3], [1]])
+        self.assertEqual(self.metrics.answers['NAK'], 1)
+        self.assertEqual(self.metrics.counters['timeouts'], 0)
+
+    def test_duh_is_retransmitted(self):
+        ret, received = self.transfer(3, (3, [('ACK', 1), ('DUH', 2), ('ACK', 3)]))
+        self.assertEqual(ret, [True, True, True])
+        self.assertEqual(received, [[1, 2, 3], [2]])
+
+    def test_unknown_number_is_ignored(self):
+        with self.assertLogs(level='WARNING'):
+            ret, received = self.transfer(2, (2, [('ACK', 7), ('ACK', 2), ('ACK', 1)]))
+        self.assertEqual(ret, [True, True])
+        self.assertEqual(received, [[1, 2]])
+
+    def test_missing_answer_is_retransmitted(self):
+        with self.assertLogs(level='ERROR'):
+            ret, received = self.transfer(2, (2, [('ACK', 2)]))
+        self.assertEqual(ret, [True, True])
+        self.assertEqual(received, [[1, 2], [1]])
+        self.assertEqual(self.metrics.counters['timeouts'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
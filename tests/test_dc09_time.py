@@ -0,0 +1,55 @@
+# ----------------------------
+# Tests of the DC09 timestamp codec
+# (c 2018 van Ovost Automatisering b.v.
+# Author : Jacq. van Ovost
+# ----------------------------
+import time
+import random
+import calendar
+import unittest
+from dc09_spt.msg import dc09_time
+
+dc09_format = '%H:%M:%S,%m-%d-%Y'
+
+
+class test_dc09_time(unittest.TestCase):
+    def seconds(self):
+        rnd = random.Random(9)
+        ret = [0, 59, 86399, 86400, 951782399, 951782400, 951868800, 4107542399, 4107542400,
+               calendar.timegm((2024, 2, 29, 23, 59, 59)), calendar.timegm((2100, 3, 1, 0, 0, 0)),
+               int(time.time())]
+        ret.extend(rnd.randrange(0, 8000000000) for x in range(2000))
+        return ret
+
+    def test_format_stamp(self):
+        for seconds in self.seconds():
+            expect = time.strftime(dc09_format, time.gmtime(seconds)).encode('ascii')
+            self.assertEqual(dc09_time.format_stamp(seconds), expect)
+            self.assertEqual(dc09_time.format_stamp(seconds + 0.999), expect)
+
+    def test_parse(self):
+        for seconds in self.seconds():
+            stamp = time.strftime(dc09_format, time.gmtime(seconds))
+            self.assertEqual(dc09_time.parse(stamp), calendar.timegm(time.strptime(stamp, dc09_format)))
+            self.assertEqual(dc09_time.parse(stamp.encode('ascii')), seconds)
+            self.assertEqual(dc09_time.parse(memoryview(stamp.encode('ascii'))), seconds)
+
+    def test_parse_invalid(self):
+        for stamp in ('24:00:00,01-01-2020', '12:60:00,01-01-2020', '12:00:00,13-01-2020',
+                      '12:00:00,00-01-2020', '12:00:00,01-00-2020', '12:00:00,04-31-2020',
+                      '12:00:00,02-29-2100', '12:00:00-01-01-2020', '12:00:00,01-01-20a0',
+                      '12:00:00,1-01-2020', '12:00:00,01-01-2020 ', ''):
+            with self.assertRaises(ValueError, msg=stamp):
+                dc09_time.parse(stamp)
+        self.assertEqual(dc09_time.parse('12:00:00,02-29-2000'), calendar.timegm((2000, 2, 29, 12, 0, 0)))
+
+    def test_clock(self):
+        self.assertIsNone(dc09_time.clock(0))
+        clock = dc09_time.clock(3600)
+        stamp = dc09_time.stamp(clock)
+        self.assertLessEqual(abs(dc09_time.parse(stamp) - (time.time() + 3600)), 1)
+        self.assertLessEqual(abs(dc09_time.parse(dc09_time.stamp()) - time.time()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
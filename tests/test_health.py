@@ -0,0 +1,95 @@
+# ----------------------------
+# Tests of the path health and circuit breaker
+# (c 2018 van Ovost Automatisering b.v.
+# Author : Jacq. van Ovost
+# ----------------------------
+import unittest
+from unittest import mock
+from dc09_spt.comm.health import path_health
+
+
+class test_path_health(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('dc09_spt.comm.health.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.health = path_health(threshold=3, backoff=1.0, max_backoff=4.0)
+
+    def fail(self, count):
+        with self.assertLogs(level='WARNING'):
+            for x in range(count):
+                self.health.begin()
+                self.health.failure()
+
+    def test_opens_after_threshold(self):
+        for x in range(2):
+            self.health.begin()
+            self.health.failure()
+        self.assertEqual(self.health.state, 'closed')
+        self.assertTrue(self.health.available())
+        self.fail(1)
+        self.assertEqual(self.health.state, 'open')
+        self.assertFalse(self.health.available())
+
+    def test_success_resets_the_failures(self):
+        for x in range(2):
+            self.health.failure()
+        self.health.success(0.1)
+        for x in range(2):
+            self.health.failure()
+        self.assertEqual(self.health.state, 'closed')
+
+    def test_half_open_trial(self):
+        self.fail(3)
+        self.now += 1.0
+        self.assertTrue(self.health.available())
+        self.health.begin()
+        self.assertEqual(self.health.state, 'half-open')
+        # one trial at a time
+        self.assertFalse(self.health.available())
+        with self.assertLogs(level='INFO'):
+            self.health.success(0.2)
+        self.assertEqual(self.health.state, 'closed')
+        self.assertTrue(self.health.available())
+
+    def test_backoff_doubles_up_to_maximum(self):
+        self.fail(3)
+        for backoff in (2.0, 4.0, 4.0):
+            self.now = self.health.open_until
+            self.fail(1)
+            self.assertEqual(self.health.state, 'open')
+            self.assertEqual(self.health.open_until - self.now, backoff)
+        self.now = self.health.open_until
+        self.health.begin()
+        with self.assertLogs(level='INFO'):
+            self.health.success()
+        self.fail(3)
+        self.assertEqual(self.health.open_until - self.now, 1.0)
+
+    def test_rank(self):
+        fast = path_health()
+        fast.success(0.01)
+        slow = path_health()
+        slow.success(0.5)
+        unmeasured = path_health()
+        flaky = path_health()
+        flaky.success(0.01)
+        flaky.failure()
+        flaky.failure()
+        broken = path_health(threshold=1)
+        with self.assertLogs(level='WARNING'):
+            broken.failure()
+        ranked = sorted([broken, flaky, unmeasured, slow, fast], key=path_health.rank)
+        self.assertEqual(ranked, [fast, slow, unmeasured, flaky, broken])
+
+    def test_srtt(self):
+        self.health.success(0.8)
+        self.assertEqual(self.health.srtt, 0.8)
+        self.health.success(0.0)
+        self.assertAlmostEqual(self.health.srtt, 0.7)
+        self.assertAlmostEqual(self.health.snapshot()['success rate'], 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+# ----------------------------
+# Tests of the send queues
+# (c 2018 van Ovost Automatisering b.v.
+# Author : Jacq. van Ovost
+# ----------------------------
+import os
+import time
+import tempfile
+import unittest
+from dc09_spt import dc09_spt
+from dc09_spt.msgqueue import queued_msg, priority_queue, persistent_queue, transmission_classes
+
+
+class test_priority_queue(unittest.TestCase):
+    def make(self, nr, deadline):
+        return queued_msg(nr, 'SIA-DCS', '#1234|NBA]', deadline)
+
+    def test_earliest_deadline_first(self):
+        queue = priority_queue()
+        now = time.monotonic()
+        for nr, deadline in ((1, None), (2, now + 60), (3, now + 20), (4, None), (5, now + 20)):
+            queue.push(self.make(nr, deadline))
+        self.assertEqual([mess.msg_nr for mess in queue], [3, 5, 2, 1, 4])
+        self.assertEqual([queue.popleft().msg_nr for x in range(len(queue))], [3, 5, 2, 1, 4])
+
+    def test_appendleft_keeps_the_order(self):
+        queue = priority_queue()
+        now = time.monotonic()
+        queue.push(self.make(1, now + 20))
+        queue.push(self.make(2, now + 20))
+        queue.push(self.make(3, None))
+        first = queue.popleft()
+        queue.appendleft(first)
+        self.assertEqual([mess.msg_nr for mess in queue], [1, 2, 3])
+
+    def test_drop_last_drops_least_urgent(self):
+        queue = priority_queue()
+        now = time.monotonic()
+        queue.push(self.make(1, now + 20))
+        queue.push(self.make(2, None))
+        queue.push(self.make(3, now + 240))
+        queue.push(self.make(4, None))
+        self.assertEqual(queue.drop_last().msg_nr, 4)
+        self.assertEqual(queue.drop_last().msg_nr, 2)
+        self.assertEqual([queue.popleft().msg_nr for x in range(len(queue))], [1, 3])
+
+    def test_breaches(self):
+        queue = priority_queue()
+        now = time.monotonic()
+        queue.ack(self.make(1, now + 60))
+        queue.ack(self.make(2, None))
+        self.assertEqual(queue.breaches, 0)
+        with self.assertLogs(level='WARNING'):
+            queue.ack(self.make(3, now - 1))
+        self.assertEqual(queue.breaches, 1)
+
+    def test_transmission_class_deadline(self):
+        before = time.monotonic()
+        due = dc09_spt.dc09_spt.deadline('D4')
+        self.assertTrue(before + transmission_classes['D4'] <= due <= time.monotonic() + transmission_classes['D4'])
+        self.assertIsNone(dc09_spt.dc09_spt.deadline())
+        self.assertLess(dc09_spt.dc09_spt.deadline('D1', 5), time.monotonic() + 6)
+        with self.assertRaises(Exception):
+            dc09_spt.dc09_spt.deadline('D9')
+
+    def test_dialler_sends_urgent_first(self):
+        spt = dc09_spt.dc09_spt('1234', queue=priority_queue())
+        spt.send_msg('SIA-DCS', {'code': 'BA', 'zone': 1})
+        spt.send_msg('SIA-DCS', {'code': 'BA', 'zone': 2}, tclass='D1')
+        spt.send_msg('SIA-DCS', {'code': 'BA', 'zone': 3}, tclass='D4')
+        spt.stop_send()
+        self.assertEqual([mess.msg_nr for mess in spt.queue], [3, 2, 1])
+
+
+class test_persistent_queue(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def fill(self, queue, count, first=1):
+        for nr in range(first, first + count):
+            queue.append(queued_msg(nr, 'SIA-DCS', '#1234|NBA{}]'.format(nr)))
+        queue.commit()
+
+    def segment_files(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith('.log'))
+
+    def test_recover_unacknowledged(self):
+        queue = persistent_queue(self.directory)
+        self.fill(queue, 3)
+        queue.ack(queue.popleft())
+        queue.close()
+        queue = persistent_queue(self.directory)
+        self.assertEqual([mess.msg_nr for mess in queue], [2, 3])
+        self.assertEqual(queue[0].mtype, 'SIA-DCS')
+        self.assertEqual(queue[0].message, '#1234|NBA2]')
+        queue.close()
+
+    def test_drop_last_is_not_recovered(self):
+        queue = persistent_queue(self.directory)
+        self.fill(queue, 3)
+        self.assertEqual(queue.drop_last().msg_nr, 3)
+        queue.close()
+        queue = persistent_queue(self.directory)
+        self.assertEqual([mess.msg_nr for mess in queue], [1, 2])
+        queue.close()
+
+    def test_delivered_segments_are_removed(self):
+        queue = persistent_queue(self.directory, segment_records=4)
+        self.fill(queue, 10)
+        self.assertEqual(len(self.segment_files()), 3)
+        for x in range(8):
+            queue.ack(queue.popleft())
+        queue.commit()
+        self.assertEqual(self.segment_files(), ['seg-0000000000000008.log'])
+        queue.close()
+        queue = persistent_queue(self.directory, segment_records=4)
+        self.assertEqual([mess.msg_nr for mess in queue], [9, 10])
+        queue.close()
+
+    def test_new_segment_after_full_recovered_segment(self):
+        queue = persistent_queue(self.directory, segment_records=4)
+        self.fill(queue, 4)
+        queue.close()
+        queue = persistent_queue(self.directory, segment_records=4)
+        self.fill(queue, 1, 5)
+        queue.close()
+        queue = persistent_queue(self.directory, segment_records=4)
+        self.assertEqual([mess.msg_nr for mess in queue], [1, 2, 3, 4, 5])
+        queue.close()
+
+    def test_torn_record_is_truncated(self):
+        queue = persistent_queue(self.directory)
+        self.fill(queue, 2)
+        name = os.path.join(self.directory, self.segment_files()[0])
+        size = os.path.getsize(name)
+        # a crash in the middle of writing the third record
+        with open(name, 'ab') as f:
+            f.write(persistent_queue._header.pack(40, 0) + b'partial')
+        queue = persistent_queue(self.directory)
+        self.assertEqual([mess.msg_nr for mess in queue], [1, 2])
+        self.assertEqual(os.path.getsize(name), size)
+        self.fill(queue, 1, 3)
+        queue.close()
+        queue = persistent_queue(self.directory)
+        self.assertEqual([mess.msg_nr for mess in queue], [1, 2, 3])
+        queue.close()
+
+    def test_corrupt_record_ends_the_segment(self):
+        queue = persistent_queue(self.directory)
+        self.fill(queue, 3)
+        queue.close()
+        name = os.path.join(self.directory, self.segment_files()[0])
+        with open(name, 'r+b') as f:
+            data = bytearray(f.read())
+            # flip a payload byte of the last record
+            data[-2] ^= 0xff
+            f.seek(0)
+            f.write(data)
+        queue = persistent_queue(self.directory)
+        self.assertEqual([mess.msg_nr for mess in queue], [1, 2])
+        queue.close()
+
+    def test_dialler_continues_message_numbers(self):
+        spt = dc09_spt.dc09_spt('1234', queue=persistent_queue(self.directory))
+        for x in range(3):
+            spt.send_msg('SIA-DCS', {'code': 'BA', 'zone': x + 1})
+        spt.stop_send()
+        spt.queue.close()
+        queue = persistent_queue(self.directory)
+        spt = dc09_spt.dc09_spt('1234', queue=queue)
+        self.assertEqual(spt.send_msg('SIA-DCS', {'code': 'BA'}), 4)
+        spt.stop_send()
+        queue.close()
+        queue = persistent_queue(self.directory)
+        self.assertEqual([mess.msg_nr for mess in queue], [1, 2, 3, 4])
+        queue.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+# ----------------------------
+# Tests of the name resolution cache and dual stack connect
+# (c 2018 van Ovost Automatisering b.v.
+# Author : Jacq. van Ovost
+# ----------------------------
+import socket
+import asyncio
+import unittest
+from unittest import mock
+from dc09_spt.comm import resolver as dns
+from dc09_spt.comm.transpathaio import happy_open
+from dc09_spt.dc09_spt_async import dc09_spt_async
+from dc09_spt.dc09_receiver import dc09_receiver
+
+v4 = (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('192.0.2.1', 12128))
+v4b = (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('192.0.2.2', 12128))
+v6 = (socket.AF_INET6, socket.SOCK_STREAM, 6, '', ('2001:db8::1', 12128, 0, 0))
+
+
+class test_resolver(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.lookups = 0
+        self.infos = [v4, v6]
+        patchers = [mock.patch('dc09_spt.comm.resolver.time.monotonic', lambda: self.now),
+                    mock.patch('dc09_spt.comm.resolver.socket.getaddrinfo', self.getaddrinfo),
+                    mock.patch('dc09_spt.comm.resolver.threading.Thread', self.thread)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.threads = []
+
+    def getaddrinfo(self, host, port, family, socktype):
+        self.lookups += 1
+        if isinstance(self.infos, Exception):
+            raise self.infos
+        return list(self.infos)
+
+    def thread(self, target, name=None, daemon=None):
+        # the background refresh runs when the test calls it
+        self.threads.append(target)
+        return mock.Mock()
+
+    def test_cached_for_ttl(self):
+        res = dns.resolver('receiver.example', 12128, ttl=300)
+        self.assertEqual(res.addresses(), [(socket.AF_INET, v4[4]), (socket.AF_INET6, v6[4])])
+        self.now += 299
+        res.addresses()
+        self.assertEqual(self.lookups, 1)
+
+    def test_expired_refreshed_in_background(self):
+        res = dns.resolver('receiver.example', 12128, ttl=300)
+        old = res.addresses()
+        self.infos = [v4b]
+        self.now += 301
+        # the old addresses are served while the refresh runs
+        self.assertEqual(res.addresses(), old)
+        self.assertEqual(res.addresses(), old)
+        self.assertEqual(len(self.threads), 1)
+        self.threads[0]()
+        self.assertEqual(res.addresses(), [(socket.AF_INET, v4b[4])])
+        self.assertEqual(self.lookups, 2)
+
+    def test_negative_cache(self):
+        self.infos = socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        res = dns.resolver('missing.example', 12128, negative_ttl=30)
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(res.addresses(), [])
+        self.now += 29
+        self.assertEqual(res.addresses(), [])
+        self.assertEqual(self.lookups, 1)
+        self.now += 2
+        self.infos = [v4]
+        self.assertEqual(res.addresses(), [(socket.AF_INET, v4[4])])
+        self.assertEqual(self.lookups, 2)
+
+    def test_failed_refresh_keeps_addresses(self):
+        res = dns.resolver('receiver.example', 12128, ttl=300, negative_ttl=30)
+        old = res.addresses()
+        self.infos = socket.gaierror(socket.EAI_AGAIN, 'Temporary failure in name resolution')
+        self.now += 301
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(res.refresh(), old)
+        self.now += 29
+        self.assertEqual(res.addresses(), old)
+        self.assertEqual(self.lookups, 2)
+
+    def test_invalidate(self):
+        res = dns.resolver('receiver.example', 12128)
+        res.addresses()
+        res.invalidate()
+        res.addresses()
+        self.assertEqual(self.lookups, 2)
+
+    def test_interleave(self):
+        v6b = (socket.AF_INET6, ('2001:db8::2', 12128, 0, 0))
+        addrs = [(socket.AF_INET6, v6[4]), v6b, (socket.AF_INET, v4[4]), (socket.AF_INET, v4b[4]),
+                 (socket.AF_INET6, v6[4])]
+        self.assertEqual(dns.resolver.interleave(addrs), [(socket.AF_INET6, v6[4]), (socket.AF_INET, v4[4]), v6b,
+                                                          (socket.AF_INET, v4b[4])])
+
+
+class test_connect(unittest.TestCase):
+    def setUp(self):
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(4)
+        self.addCleanup(self.server.close)
+        self.port = self.server.getsockname()[1]
+        # nothing listens on this port
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        self.closed = closed.getsockname()[1]
+        closed.close()
+
+    def test_happy_connect(self):
+        addrs = [(socket.AF_INET, ('127.0.0.1', self.closed)), (socket.AF_INET, ('127.0.0.1', self.port))]
+        sock = dns.happy_connect(addrs, 2.0)
+        self.assertEqual(sock.getpeername(), ('127.0.0.1', self.port))
+        sock.close()
+        with self.assertRaises(OSError):
+            dns.happy_connect([], 1.0)
+        with self.assertRaises(OSError):
+            dns.happy_connect([(socket.AF_INET, ('127.0.0.1', self.closed))], 1.0)
+
+    def test_happy_open(self):
+        async def connect(addrs):
+            reader, writer = await asyncio.wait_for(happy_open(addrs), 2.0)
+            peer = writer.get_extra_info('peername')
+            writer.close()
+            return peer
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        addrs = [(socket.AF_INET, ('127.0.0.1', self.closed)), (socket.AF_INET, ('127.0.0.1', self.port))]
+        self.assertEqual(loop.run_until_complete(connect(addrs)), ('127.0.0.1', self.port))
+        with self.assertRaises(OSError):
+            loop.run_until_complete(connect(addrs[:1]))
+        with self.assertRaises(OSError):
+            loop.run_until_complete(connect([]))
+
+    def test_async_dialler_uses_cache(self):
+        lookups = []
+
+        def getaddrinfo(host, port, family, socktype):
+            lookups.append(host)
+            return [(socket.AF_INET, socktype, 6, '', ('127.0.0.1', port))]
+
+        async def send():
+            rcv = dc09_receiver()
+            await rcv.start('127.0.0.1', 0, udp=False)
+            spt = dc09_spt_async('1234')
+            spt.set_path('main', 'primary', 'receiver.example', rcv.ports()[0][1], type='tcp')
+            for x in range(3):
+                spt.send_msg('SIA-DCS', {'code': 'BA', 'zone': x + 1})
+                for y in range(200):
+                    if spt.state()['msgs queued'] == 0 and not spt.sending:
+                        break
+                    await asyncio.sleep(0.01)
+            await spt.close()
+            rcv.close()
+            return rcv.state()['ACK']
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        with mock.patch('dc09_spt.comm.resolver.socket.getaddrinfo', getaddrinfo):
+            self.assertEqual(loop.run_until_complete(send()), 3)
+        self.assertEqual(lookups, ['receiver.example'])
+
+
+if __name__ == '__main__':
+    unittest.main()